@@ -0,0 +1,258 @@
+import os
+import tempfile
+import time
+from datetime import datetime, timedelta
+from statistics import median
+from unittest import mock
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import Session, sessionmaker
+
+environment = {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+}
+
+
+def create_session() -> Session:
+    """
+    Create a session against a temporary SQLite database with the schema of the API.
+    """
+    from src.database import Base
+    engine = create_engine(f"sqlite:///{tempfile.mkdtemp()}/benchmark.db", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def create_async_session_local(session: Session):
+    """
+    Create an AsyncSession factory for the aiosqlite driver against the database of session.
+    """
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{session.get_bind().url.database}")
+    return sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+
+def seed(session: Session, event_count: int):
+    """
+    Seed a user, an animal and event_count events.
+    """
+    from src.database import Animal, Event, User
+
+    now = datetime.now()
+    user = User(first_name="Bench", last_name="Mark", email_address="bench@pooper.online", password_hash="",
+                is_disabled=False, created=now, updated=now)
+    session.add(user)
+    session.flush()
+
+    animal = Animal(name="Benchmark", is_deactivated=False, created=now, created_by_user_id=user.id, updated=now,
+                    updated_by_user_id=user.id)
+    session.add(animal)
+    session.flush()
+
+    session.bulk_insert_mappings(Event, [{
+        "latitude": 59.91,
+        "longitude": 10.75,
+        "event_type": "Pee",
+        "animal_id": animal.id,
+        "created": now - timedelta(minutes=i),
+        "created_by_user_id": user.id,
+        "updated": now,
+        "updated_by_user_id": user.id
+    } for i in range(event_count)])
+    session.commit()
+
+
+def measure(function, repetitions: int = 5) -> float:
+    """
+    Return the median wall clock time of function in milliseconds.
+    """
+    timings = []
+    for _ in range(repetitions):
+        start = time.perf_counter()
+        function()
+        timings.append((time.perf_counter() - start) * 1000)
+    return median(timings)
+
+
+def create_client(session: Session):
+    """
+    Create a test client for the API that uses session for every synchronous request, and an aiosqlite session
+    against the same database for every asynchronous request.
+    """
+    from fastapi.testclient import TestClient
+    from src.database import get_async_database_session, get_database_session
+    from src.main import app
+
+    async_session_local = create_async_session_local(session)
+
+    async def get_benchmark_async_database_session():
+        async with async_session_local() as async_session:
+            yield async_session
+
+    app.dependency_overrides[get_database_session] = lambda: session
+    app.dependency_overrides[get_async_database_session] = get_benchmark_async_database_session
+    client = TestClient(app)
+    client.headers["Authorization"] = "Bearer benchmark"
+    return client
+
+
+def benchmark_event_pagination(pages=(1, 10, 100, 1000, 10000), page_size: int = 10):
+    """
+    Compare offset pagination with keyset pagination of GET /events from the first to the last page.
+    """
+    from src.database import Event
+    from src.services.events import encode_cursor
+
+    session = create_session()
+    seed(session, max(pages) * page_size)
+    client = create_client(session)
+
+    print(f"{'page':>8} {'offset (ms)':>12} {'keyset (ms)':>12}")
+    for page in pages:
+        # The cursor of a page is the id of the last event on the page before it.
+        cursor = {}
+        if page > 1:
+            before_id = session.query(Event.id).order_by(Event.id.desc()).offset((page - 1) * page_size - 1).first()[0]
+            cursor = {"cursor": encode_cursor("desc", before_id)}
+
+        offset_time = measure(lambda: client.get("/events/", params={"page": page - 1, "page_size": page_size}))
+        keyset_time = measure(lambda: client.get("/events/", params={"page_size": page_size, **cursor}))
+        print(f"{page:>8} {offset_time:>12.2f} {keyset_time:>12.2f}")
+
+
+async def request(app, path: str):
+    """
+    Send a GET request for path straight to an ASGI app.
+    """
+    scope = {
+        "type": "http",
+        "http_version": "1.1",
+        "method": "GET",
+        "scheme": "http",
+        "path": path,
+        "raw_path": path.encode(),
+        "root_path": "",
+        "query_string": b"",
+        "headers": [(b"authorization", b"Bearer benchmark")],
+        "client": ("127.0.0.1", 0),
+        "server": ("127.0.0.1", 80)
+    }
+
+    async def receive():
+        return {"type": "http.request", "body": b"", "more_body": False}
+
+    async def send(message):
+        pass
+
+    await app(scope, receive, send)
+
+
+def benchmark_event_concurrency(request_count: int = 500, concurrency: int = 200, event_count: int = 10000):
+    """
+    Compare requests per second of GET /events served by a synchronous handler on the threadpool with the
+    asynchronous handler, with concurrency requests in flight at a time.
+    """
+    import asyncio
+    from typing import List
+
+    from fastapi import Depends, FastAPI
+    from sqlalchemy.ext.asyncio import AsyncSession
+    from src.database import Event
+    from src.models.event import EventRead
+    from src.routers.events import get_statement
+    from src.services.events import get_event_read_options
+
+    session = create_session()
+    seed(session, event_count)
+    session_local = sessionmaker(bind=session.get_bind())
+    async_session_local = create_async_session_local(session)
+
+    def get_session():
+        sync_session = session_local()
+        try:
+            yield sync_session
+        finally:
+            sync_session.close()
+
+    async def get_async_session():
+        async with async_session_local() as async_session:
+            yield async_session
+
+    app = FastAPI()
+    statement = get_statement().options(*get_event_read_options()).order_by(Event.id.desc()).limit(100)
+
+    @app.get("/sync", response_model=List[EventRead])
+    def get_sync(sync_session: Session = Depends(get_session)):
+        return sync_session.execute(statement).scalars().all()
+
+    @app.get("/async", response_model=List[EventRead])
+    async def get_async(async_session: AsyncSession = Depends(get_async_session)):
+        return (await async_session.execute(statement)).scalars().all()
+
+    async def run(path: str) -> float:
+        semaphore = asyncio.Semaphore(concurrency)
+
+        async def limited_request():
+            async with semaphore:
+                await request(app, path)
+
+        start = time.perf_counter()
+        await asyncio.gather(*[limited_request() for _ in range(request_count)])
+        return request_count / (time.perf_counter() - start)
+
+    print(f"{'handler':>8} {'requests/s':>12}")
+    for handler in ("sync", "async"):
+        print(f"{handler:>8} {asyncio.run(run(f'/{handler}')):>12.1f}")
+
+
+def benchmark_event_serialization(page_size: int = 100, repetitions: int = 100):
+    """
+    Compare the time to serialize a page of events through the response model of GET /events with building dicts
+    from rows and encoding them with orjson.
+    """
+    import asyncio
+    from typing import List
+
+    from fastapi.responses import JSONResponse
+    from fastapi.routing import serialize_response
+    from fastapi.utils import create_response_field
+    from src.database import Event
+    from src.models.event import EventRead
+    from src.routers.events import get_statement
+    from src.services.events import get_event_read_options
+    from src.services.serialization import create_json_response, event_to_dict, get_event_row_statement
+
+    session = create_session()
+    seed(session, page_size)
+    statement = get_statement().order_by(Event.id.desc()).limit(page_size)
+    events = session.execute(statement.options(*get_event_read_options())).scalars().all()
+    rows = session.execute(get_event_row_statement(statement)).all()
+    field = create_response_field("Response", List[EventRead])
+
+    def serialize_with_response_model():
+        content = asyncio.run(serialize_response(field=field, response_content=events))
+        return JSONResponse(content).body
+
+    def serialize_with_orjson():
+        return create_json_response([event_to_dict(row) for row in rows]).body
+
+    print(f"{'serializer':>16} {'ms per page':>12}")
+    for name, function in [("response model", serialize_with_response_model), ("orjson", serialize_with_orjson)]:
+        print(f"{name:>16} {measure(lambda: [function() for _ in range(repetitions)]) / repetitions:>12.3f}")
+
+
+if __name__ == "__main__":
+    with mock.patch.dict(os.environ, environment):
+        benchmark_event_pagination()
+        benchmark_event_concurrency()
+        benchmark_event_serialization()
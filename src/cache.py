@@ -0,0 +1,122 @@
+import time
+from abc import ABC, abstractmethod
+from collections import OrderedDict
+from threading import Lock
+from typing import Any, Hashable, Optional
+
+
+class TTLCache:
+    """
+    Thread safe in-process cache which evicts the least recently used entry beyond maxsize entries, and expires
+    entries ttl_seconds after they were set.
+    """
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.maxsize = maxsize
+        self.ttl_seconds = ttl_seconds
+        self.__entries: OrderedDict = OrderedDict()
+        self.__lock = Lock()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self.__lock:
+            entry = self.__entries.get(key)
+
+            if entry is None:
+                return None
+
+            expires, value = entry
+            if expires <= time.monotonic():
+                del self.__entries[key]
+                return None
+
+            self.__entries.move_to_end(key)
+            return value
+
+    def set(self, key: Hashable, value: Any):
+        with self.__lock:
+            self.__entries[key] = (time.monotonic() + self.ttl_seconds, value)
+            self.__entries.move_to_end(key)
+
+            while len(self.__entries) > self.maxsize:
+                self.__entries.popitem(last=False)
+
+    def delete(self, key: Hashable):
+        with self.__lock:
+            self.__entries.pop(key, None)
+
+    def clear(self):
+        with self.__lock:
+            self.__entries.clear()
+
+    def __len__(self):
+        with self.__lock:
+            return len(self.__entries)
+
+
+class CacheBackend(ABC):
+    """
+    Storage for serialized values shared by everything which reads through a cache, and for the counters used to
+    invalidate them. The methods are coroutines, so that a remote backend does not block the event loop.
+    """
+    @abstractmethod
+    async def get(self, key: str) -> Optional[bytes]:
+        pass
+
+    @abstractmethod
+    async def set(self, key: str, value: bytes):
+        pass
+
+    @abstractmethod
+    async def get_counter(self, key: str) -> int:
+        pass
+
+    @abstractmethod
+    async def increment(self, key: str) -> int:
+        pass
+
+
+class LocalCacheBackend(CacheBackend):
+    """
+    Keep values in a TTLCache within the process. Counters never expire.
+    """
+    def __init__(self, maxsize: int, ttl_seconds: float):
+        self.__values = TTLCache(maxsize, ttl_seconds)
+        self.__counters = {}
+        self.__lock = Lock()
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return self.__values.get(key)
+
+    async def set(self, key: str, value: bytes):
+        self.__values.set(key, value)
+
+    async def get_counter(self, key: str) -> int:
+        with self.__lock:
+            return self.__counters.get(key, 0)
+
+    async def increment(self, key: str) -> int:
+        with self.__lock:
+            self.__counters[key] = self.__counters.get(key, 0) + 1
+            return self.__counters[key]
+
+
+class RedisCacheBackend(CacheBackend):
+    """
+    Keep values in Redis through an asyncio client, or anything implementing its get, set and incr commands as
+    coroutines, so that every process of the API shares them. Values expire after ttl_seconds and are evicted
+    according to the maxmemory-policy of the server.
+    """
+    def __init__(self, client, ttl_seconds: float):
+        self.client = client
+        self.ttl_seconds = ttl_seconds
+
+    async def get(self, key: str) -> Optional[bytes]:
+        return await self.client.get(key)
+
+    async def set(self, key: str, value: bytes):
+        await self.client.set(key, value, ex=max(1, round(self.ttl_seconds)))
+
+    async def get_counter(self, key: str) -> int:
+        return int(await self.client.get(key) or 0)
+
+    async def increment(self, key: str) -> int:
+        return await self.client.incr(key)
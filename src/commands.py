@@ -0,0 +1,76 @@
+import argparse
+
+from .database import Event, SessionLocal
+from .services.animal_status import rebuild_last_events
+from .services.event_rollup import rebuild_rollup
+from .services.geo import encode_geohash
+from .services.sync import prune_tombstones
+
+BATCH_SIZE = 1000
+
+
+def rebuild_event_rollup():
+    session = SessionLocal()
+    try:
+        rebuild_rollup(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+def rebuild_animal_last_event():
+    session = SessionLocal()
+    try:
+        rebuild_last_events(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+def prune_expired_tombstones():
+    session = SessionLocal()
+    try:
+        prune_tombstones(session)
+        session.commit()
+    finally:
+        session.close()
+
+
+def backfill_event_geohash():
+    """
+    Set the geohash of the events created before it was recorded, a batch at a time.
+    """
+    session = SessionLocal()
+    try:
+        while True:
+            events = session.query(Event.id, Event.latitude, Event.longitude)\
+                .where(Event.geohash.is_(None))\
+                .limit(BATCH_SIZE)\
+                .all()
+
+            if len(events) == 0:
+                return
+
+            session.bulk_update_mappings(Event, [{"id": event_id, "geohash": encode_geohash(latitude, longitude)}
+                                                 for event_id, latitude, longitude in events])
+            session.commit()
+    finally:
+        session.close()
+
+
+commands = {
+    "backfill-event-geohash": backfill_event_geohash,
+    "prune-tombstones": prune_expired_tombstones,
+    "rebuild-animal-last-event": rebuild_animal_last_event,
+    "rebuild-event-rollup": rebuild_event_rollup
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands for the Pooper API.")
+    parser.add_argument("command", choices=commands.keys())
+    commands[parser.parse_args().command]()
+
+
+if __name__ == "__main__":
+    main()
@@ -1,22 +1,52 @@
 from datetime import datetime
 from logging import getLogger
 
-from sqlalchemy import Boolean, create_engine, Column, DateTime, Float, ForeignKey, Integer, String, UniqueConstraint
+from sqlalchemy import Boolean, create_engine, Column, Date, DateTime, Float, ForeignKey, Index, Integer, String, \
+    UniqueConstraint
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.ext.hybrid import hybrid_property
 from sqlalchemy.orm import declarative_base, relationship, sessionmaker, declared_attr
 
 from .auth import pwd_context
+from .metrics import register_metrics
+from .pool import InstrumentedAsyncAdaptedQueuePool, InstrumentedQueuePool
+from .services.geo import encode_geohash, GEOHASH_PRECISION
 from .settings_manager import settingsManager
 
 Base = declarative_base()
 
 log = getLogger(__name__)
-engine = create_engine(f"mariadb+mariadbconnector://"
-                       f"{settingsManager.get_setting('MARIADB_USER')}:"
-                       f"{settingsManager.get_setting('MARIADB_PASSWORD')}@"
-                       f"{settingsManager.get_setting('MARIADB_SERVER')}/"
-                       f"{settingsManager.get_setting('MARIADB_DATABASE')}")
+
+
+def get_database_url(driver: str) -> str:
+    return f"mariadb+{driver}://" \
+           f"{settingsManager.get_setting('MARIADB_USER')}:" \
+           f"{settingsManager.get_setting('MARIADB_PASSWORD')}@" \
+           f"{settingsManager.get_setting('MARIADB_SERVER')}/" \
+           f"{settingsManager.get_setting('MARIADB_DATABASE')}"
+
+
+def get_pool_options() -> dict:
+    """
+    Get the connection pool options. Connections are pinged on checkout and recycled before MariaDB times them out.
+    """
+    return {
+        "pool_size": int(settingsManager.get_setting('MARIADB_POOL_SIZE')),
+        "max_overflow": int(settingsManager.get_setting('MARIADB_MAX_OVERFLOW')),
+        "pool_timeout": int(settingsManager.get_setting('MARIADB_POOL_TIMEOUT')),
+        "pool_recycle": int(settingsManager.get_setting('MARIADB_POOL_RECYCLE')),
+        "pool_pre_ping": True
+    }
+
+
+engine = create_engine(get_database_url("mariadbconnector"), poolclass=InstrumentedQueuePool, **get_pool_options())
 SessionLocal = sessionmaker(bind=engine)
+async_engine = create_async_engine(get_database_url(settingsManager.get_setting('MARIADB_ASYNC_DRIVER')),
+                                   poolclass=InstrumentedAsyncAdaptedQueuePool, **get_pool_options())
+AsyncSessionLocal = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+register_metrics("database_pool", lambda: engine.pool.get_metrics())
+register_metrics("async_database_pool", lambda: async_engine.sync_engine.pool.get_metrics())
 
 
 class BaseMixin(object):
@@ -33,6 +63,7 @@ class BaseMixin(object):
 
 class Animal(BaseMixin, Base):
     __tablename__ = 'animal'
+    __table_args__ = (Index('ix_animal_updated', 'updated'),)
 
     name = Column(String(256), nullable=False)
     is_deactivated = Column(Boolean, nullable=False)
@@ -58,6 +89,10 @@ class Animal(BaseMixin, Base):
 
 class AnimalEventTypeAssociation(Base):
     __tablename__ = 'animal_event_type_association'
+    __table_args__ = (
+        UniqueConstraint('animal_id', 'event_type'),
+        Index('ix_animal_event_type_association_updated', 'updated'),
+    )
 
     id = Column(Integer, primary_key=True)
     animal_id = Column(Integer, ForeignKey('animal.id', ondelete='cascade'))
@@ -70,6 +105,10 @@ class AnimalEventTypeAssociation(Base):
 
 class AnimalConditionTypeAssociation(Base):
     __tablename__ = 'animal_condition_association'
+    __table_args__ = (
+        UniqueConstraint('animal_id', 'condition_type'),
+        Index('ix_animal_condition_association_updated', 'updated'),
+    )
 
     id = Column(Integer, primary_key=True)
     animal_id = Column(Integer, ForeignKey('animal.id', ondelete='cascade'))
@@ -81,12 +120,22 @@ class AnimalConditionTypeAssociation(Base):
 
 
 class AnimalWeight(BaseMixin, Base):
+    __table_args__ = (
+        Index('ix_animalweight_created', 'created'),
+        Index('ix_animalweight_animal_id_created', 'animal_id', 'created'),
+        Index('ix_animalweight_updated', 'updated'),
+    )
+
     animal_id = Column(Integer, ForeignKey('animal.id', ondelete='cascade'))
     weight_in_grams = Column(Float, nullable=False)
 
 
 class Condition(BaseMixin, Base):
-    __table_args__ = (UniqueConstraint('animal_id', 'condition_type'),)
+    __table_args__ = (
+        UniqueConstraint('animal_id', 'condition_type'),
+        Index('ix_condition_created', 'created'),
+        Index('ix_condition_updated', 'updated'),
+    )
 
     animal_id = Column(Integer, ForeignKey('animal.id', ondelete='cascade'))
     animal = relationship("Animal", back_populates="tracked_conditions")
@@ -94,12 +143,26 @@ class Condition(BaseMixin, Base):
     is_enabled = Column(Boolean, nullable=False)
 
 
+def get_event_geohash(context) -> str:
+    parameters = context.get_current_parameters()
+    return encode_geohash(parameters['latitude'], parameters['longitude'])
+
+
 class Event(Base):
     __tablename__ = 'event'
+    __table_args__ = (
+        UniqueConstraint('created_by_user_id', 'idempotency_key'),
+        Index('ix_event_animal_id_event_type_created', 'animal_id', 'event_type', 'created'),
+        Index('ix_event_trip_id', 'trip_id'),
+        Index('ix_event_created', 'created'),
+        Index('ix_event_updated', 'updated'),
+        Index('ix_event_geohash', 'geohash'),
+    )
 
     id = Column(Integer, primary_key=True)
     latitude = Column(Float, nullable=False)
     longitude = Column(Float, nullable=False)
+    geohash = Column(String(GEOHASH_PRECISION), nullable=True, default=get_event_geohash)
     event_type = Column(String(256), nullable=False)
     animal_id = Column(Integer, ForeignKey('animal.id'))
     created = Column(DateTime, nullable=False)
@@ -117,6 +180,7 @@ class Event(Base):
     created_by_user = relationship("User", back_populates="events")
     rating = Column(Integer)
     trip_id = Column(Integer, nullable=True)
+    idempotency_key = Column(String(64), nullable=True)
 
     @hybrid_property
     def animal_name(self):
@@ -131,8 +195,42 @@ class Event(Base):
         return True if self.animal_event_type_association is not None else False
 
 
+class EventDailyRollup(Base):
+    """
+    The number of events and the sum of their ratings per animal, event type and server-local day.
+    """
+    __tablename__ = 'event_daily_rollup'
+    __table_args__ = (Index('ix_event_daily_rollup_day', 'day'),)
+
+    animal_id = Column(Integer, primary_key=True)
+    event_type = Column(String(256), primary_key=True)
+    day = Column(Date, primary_key=True)
+    count = Column(Integer, nullable=False)
+    rating_sum = Column(Integer, nullable=False)
+    rating_count = Column(Integer, nullable=False)
+
+    @property
+    def avg_rating(self):
+        return self.rating_sum / self.rating_count if self.rating_count > 0 else None
+
+
+class AnimalLastEvent(Base):
+    """
+    The latest event per animal and event type.
+    """
+    __tablename__ = 'animal_last_event'
+
+    animal_id = Column(Integer, ForeignKey('animal.id', ondelete='cascade'), primary_key=True)
+    event_type = Column(String(256), primary_key=True)
+    event_id = Column(Integer, nullable=False)
+    created = Column(DateTime, nullable=False)
+    created_by_user_id = Column(Integer, nullable=False)
+    rating = Column(Integer, nullable=True)
+
+
 class Note(Base):
     __tablename__ = 'note'
+    __table_args__ = (Index('ix_note_updated', 'updated'),)
 
     id = Column(Integer, primary_key=True)
     text = Column(String(256), nullable=False)
@@ -182,13 +280,26 @@ class NotificationSubscription(Base):
     updated = Column(DateTime, nullable=False)
 
 
+class Tombstone(Base):
+    __tablename__ = 'tombstone'
+    __table_args__ = (Index('ix_tombstone_deleted', 'deleted'),)
+
+    id = Column(Integer, primary_key=True)
+    table_name = Column(String(256), nullable=False)
+    row_id = Column(Integer, nullable=False)
+    deleted = Column(DateTime, nullable=False)
+
+
 class Trip(Base):
     __tablename__ = 'trip'
+    __table_args__ = (Index('ix_trip_created_date', 'created_date'),)
 
     id = Column(Integer, primary_key=True)
     created_by_user_id = Column(Integer, ForeignKey('user.id'))
     created_by_user = relationship("User")
     created_date = Column(DateTime, nullable=False)
+    events = relationship("Event", primaryjoin="Trip.id == foreign(Event.trip_id)", order_by="Event.created",
+                          viewonly=True)
 
     @hybrid_property
     def created_by_user_name(self):
@@ -197,6 +308,10 @@ class Trip(Base):
 
 class User(Base):
     __tablename__ = 'user'
+    __table_args__ = (
+        Index('ix_user_email_address', 'email_address'),
+        Index('ix_user_updated', 'updated'),
+    )
 
     id = Column(Integer, primary_key=True)
     first_name = Column(String(256), nullable=False)
@@ -226,6 +341,11 @@ def get_database_session():
         session.close()
 
 
+async def get_async_database_session():
+    async with AsyncSessionLocal() as session:
+        yield session
+
+
 def seed_users():
     log.info("Seeding users")
     email_address = "admin@pooper.online"
@@ -5,8 +5,11 @@ from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
 from .logging_config import logging_config
+from .middleware import SelectiveGZipMiddleware
 from .database import create_db_and_tables, seed_users
-from .routers import animals, auth, events, users, notifications, trips, conditions
+from .services.notification_dispatcher import notification_dispatcher
+from .services.passwords import password_hasher
+from .routers import animals, auth, events, users, notifications, trips, conditions, metrics, sync
 from .settings_manager import settingsManager
 
 logging.config.dictConfig(logging_config)
@@ -28,14 +31,19 @@ app.add_middleware(
     allow_origins=settingsManager.get_setting('CLIENT_BASE_URL').split(','),
     allow_credentials=True,
     allow_methods=["*"],
-    allow_headers=["*"]
+    allow_headers=["*"],
+    expose_headers=[events.NEXT_CURSOR_HEADER, "ETag", "Last-Modified"]
 )
 
+app.add_middleware(SelectiveGZipMiddleware, minimum_size=int(settingsManager.get_setting('GZIP_MINIMUM_SIZE')))
+
 app.include_router(animals.router)
 app.include_router(auth.router)
 app.include_router(conditions.router)
 app.include_router(events.router)
+app.include_router(metrics.router)
 app.include_router(notifications.router)
+app.include_router(sync.router)
 app.include_router(trips.router)
 app.include_router(users.router)
 
@@ -44,3 +52,11 @@ app.include_router(users.router)
 def on_startup():
     create_db_and_tables()
     seed_users()
+    notification_dispatcher.start()
+    password_hasher.start()
+
+
+@app.on_event("shutdown")
+def on_shutdown():
+    notification_dispatcher.stop()
+    password_hasher.stop()
@@ -0,0 +1,41 @@
+from threading import Lock
+from typing import Callable, Dict
+
+__metric_providers: Dict[str, Callable[[], dict]] = {}
+
+
+class Timer:
+    """
+    Thread safe aggregate of observed durations.
+    """
+    def __init__(self):
+        self.__lock = Lock()
+        self.count = 0
+        self.total_seconds = 0.0
+        self.max_seconds = 0.0
+
+    def observe(self, seconds: float):
+        with self.__lock:
+            self.count += 1
+            self.total_seconds += seconds
+            self.max_seconds = max(self.max_seconds, seconds)
+
+    def get_metrics(self) -> dict:
+        with self.__lock:
+            return {
+                "count": self.count,
+                "total_seconds": self.total_seconds,
+                "average_seconds": self.total_seconds / self.count if self.count > 0 else 0.0,
+                "max_seconds": self.max_seconds
+            }
+
+
+def register_metrics(name: str, provider: Callable[[], dict]):
+    """
+    Register a function which returns the current metrics of a component under name.
+    """
+    __metric_providers[name] = provider
+
+
+def get_metrics() -> dict:
+    return {name: provider() for name, provider in __metric_providers.items()}
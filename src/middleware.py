@@ -0,0 +1,16 @@
+from starlette.datastructures import Headers
+from starlette.middleware.gzip import GZipMiddleware
+from starlette.types import Receive, Scope, Send
+
+
+class SelectiveGZipMiddleware(GZipMiddleware):
+    """
+    Compress responses like GZipMiddleware, except for requests of event streams. The gzip stream is only flushed when
+    its buffer fills, which would hold back Server-Sent Events indefinitely.
+    """
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] == "http" and "text/event-stream" in Headers(scope=scope).get("Accept", ""):
+            await self.app(scope, receive, send)
+            return
+
+        await super().__call__(scope, receive, send)
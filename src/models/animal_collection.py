@@ -0,0 +1,10 @@
+from enum import Enum
+
+
+class AnimalCollection(str, Enum):
+    Notes = 'notes'
+    TrackedConditions = 'tracked_conditions'
+    TrackedEvents = 'tracked_events'
+    TrackedConditionTypes = 'tracked_condition_types'
+    TrackedEventTypes = 'tracked_event_types'
+    WeightHistory = 'weight_history'
@@ -0,0 +1,25 @@
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+from .condition import ConditionRead
+from .event_type import EventType
+
+
+class AnimalLastEventRead(BaseModel):
+    event_type: EventType
+    event_id: int
+    created: datetime
+    created_by_user_id: int
+    rating: Optional[int]
+
+    class Config:
+        orm_mode = True
+
+
+class AnimalStatusRead(BaseModel):
+    animal_id: int
+    name: str
+    last_events: List[AnimalLastEventRead]
+    conditions: List[ConditionRead]
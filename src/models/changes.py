@@ -0,0 +1,18 @@
+from typing import List
+
+from pydantic import BaseModel
+
+from .animal_weight import AnimalWeightRead
+from .condition import ConditionRead
+from .event import EventRead
+from .note import NoteRead
+from .tombstone import TombstoneRead
+
+
+class ChangesRead(BaseModel):
+    token: str
+    events: List[EventRead]
+    conditions: List[ConditionRead]
+    weights: List[AnimalWeightRead]
+    notes: List[NoteRead]
+    deleted: List[TombstoneRead]
@@ -0,0 +1,6 @@
+from enum import Enum
+
+
+class DownsamplingMethod(str, Enum):
+    lttb = 'lttb'
+    buckets = 'buckets'
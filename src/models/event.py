@@ -1,7 +1,8 @@
 from datetime import datetime
 from typing import Optional
 
-from pydantic import BaseModel
+from pydantic import BaseModel, constr
+from .event_batch_item_status import EventBatchItemStatus
 from .event_type import EventType
 
 
@@ -28,3 +29,14 @@ class EventRead(EventBase):
 
     class Config:
         orm_mode = True
+
+
+class EventBatchItem(EventCreate):
+    idempotency_key: constr(min_length=1, max_length=64)
+
+
+class EventBatchItemResult(BaseModel):
+    idempotency_key: str
+    status: EventBatchItemStatus
+    event_id: Optional[int]
+    detail: Optional[str]
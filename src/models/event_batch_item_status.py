@@ -0,0 +1,7 @@
+from enum import Enum
+
+
+class EventBatchItemStatus(str, Enum):
+    Created = 'Created'
+    Duplicate = 'Duplicate'
+    Invalid = 'Invalid'
@@ -0,0 +1,17 @@
+from datetime import date
+from typing import Optional
+
+from pydantic import BaseModel
+
+from .event_type import EventType
+
+
+class EventStatsRead(BaseModel):
+    day: date
+    animal_id: int
+    event_type: EventType
+    count: int
+    avg_rating: Optional[float]
+
+    class Config:
+        orm_mode = True
@@ -0,0 +1,20 @@
+from typing import List
+
+from pydantic import BaseModel
+
+
+class TileCellRead(BaseModel):
+    row: int
+    column: int
+    count: int
+    latitude: float
+    longitude: float
+
+
+class TileRead(BaseModel):
+    z: int
+    x: int
+    y: int
+    grid_size: int
+    count: int
+    cells: List[TileCellRead]
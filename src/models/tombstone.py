@@ -0,0 +1,12 @@
+from datetime import datetime
+
+from pydantic import BaseModel
+
+
+class TombstoneRead(BaseModel):
+    table_name: str
+    row_id: int
+    deleted: datetime
+
+    class Config:
+        orm_mode = True
@@ -2,6 +2,8 @@ from typing import List
 
 from pydantic import BaseModel
 
+from .event import EventRead
+
 
 class TripBase(BaseModel):
     pass
@@ -17,3 +19,7 @@ class TripRead(TripBase):
 
     class Config:
         orm_mode = True
+
+
+class TripDetailRead(TripRead):
+    events: List[EventRead]
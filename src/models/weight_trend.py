@@ -0,0 +1,18 @@
+from datetime import datetime
+from typing import List, Optional
+
+from pydantic import BaseModel
+
+
+class WeightTrendPointRead(BaseModel):
+    created: datetime
+    weight_in_grams: float
+    moving_average: float
+
+
+class WeightTrendRead(BaseModel):
+    animal_id: int
+    count: int
+    slope_grams_per_day: Optional[float]
+    change_percent: Optional[float]
+    points: List[WeightTrendPointRead]
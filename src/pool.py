@@ -0,0 +1,38 @@
+import time
+
+from sqlalchemy.pool import AsyncAdaptedQueuePool, QueuePool
+
+from .metrics import Timer
+
+
+class InstrumentedPoolMixin:
+    """
+    Measure how long checkouts wait for a connection, and report the usage of the pool.
+    """
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.checkout_wait = Timer()
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            self.checkout_wait.observe(time.perf_counter() - start)
+
+    def get_metrics(self) -> dict:
+        return {
+            "size": self.size(),
+            "checked_in": self.checkedin(),
+            "checked_out": self.checkedout(),
+            "overflow": max(self.overflow(), 0),
+            "checkout_wait": self.checkout_wait.get_metrics()
+        }
+
+
+class InstrumentedQueuePool(InstrumentedPoolMixin, QueuePool):
+    pass
+
+
+class InstrumentedAsyncAdaptedQueuePool(InstrumentedPoolMixin, AsyncAdaptedQueuePool):
+    pass
@@ -2,21 +2,38 @@ from datetime import datetime
 import logging
 from typing import List, Optional
 
-from fastapi import APIRouter, status, HTTPException, Depends
+from fastapi import APIRouter, status, HTTPException, Depends, Request, Response
 import fastapi
-from sqlalchemy import func
-from sqlalchemy.orm import Query, noload
+from sqlalchemy import func, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import Select
 from sqlmodel import Session
 
 from ..auth import oauth2_scheme
-from ..database import get_database_session, Animal, Note, AnimalEventTypeAssociation, AnimalConditionTypeAssociation, \
-    Condition, AnimalWeight
+from ..database import get_async_database_session, get_database_session, Animal, Note, AnimalEventTypeAssociation, \
+    AnimalConditionTypeAssociation, Condition, AnimalWeight, Event, User
 from ..models.animal import AnimalRead, AnimalCreate
+from ..models.animal_collection import AnimalCollection
+from ..models.animal_status import AnimalStatusRead
 from ..models.animal_weight import AnimalWeightRead, AnimalWeightCreate
 from ..models.condition_type import ConditionType
-from ..models.event_type import EventType
+from ..models.downsampling_method import DownsamplingMethod
+from ..models.export_format import ExportFormat
 from ..models.note import NoteCreate, NoteRead
-from ..services.users import get_current_user
+from ..models.weight_trend import WeightTrendRead
+from ..services.animal_status import get_statuses
+from ..services.animals import DEFAULT_COLLECTIONS, delete_animal_rows, get_animals, update_tracked_types
+from ..services.conditional_requests import get_not_modified_response
+from ..services.event_bus import event_bus
+from ..services.export import create_export_response
+from ..services.response_cache import ANIMALS_NAMESPACE, CONDITIONS_NAMESPACE, response_cache
+from ..services.serialization import animal_to_dict, animal_weight_to_dict, create_json_response, \
+    create_rendered_response, is_fast_json_enabled, render
+from ..services.sync import add_tombstone
+from ..services.tiles import tile_cache
+from ..services.time_window import filter_by_time_window
+from ..services.users import get_current_principal
+from ..services.weight_trend import get_trends, validate_trend
 
 router = APIRouter(
     prefix="/animals",
@@ -26,72 +43,207 @@ router = APIRouter(
 
 log = logging.getLogger(__name__)
 
+DEFAULT_MAX_POINTS = 200
+DEFAULT_WINDOW_DAYS = 7
+
 
 @router.get("/count", response_model=int)
-def get_animal_count(session: Session = Depends(get_database_session)):
-    return session.query(func.count(Animal.id)).scalar()
+async def get_animal_count(session: AsyncSession = Depends(get_async_database_session)):
+    return (await session.execute(select(func.count(Animal.id)))).scalar()
 
 
 @router.get("/", response_model=List[AnimalRead])
-def get_all_animals(
+async def get_all_animals(
+        request: Request,
+        response: Response,
         include_deactivated: bool = False,
         include_events: bool = False,
         include_conditions: bool = False,
         include_weight_history: bool = False,
+        expand: Optional[List[AnimalCollection]] = fastapi.Query(None),
+        collection_limit: Optional[int] = None,
+        weight_days: Optional[int] = None,
+        weight_limit: int = 100,
         page: int = 0,
         page_size: int = 100,
-        session: Session = Depends(get_database_session)
+        session: AsyncSession = Depends(get_async_database_session)
 ):
-    statement: Query = session.query(Animal)
+    """
+    Get a page of animals.
+    Only the collections in expand are loaded, and the rest are returned empty. Notes and tracked event types are
+    loaded when expand is not given. The tracked events of each animal are capped to the latest collection_limit,
+    which defaults to 100, and the notes only when collection_limit is given. The weight history is capped to the
+    latest weight_limit within the last weight_days.
+    """
+    not_modified = await get_not_modified_response(session, request, response, Animal.updated, Note.updated,
+                                                    Event.updated, Condition.updated, AnimalWeight.updated,
+                                                    AnimalConditionTypeAssociation.updated,
+                                                    AnimalEventTypeAssociation.updated, User.updated)
+    if not_modified is not None:
+        return not_modified
+
+    statement: Select = select(Animal)
 
     statement = statement if include_deactivated is True else statement.where(Animal.is_deactivated.is_not(True))
-    statement = statement if include_events is True else statement.options(noload('tracked_events'))
-    statement = statement if include_conditions is True else statement.options(noload('tracked_conditions'))
-    statement = statement.join(AnimalWeight) if include_weight_history is True else statement
 
-    return statement.offset(page).limit(page_size).all()
+    collections = set(expand) if expand is not None else set(DEFAULT_COLLECTIONS)
+    collections = collections if include_events is False else collections | {AnimalCollection.TrackedEvents}
+    collections = collections if include_conditions is False else collections | {AnimalCollection.TrackedConditions}
+    collections = collections if include_weight_history is False else collections | {AnimalCollection.WeightHistory}
+
+    statement = statement.order_by(Animal.id).offset(page * page_size).limit(page_size)
+
+    async def load() -> bytes:
+        animals = await session.run_sync(get_animals, statement, collections, collection_limit, weight_days,
+                                         weight_limit)
+        return render(animals, animal_to_dict, AnimalRead)
+
+    content = await response_cache.get_or_load(ANIMALS_NAMESPACE, (
+        response.headers["ETag"], include_deactivated, tuple(sorted(collection.value for collection in collections)),
+        collection_limit, weight_days, weight_limit, page, page_size
+    ), load)
+
+    return create_rendered_response(content, dict(response.headers))
+
+
+def get_weight_statement(
+        animal_ids: Optional[List[int]] = None,
+        days: Optional[int] = None,
+        from_date: Optional[datetime] = None,
+        to_date: Optional[datetime] = None,
+        time_zone: Optional[str] = None) -> Select:
+    statement: Select = select(AnimalWeight)
+
+    if animal_ids is not None and len(animal_ids) > 0:
+        statement = statement.where(AnimalWeight.animal_id.in_(animal_ids))
+
+    return filter_by_time_window(statement, AnimalWeight.created, days, from_date, to_date, time_zone)
 
 
 @router.get("/weight", response_model=List[AnimalWeightRead])
-def get_animal_weight_history(
+async def get_animal_weight_history(
+        request: Request,
+        response: Response,
         animal_ids: Optional[List[int]] = fastapi.Query(None),
         days: Optional[int] = None,
-        session: Session = Depends(get_database_session)
+        from_date: Optional[datetime] = fastapi.Query(None, alias="from"),
+        to_date: Optional[datetime] = fastapi.Query(None, alias="to"),
+        time_zone: Optional[str] = None,
+        session: AsyncSession = Depends(get_async_database_session)
 ):
-    statement: Query = session.query(AnimalWeight)
+    not_modified = await get_not_modified_response(session, request, response, AnimalWeight.updated)
+    if not_modified is not None:
+        return not_modified
 
-    if animal_ids is not None and len(animal_ids) > 0:
-        statement = statement.where(AnimalWeight.animal_id.in_(animal_ids))
+    statement = get_weight_statement(animal_ids, days, from_date, to_date, time_zone).order_by(AnimalWeight.id.desc())
 
-    if days is not None:
-        if days == 1:
-            statement = statement.where(func.date(AnimalWeight.created) == func.date(datetime.now()))
-        else:
-            statement = statement.where(func.datediff(datetime.now(), AnimalWeight.created) <= days)
+    if is_fast_json_enabled():
+        statement = statement.with_only_columns(AnimalWeight.animal_id, AnimalWeight.weight_in_grams, AnimalWeight.id,
+                                                AnimalWeight.created)
+        return create_json_response([animal_weight_to_dict(row) for row in await session.execute(statement)],
+                                    dict(response.headers))
 
-    db_animal_weight_history = statement\
-        .order_by(AnimalWeight.id.desc())\
-        .all()
+    db_animal_weight_history = await session.execute(statement)
 
-    return db_animal_weight_history
+    return db_animal_weight_history.scalars().all()
+
+
+@router.get("/weight/export")
+async def export_animal_weight_history(
+        export_format: ExportFormat = fastapi.Query(ExportFormat.ndjson, alias="format"),
+        animal_ids: Optional[List[int]] = fastapi.Query(None),
+        days: Optional[int] = None,
+        from_date: Optional[datetime] = fastapi.Query(None, alias="from"),
+        to_date: Optional[datetime] = fastapi.Query(None, alias="to"),
+        time_zone: Optional[str] = None,
+        session: AsyncSession = Depends(get_async_database_session)
+):
+    """
+    Stream every weight matching the filters as NDJSON or CSV, oldest first.
+    """
+    statement = get_weight_statement(animal_ids, days, from_date, to_date, time_zone)\
+        .with_only_columns(AnimalWeight.id, AnimalWeight.created, AnimalWeight.animal_id, AnimalWeight.weight_in_grams)\
+        .order_by(AnimalWeight.id)
+    return create_export_response(session, statement, export_format, "weights")
+
+
+@router.get("/weight/trend", response_model=List[WeightTrendRead])
+async def get_animal_weight_trend(
+        request: Request,
+        response: Response,
+        animal_ids: Optional[List[int]] = fastapi.Query(None),
+        days: Optional[int] = None,
+        from_date: Optional[datetime] = fastapi.Query(None, alias="from"),
+        to_date: Optional[datetime] = fastapi.Query(None, alias="to"),
+        time_zone: Optional[str] = None,
+        max_points: int = DEFAULT_MAX_POINTS,
+        method: DownsamplingMethod = DownsamplingMethod.lttb,
+        window_days: float = DEFAULT_WINDOW_DAYS,
+        session: AsyncSession = Depends(get_async_database_session)
+):
+    """
+    Get the weight trend of every animal within the window: at most max_points points downsampled with LTTB or by
+    averaging fixed time buckets, the moving average over the last window_days at each point, the least squares slope
+    in grams per day and the percent change from the first to the last weight.
+    """
+    validate_trend(max_points, window_days)
+
+    not_modified = await get_not_modified_response(session, request, response, AnimalWeight.updated)
+    if not_modified is not None:
+        return not_modified
+
+    statement = get_weight_statement(animal_ids, days, from_date, to_date, time_zone)\
+        .with_only_columns(AnimalWeight.animal_id, AnimalWeight.created, AnimalWeight.weight_in_grams)\
+        .order_by(AnimalWeight.animal_id, AnimalWeight.created, AnimalWeight.id)
+
+    return get_trends((await session.execute(statement)).all(), max_points, method, window_days)
+
+
+@router.get("/status", response_model=List[AnimalStatusRead])
+async def get_animal_statuses(
+        animal_ids: Optional[List[int]] = fastapi.Query(None),
+        include_deactivated: bool = False,
+        session: AsyncSession = Depends(get_async_database_session)
+):
+    """
+    Get when each event type was last registered for every animal, and the current state of its tracked conditions,
+    without loading any event history.
+    """
+    statement: Select = select(Animal.id, Animal.name).order_by(Animal.id)
+
+    if animal_ids is not None and len(animal_ids) > 0:
+        statement = statement.where(Animal.id.in_(animal_ids))
+
+    statement = statement if include_deactivated is True else statement.where(Animal.is_deactivated.is_not(True))
+
+    return await session.run_sync(get_statuses, statement)
 
 
 @router.get("/{_id}", response_model=AnimalRead)
-def get_animal_by_id(_id, session: Session = Depends(get_database_session)):
-    animal = session.query(Animal).where(Animal.id == _id).first()
+async def get_animal_by_id(
+        _id,
+        expand: Optional[List[AnimalCollection]] = fastapi.Query(None),
+        collection_limit: Optional[int] = None,
+        session: AsyncSession = Depends(get_async_database_session)
+):
+    collections = set(expand) if expand is not None else DEFAULT_COLLECTIONS | {
+        AnimalCollection.TrackedEvents,
+        AnimalCollection.TrackedConditions
+    }
+    animals = await session.run_sync(get_animals, select(Animal).where(Animal.id == _id), collections, collection_limit)
 
-    if animal is None:
+    if len(animals) == 0:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
             detail=f"animal with id {_id} was not found"
         )
 
-    return animal
+    return animals[0]
 
 
 @router.post("/", response_model=AnimalRead, status_code=status.HTTP_201_CREATED)
 def create_animal(animal: AnimalCreate, session: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
-    user = get_current_user(session, token)
+    user = get_current_principal(session, token)
 
     db_animal = Animal()
     db_animal.name = animal.name
@@ -122,6 +274,7 @@ def create_animal(animal: AnimalCreate, session: Session = Depends(get_database_
     session.add(db_animal)
     session.commit()
     session.refresh(db_animal)
+    response_cache.invalidate_from_thread(ANIMALS_NAMESPACE)
 
     return db_animal
 
@@ -133,7 +286,7 @@ def update_animal(
         session: Session = Depends(get_database_session),
         token: str = Depends(oauth2_scheme)
 ):
-    user = get_current_user(session, token)
+    user = get_current_principal(session, token)
     db_animal = session.query(Animal).where(Animal.id == _id).first()
 
     if db_animal is None:
@@ -150,48 +303,19 @@ def update_animal(
     db_animal.updated = datetime.now()
     db_animal.updated_by_user_id = user.id
 
-    # Removed all tracked condition types
-    session.query(AnimalConditionTypeAssociation).where(AnimalConditionTypeAssociation.animal_id == _id).delete()
-
-    # Add condition types to track
-    for condition_type in animal.condition_types_to_track:
-        is_untracked = True
-        for tracked_condition_type in db_animal.tracked_condition_types:
-            if ConditionType(tracked_condition_type.condition_type) == condition_type:
-                is_untracked = False
-
-        if is_untracked is True:
-            db_animal.tracked_condition_types.append(AnimalConditionTypeAssociation(
-                condition_type=condition_type,
-                created=datetime.now(),
-                created_by_user_id=user.id,
-                updated=datetime.now(),
-                updated_by_user_id=user.id
-            ))
-
-    # Removed all tracked event types
-    session.query(AnimalEventTypeAssociation).where(AnimalEventTypeAssociation.animal_id == _id).delete()
-
-    # Add event types to track
-    for event_type in animal.event_types_to_track:
-        is_untracked = True
-        for tracked_event_type in db_animal.tracked_event_types:
-            if EventType(tracked_event_type.event_type) == event_type:
-                is_untracked = False
-
-        if is_untracked is True:
-            db_animal.tracked_event_types.append(AnimalEventTypeAssociation(
-                event_type=event_type,
-                created=datetime.now(),
-                created_by_user_id=user.id,
-                updated=datetime.now(),
-                updated_by_user_id=user.id
-            ))
+    update_tracked_types(session, _id, AnimalConditionTypeAssociation, AnimalConditionTypeAssociation.condition_type,
+                         animal.condition_types_to_track, user.id)
+    update_tracked_types(session, _id, AnimalEventTypeAssociation, AnimalEventTypeAssociation.event_type,
+                         animal.event_types_to_track, user.id)
 
     session.commit()
-    session.refresh(db_animal)
+    tile_cache.clear()
+    response_cache.invalidate_from_thread(ANIMALS_NAMESPACE)
 
-    return db_animal
+    return get_animals(session, select(Animal).where(Animal.id == _id), DEFAULT_COLLECTIONS | {
+        AnimalCollection.TrackedEvents,
+        AnimalCollection.TrackedConditions
+    })[0]
 
 
 @router.delete("/{_id}", status_code=status.HTTP_204_NO_CONTENT)
@@ -204,8 +328,12 @@ def delete_animal(_id: int, session: Session = Depends(get_database_session)):
             detail=f"animal with id {_id} was not found"
         )
 
+    delete_animal_rows(session, animal.id)
     session.delete(animal)
+    add_tombstone(session, Animal.__tablename__, animal.id)
     session.commit()
+    tile_cache.clear()
+    response_cache.invalidate_from_thread(ANIMALS_NAMESPACE, CONDITIONS_NAMESPACE)
 
 
 @router.get("/note", response_model=List[NoteRead])
@@ -216,7 +344,7 @@ def get_all_notes(session: Session = Depends(get_database_session)):
 
 @router.post("/note", response_model=NoteRead, status_code=status.HTTP_201_CREATED)
 def create_note(note: NoteCreate, session: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
-    user = get_current_user(session, token)
+    user = get_current_principal(session, token)
 
     db_note = Note(**note.dict())
     db_note.created = datetime.now()
@@ -238,7 +366,7 @@ def update_note(
         session: Session = Depends(get_database_session),
         token: str = Depends(oauth2_scheme)
 ):
-    user = get_current_user(session, token)
+    user = get_current_principal(session, token)
     db_note = session.query(Note).where(Note.id == _id).first()
 
     if db_note is None:
@@ -269,6 +397,7 @@ def delete_note(_id, session: Session = Depends(get_database_session)):
         )
 
     session.delete(note)
+    add_tombstone(session, Note.__tablename__, note.id)
     session.commit()
 
 
@@ -279,7 +408,7 @@ def toggle_condition(
         session: Session = Depends(get_database_session),
         token: str = Depends(oauth2_scheme)
 ):
-    user = get_current_user(session, token)
+    user = get_current_principal(session, token)
     db_animal = session.query(Animal).where(Animal.id == _id).first()
 
     if db_animal is None:
@@ -294,6 +423,7 @@ def toggle_condition(
             tracked_condition.is_enabled = not tracked_condition.is_enabled
             tracked_condition.updated = datetime.now()
             tracked_condition.updated_by_user_id = user.id
+            is_enabled = tracked_condition.is_enabled
             done = True
 
     if not done:
@@ -306,8 +436,15 @@ def toggle_condition(
             updated=datetime.now(),
             updated_by_user_id=user.id
         ))
+        is_enabled = True
 
     session.commit()
+    response_cache.invalidate_from_thread(ANIMALS_NAMESPACE, CONDITIONS_NAMESPACE)
+    event_bus.publish("condition.toggled", {
+        "animal_id": _id,
+        "condition_type": condition_type.value,
+        "is_enabled": is_enabled
+    }, [_id])
     return db_animal
 
 
@@ -327,7 +464,7 @@ def create_animal_weight(
         session: Session = Depends(get_database_session),
         token: str = Depends(oauth2_scheme)
 ):
-    user = get_current_user(session, token)
+    user = get_current_principal(session, token)
 
     db_animal_weight = AnimalWeight()
     db_animal_weight.animal_id = weight.animal_id
@@ -355,4 +492,5 @@ def delete_animal_weight(_id: int, session: Session = Depends(get_database_sessi
         )
 
     session.delete(db_animal_weight)
+    add_tombstone(session, AnimalWeight.__tablename__, db_animal_weight.id)
     session.commit()
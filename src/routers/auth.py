@@ -6,12 +6,16 @@ import jwt
 from fastapi import APIRouter, status, Depends, HTTPException, Form
 from fastapi.security import OAuth2PasswordRequestForm
 from pydantic import BaseModel
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from ..auth import pwd_context, ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM
-from ..database import get_database_session, User
+from ..auth import ACCESS_TOKEN_EXPIRE_MINUTES, ALGORITHM
+from ..database import get_async_database_session, get_database_session, User
 from ..models.user import UserRead
 from ..services.email import EmailService
+from ..services.passwords import password_hasher
+from ..services.users import invalidate_principal
 from ..settings_manager import settingsManager
 
 router = APIRouter(
@@ -41,9 +45,10 @@ class PasswordResetConfirmation(BaseModel):
 
 
 @router.post("/token", response_model=LoginResponse)
-def login(form_data: OAuth2PasswordRequestForm = Depends(), session: Session = Depends(get_database_session)):
+async def login(form_data: OAuth2PasswordRequestForm = Depends(),
+                session: AsyncSession = Depends(get_async_database_session)):
     email_address = form_data.username
-    user: User = session.query(User).where(User.email_address == email_address).first()
+    user: User = (await session.execute(select(User).where(User.email_address == email_address))).scalars().first()
 
     credentials_exception = HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -54,7 +59,7 @@ def login(form_data: OAuth2PasswordRequestForm = Depends(), session: Session = D
         log.warning(f"Someone attempted to log in with username {email_address} but no user with this username exists.")
         raise credentials_exception
 
-    if not pwd_context.verify(form_data.password, user.password_hash):
+    if not await password_hasher.verify(form_data.password, user.password_hash):
         log.warning(f"Someone attempted to log in with username {email_address} but supplied invalid credentials")
         raise credentials_exception
 
@@ -99,10 +104,10 @@ def reset_password(email_address: str = Form(...), session: Session = Depends(ge
 
 
 @router.post("/confirm-password-reset", response_model=PasswordResetResponse)
-def confirm_password_reset(token: str = Form(...),
-                           new_password: str = Form(...),
-                           new_password_repeated: str = Form(...),
-                           session: Session = Depends(get_database_session)):
+async def confirm_password_reset(token: str = Form(...),
+                                 new_password: str = Form(...),
+                                 new_password_repeated: str = Form(...),
+                                 session: AsyncSession = Depends(get_async_database_session)):
     if new_password != new_password_repeated:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -114,7 +119,7 @@ def confirm_password_reset(token: str = Form(...),
         detail=f"Invalid credentials"
     )
 
-    user: User = session.query(User).where(User.password_reset_token == token).first()
+    user: User = (await session.execute(select(User).where(User.password_reset_token == token))).scalars().first()
 
     if user is None:
         raise credentials_exception
@@ -125,12 +130,13 @@ def confirm_password_reset(token: str = Form(...),
     if user.email_address != email_address:
         raise credentials_exception
 
-    user.password_hash = pwd_context.hash(new_password)
+    user.password_hash = await password_hasher.hash(new_password)
     user.password_reset_token = None
     user.updated = datetime.now()
 
     session.add(user)
-    session.commit()
+    await session.commit()
+    invalidate_principal(user.id)
 
     expiration = payload['exp']
     return PasswordResetResponse(success=True)
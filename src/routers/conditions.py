@@ -1,11 +1,17 @@
+from datetime import datetime
 from typing import List, Optional
 
-from fastapi import APIRouter, Depends, Query
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, Query, Request, Response
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from src.auth import oauth2_scheme
-from src.database import get_database_session, Condition
+from src.database import get_async_database_session, Condition
 from src.models.condition import ConditionRead
+from src.services.conditional_requests import get_not_modified_response
+from src.services.response_cache import CONDITIONS_NAMESPACE, response_cache
+from src.services.serialization import condition_to_dict, create_rendered_response, render
+from src.services.time_window import filter_by_time_window
 
 router = APIRouter(
     prefix="/conditions",
@@ -15,18 +21,40 @@ router = APIRouter(
 
 
 @router.get("/", response_model=List[ConditionRead])
-def get_all(
+async def get_all(
+        request: Request,
+        response: Response,
         animal_ids: Optional[List[int]] = Query(None),
+        days: Optional[int] = None,
+        from_date: Optional[datetime] = Query(None, alias="from"),
+        to_date: Optional[datetime] = Query(None, alias="to"),
+        time_zone: Optional[str] = None,
         page: int = 0,
         page_size: int = 100,
         sort_order: str = "desc",
-        session: Session = Depends(get_database_session)
+        session: AsyncSession = Depends(get_async_database_session)
 ):
-    statement = session.query(Condition)
+    not_modified = await get_not_modified_response(session, request, response, Condition.updated)
+    if not_modified is not None:
+        return not_modified
+
+    statement = select(Condition)
 
     if animal_ids is not None and len(animal_ids) > 0:
         statement = statement.where(Condition.animal_id.in_(animal_ids))
 
-    return statement.order_by(Condition.id.asc() if sort_order == "asc" else Condition.id.desc())\
+    statement = filter_by_time_window(statement, Condition.created, days, from_date, to_date, time_zone)
+
+    statement = statement.order_by(Condition.id.asc() if sort_order == "asc" else Condition.id.desc())\
         .limit(page_size)\
-        .offset(page * page_size).all()
+        .offset(page * page_size)
+
+    async def load() -> bytes:
+        return render((await session.execute(statement)).scalars().all(), condition_to_dict, ConditionRead)
+
+    content = await response_cache.get_or_load(CONDITIONS_NAMESPACE, (
+        response.headers["ETag"], tuple(sorted(set(animal_ids or []))), days, from_date, to_date, time_zone, page,
+        page_size, sort_order == "asc"
+    ), load)
+
+    return create_rendered_response(content, dict(response.headers))
@@ -1,17 +1,40 @@
+from collections import Counter
 from datetime import datetime
 from typing import List, Optional
 
 import fastapi
-from fastapi import APIRouter, status, HTTPException, Depends
-from sqlalchemy import func, or_
-from sqlalchemy.orm import Session, Query
+from fastapi import APIRouter, status, HTTPException, Depends, Request, Response
+from fastapi.responses import StreamingResponse
+from sqlalchemy import func, or_, select
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
 
 from ..auth import oauth2_scheme
-from ..database import get_database_session, Event, Animal
-from ..models.event import EventRead, EventCreate
+from ..database import get_async_database_session, get_database_session, Event, Animal, AnimalEventTypeAssociation, \
+    User
+from ..models.event_stats import EventStatsRead
+from ..models.export_format import ExportFormat
+from ..models.tile import TileRead
+from ..models.event import EventBatchItem, EventBatchItemResult, EventRead, EventCreate
+from ..models.event_batch_item_status import EventBatchItemStatus
 from ..models.event_type import EventType
-from ..services.notifications import send_notification_to_users
-from ..services.users import get_current_user
+from ..services.animal_status import remove_last_event, update_last_events
+from ..services.event_rollup import get_stats_statement, update_rollup
+from ..services.conditional_requests import get_not_modified_response
+from ..services.event_bus import event_bus
+from ..services.events import create_events, decode_cursor, encode_cursor, get_event_read_options
+from ..services.export import create_export_response
+from ..services.geo import filter_by_bounding_box, filter_by_distance, get_distance, parse_bounding_box, \
+    parse_coordinates, validate_radius
+from ..services.notification_dispatcher import notification_dispatcher
+from ..services.serialization import create_json_response, event_to_dict, get_event_row_statement, \
+    is_fast_json_enabled
+from ..services.sync import add_tombstone
+from ..services.tiles import bin_positions, get_tile_bounding_box, tile_cache, validate_tile
+from ..services.time_window import filter_by_time_window, get_time_window
+from ..services.users import get_current_principal
 
 router = APIRouter(
     prefix="/events",
@@ -19,14 +42,25 @@ router = APIRouter(
     dependencies=[Depends(oauth2_scheme)]
 )
 
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+MAX_BATCH_SIZE = 1000
+DEFAULT_RADIUS_M = 500
+DEFAULT_GRID_SIZE = 16
+MAX_GRID_SIZE = 256
+
 
 def get_statement(
-        session: Session,
         animal_ids: Optional[List[int]] = None,
         event_type: Optional[EventType] = None,
         days: Optional[int] = None,
-        has_trip: Optional[bool] = None) -> Query:
-    statement: Query = session.query(Event).filter(Event.animal.has(Animal.is_deactivated.is_not(True)))
+        has_trip: Optional[bool] = None,
+        from_date: Optional[datetime] = None,
+        to_date: Optional[datetime] = None,
+        time_zone: Optional[str] = None,
+        bbox: Optional[str] = None,
+        near: Optional[str] = None,
+        radius_m: float = DEFAULT_RADIUS_M) -> Select:
+    statement: Select = select(Event).where(Event.animal.has(Animal.is_deactivated.is_not(True)))
 
     if animal_ids is not None and len(animal_ids) > 0:
         statement = statement.where(Event.animal_id.in_(animal_ids))
@@ -34,33 +68,154 @@ def get_statement(
     if EventType.has_value(event_type):
         statement = statement.where(Event.event_type == event_type)
 
-    if days is not None:
-        if days == 1:
-            statement = statement.where(func.date(Event.created) == func.date(datetime.now()))
-        else:
-            statement = statement.where(func.datediff(datetime.now(), Event.created) <= days)
+    statement = filter_by_time_window(statement, Event.created, days, from_date, to_date, time_zone)
 
     if has_trip is True:
-        statement = statement.filter(or_(Event.trip_id.is_not(None), Event.trip_id > 0))
+        statement = statement.where(or_(Event.trip_id.is_not(None), Event.trip_id > 0))
     elif has_trip is False:
-        statement = statement.filter(or_(Event.trip_id.is_(None), Event.trip_id == 0))
+        statement = statement.where(or_(Event.trip_id.is_(None), Event.trip_id == 0))
+
+    if bbox is not None:
+        statement = filter_by_bounding_box(statement, Event.latitude, Event.longitude, Event.geohash,
+                                           parse_bounding_box(bbox))
+
+    if near is not None:
+        latitude, longitude = parse_coordinates(near, 2, "position")
+        validate_radius(radius_m)
+        statement = filter_by_distance(statement, Event.latitude, Event.longitude, Event.geohash, latitude, longitude,
+                                       radius_m)
 
     return statement
 
 
 @router.get("/count", response_model=int)
-def get_count(
+async def get_count(
+        animal_ids: Optional[List[int]] = fastapi.Query(None),
+        event_type: Optional[EventType] = None,
+        days: Optional[int] = None,
+        has_trip: Optional[bool] = None,
+        from_date: Optional[datetime] = fastapi.Query(None, alias="from"),
+        to_date: Optional[datetime] = fastapi.Query(None, alias="to"),
+        time_zone: Optional[str] = None,
+        bbox: Optional[str] = None,
+        near: Optional[str] = None,
+        radius_m: float = DEFAULT_RADIUS_M,
+        session: AsyncSession = Depends(get_async_database_session)):
+    statement = get_statement(animal_ids, event_type, days, has_trip, from_date, to_date, time_zone, bbox, near,
+                              radius_m)\
+        .with_only_columns(func.count(Event.id))
+    return (await session.execute(statement)).scalar()
+
+
+@router.get("/stats", response_model=List[EventStatsRead])
+async def get_stats(
+        animal_ids: Optional[List[int]] = fastapi.Query(None),
+        event_type: Optional[EventType] = None,
+        days: Optional[int] = None,
+        from_date: Optional[datetime] = fastapi.Query(None, alias="from"),
+        to_date: Optional[datetime] = fastapi.Query(None, alias="to"),
+        time_zone: Optional[str] = None,
+        session: AsyncSession = Depends(get_async_database_session)):
+    """
+    Get the number of events and their average rating per day, animal and event type.
+    Days are calendar days in server time, so the window is widened to whole days.
+    """
+    start, end = get_time_window(days, from_date, to_date, time_zone)
+    statement = get_stats_statement(animal_ids, event_type.value if event_type is not None else None, start, end)
+    return (await session.execute(statement)).scalars().all()
+
+
+@router.get("/export")
+async def export(
+        export_format: ExportFormat = fastapi.Query(ExportFormat.ndjson, alias="format"),
         animal_ids: Optional[List[int]] = fastapi.Query(None),
         event_type: Optional[EventType] = None,
         days: Optional[int] = None,
         has_trip: Optional[bool] = None,
-        session: Session = Depends(get_database_session)):
-    return get_statement(session, animal_ids, event_type, days, has_trip).count()
+        from_date: Optional[datetime] = fastapi.Query(None, alias="from"),
+        to_date: Optional[datetime] = fastapi.Query(None, alias="to"),
+        time_zone: Optional[str] = None,
+        bbox: Optional[str] = None,
+        near: Optional[str] = None,
+        radius_m: float = DEFAULT_RADIUS_M,
+        session: AsyncSession = Depends(get_async_database_session)):
+    """
+    Stream every event matching the filters as NDJSON or CSV, oldest first.
+    """
+    statement = get_statement(animal_ids, event_type, days, has_trip, from_date, to_date, time_zone, bbox, near,
+                              radius_m)\
+        .with_only_columns(Event.id, Event.created, Event.animal_id, Animal.name.label("animal_name"),
+                           Event.event_type, Event.rating, Event.latitude, Event.longitude, Event.trip_id,
+                           Event.created_by_user_id)\
+        .join_from(Event, Animal, Event.animal_id == Animal.id)\
+        .order_by(Event.id)
+    return create_export_response(session, statement, export_format, "events")
+
+
+@router.get("/tiles/{z}/{x}/{y}", response_model=TileRead)
+async def get_tile(
+        z: int,
+        x: int,
+        y: int,
+        animal_ids: Optional[List[int]] = fastapi.Query(None),
+        event_type: Optional[EventType] = None,
+        days: Optional[int] = None,
+        from_date: Optional[datetime] = fastapi.Query(None, alias="from"),
+        to_date: Optional[datetime] = fastapi.Query(None, alias="to"),
+        time_zone: Optional[str] = None,
+        grid_size: int = DEFAULT_GRID_SIZE,
+        session: AsyncSession = Depends(get_async_database_session)):
+    """
+    Get the number of events within each cell of a grid_size by grid_size grid over a Web Mercator map tile, to render
+    clusters or a heatmap instead of every event.
+    """
+    validate_tile(z, x, y)
+
+    if not 1 <= grid_size <= MAX_GRID_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"grid_size must be between 1 and {MAX_GRID_SIZE}"
+        )
+
+    filters = (tuple(sorted(set(animal_ids or []))), event_type, days, from_date, to_date, time_zone, grid_size)
+    tile = tile_cache.get((z, x, y), filters)
+    if tile is not None:
+        return tile
+
+    generation = tile_cache.get_generation()
+    statement = get_statement(animal_ids, event_type, days, None, from_date, to_date, time_zone)\
+        .with_only_columns(Event.latitude, Event.longitude)
+    statement = filter_by_bounding_box(statement, Event.latitude, Event.longitude, Event.geohash,
+                                       get_tile_bounding_box(z, x, y))
+    tile = bin_positions(z, x, y, grid_size, (await session.execute(statement)).all())
+    tile_cache.set((z, x, y), filters, tile, generation)
+
+    return tile
+
+
+@router.get("/stream")
+async def stream(
+        animal_ids: Optional[List[int]] = fastapi.Query(None),
+        event_type: Optional[EventType] = None,
+        last_event_id: Optional[str] = fastapi.Header(None)):
+    """
+    Stream changes to events, trips and conditions as Server-Sent Events instead of polling for them.
+    Pass the id of the last message received in the Last-Event-ID header to get the messages missed while
+    disconnected. A reset message is sent first when they are no longer available, and the client should reload.
+    """
+    if last_event_id is not None:
+        event_bus.parse_message_id(last_event_id)
+
+    messages = event_bus.subscribe_and_stream(animal_ids, [event_type.value] if event_type is not None else None,
+                                              last_event_id)
+    return StreamingResponse(messages, media_type="text/event-stream",
+                             headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
 
 
 @router.get("/{_id}", response_model=EventRead)
-def get_event(_id: int, session: Session = Depends(get_database_session)):
-    event = session.query(Event).where(Event.id == _id).first()
+async def get_event(_id: int, session: AsyncSession = Depends(get_async_database_session)):
+    statement = select(Event).options(*get_event_read_options()).where(Event.id == _id)
+    event = (await session.execute(statement)).scalars().first()
 
     if event is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"event with id {_id} was not found")
@@ -69,28 +224,97 @@ def get_event(_id: int, session: Session = Depends(get_database_session)):
 
 
 @router.get("/", response_model=List[EventRead])
-def get_all(
+async def get_all(
+        request: Request,
+        response: Response,
         animal_ids: Optional[List[int]] = fastapi.Query(None),
         event_type: Optional[EventType] = None,
         days: Optional[int] = None,
         has_trip: Optional[bool] = None,
+        from_date: Optional[datetime] = fastapi.Query(None, alias="from"),
+        to_date: Optional[datetime] = fastapi.Query(None, alias="to"),
+        time_zone: Optional[str] = None,
+        bbox: Optional[str] = None,
+        near: Optional[str] = None,
+        radius_m: float = DEFAULT_RADIUS_M,
         page: int = 0,
         page_size: int = 100,
         sort_order: str = "desc",
-        session: Session = Depends(get_database_session)):
-    statement: Query = get_statement(session, animal_ids, event_type, days, has_trip)
+        cursor: Optional[str] = None,
+        session: AsyncSession = Depends(get_async_database_session)):
+    """
+    Get a page of events.
+    Pass the cursor returned in the X-Next-Cursor header of the previous page to seek past it instead of using
+    page/offset pagination, which keeps the cost of a page constant regardless of how deep it is. A cursor is returned
+    whenever a full page was returned, and only continues a listing with the same sort_order.
+    Pass bbox as south,west,north,east to get the events within it, or near as latitude,longitude to get the events
+    within radius_m meters of it, nearest first. Events near a position are paged by offset only.
+    """
+    if near is not None and cursor is not None:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="cursor cannot be combined with near"
+        )
+
+    not_modified = await get_not_modified_response(session, request, response, Event.updated, Animal.updated,
+                                                    AnimalEventTypeAssociation.updated, User.updated)
+    if not_modified is not None:
+        return not_modified
+
+    statement: Select = get_statement(animal_ids, event_type, days, has_trip, from_date, to_date, time_zone, bbox,
+                                      near, radius_m)
+
+    if near is not None:
+        latitude, longitude = parse_coordinates(near, 2, "position")
+        statement = statement.order_by(get_distance(Event.latitude, Event.longitude, latitude, longitude))
+
+    if cursor is not None:
+        event_id = decode_cursor(cursor, sort_order)
+        statement = statement.where(Event.id > event_id if sort_order == "asc" else Event.id < event_id)
 
     if sort_order == "asc":
         statement = statement.order_by(Event.id.asc())
     else:
         statement = statement.order_by(Event.id.desc())
 
-    return statement.limit(page_size).offset(page * page_size).all()
+    statement = statement.limit(page_size)
+
+    if cursor is None:
+        statement = statement.offset(page * page_size)
+
+    if is_fast_json_enabled():
+        events = (await session.execute(get_event_row_statement(statement))).all()
+    else:
+        events = (await session.execute(statement.options(*get_event_read_options()))).scalars().all()
+
+    if near is None and len(events) == page_size and page_size > 0:
+        response.headers[NEXT_CURSOR_HEADER] = encode_cursor(sort_order, events[-1].id)
+
+    if is_fast_json_enabled():
+        return create_json_response([event_to_dict(event) for event in events], dict(response.headers))
+
+    return events
+
+
+def publish_event_created(event):
+    """
+    Publish an event, or a row with the same columns, to the event streams.
+    """
+    event_bus.publish("event.created", {
+        "id": event.id,
+        "animal_id": event.animal_id,
+        "event_type": event.event_type,
+        "latitude": event.latitude,
+        "longitude": event.longitude,
+        "rating": event.rating,
+        "created": event.created,
+        "created_by_user_id": event.created_by_user_id
+    }, [event.animal_id], [event.event_type])
 
 
 @router.post("/", response_model=EventRead, status_code=status.HTTP_201_CREATED)
 def create(event: EventCreate, session: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
-    current_user = get_current_user(session, token)
+    current_user = get_current_principal(session, token)
 
     db_event = Event(**event.dict())
     if db_event.created is None:
@@ -100,18 +324,80 @@ def create(event: EventCreate, session: Session = Depends(get_database_session),
     db_event.updated_by_user_id = current_user.id
 
     session.add(db_event)
+    session.flush()
+    update_rollup(session, [(db_event.animal_id, event.event_type.value, db_event.created, db_event.rating)])
+    update_last_events(session, [(db_event.animal_id, event.event_type.value, db_event.id, db_event.created,
+                                  db_event.created_by_user_id, db_event.rating)])
     session.commit()
     session.refresh(db_event)
+    tile_cache.invalidate([(db_event.latitude, db_event.longitude)])
+    publish_event_created(db_event)
 
-    send_notification_to_users(f"{current_user.first_name} registered a new event",
-                               f"{db_event.event_type} was registered for {db_event.animal_name}.",
-                               [current_user.id],
-                               session,
-                               token)
+    notification_dispatcher.dispatch(f"{current_user.first_name} registered a new event",
+                                     f"{db_event.event_type} was registered for {db_event.animal_name}.",
+                                     [current_user.id],
+                                     current_user.id)
 
     return db_event
 
 
+@router.post("/batch", response_model=List[EventBatchItemResult])
+def create_batch(
+        events: List[EventBatchItem],
+        session: Session = Depends(get_database_session),
+        token: str = Depends(oauth2_scheme)
+):
+    """
+    Create the events queued by a client while offline in one transaction.
+    Items whose idempotency key was already used by the user are reported as duplicates instead of being created again,
+    so a batch can safely be replayed. A single notification summarizes the created events.
+    """
+    current_user = get_current_principal(session, token)
+
+    if len(events) > MAX_BATCH_SIZE:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"A batch can hold at most {MAX_BATCH_SIZE} events"
+        )
+
+    results = create_events(session, events, current_user.id)
+
+    try:
+        session.commit()
+    except IntegrityError:
+        raise HTTPException(
+            status_code=status.HTTP_409_CONFLICT,
+            detail="Some of the events are being created by another request. Retry the batch."
+        )
+
+    created_events = [event for event, result in zip(events, results) if result.status == EventBatchItemStatus.Created]
+    tile_cache.invalidate([(event.latitude, event.longitude) for event in created_events])
+
+    if len(created_events) > 0:
+        statement = select(Event.id, Event.animal_id, Event.event_type, Event.latitude, Event.longitude,
+                           Event.rating, Event.created, Event.created_by_user_id)\
+            .where(Event.id.in_([result.event_id for result in results
+                                 if result.status == EventBatchItemStatus.Created]))\
+            .order_by(Event.id)
+        for row in session.execute(statement):
+            publish_event_created(row)
+
+        event_type_counts = Counter(event.event_type.value for event in created_events)
+        animal_names = [name for (name,) in session.query(Animal.name)
+                        .where(Animal.id.in_({event.animal_id for event in created_events}))
+                        .order_by(Animal.name)]
+        notification_dispatcher.dispatch(
+            f"{current_user.first_name} registered {len(created_events)} new "
+            f"{'event' if len(created_events) == 1 else 'events'}",
+            f"{', '.join(f'{count} {event_type}' for event_type, count in event_type_counts.items())} "
+            f"{'was' if len(created_events) == 1 else 'were'} registered for {', '.join(animal_names)}.",
+            [current_user.id],
+            current_user.id
+        )
+
+    return results
+
+
 @router.delete("/{_id}", status_code=status.HTTP_204_NO_CONTENT)
 def delete(_id, session: Session = Depends(get_database_session)):
     event = session.query(Event).where(Event.id == _id).first()
@@ -120,4 +406,10 @@ def delete(_id, session: Session = Depends(get_database_session)):
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"event with id {id} was not found")
 
     session.delete(event)
+    update_rollup(session, [(event.animal_id, event.event_type, event.created, event.rating)], -1)
+    remove_last_event(session, event.animal_id, event.event_type, event.id)
+    add_tombstone(session, Event.__tablename__, event.id)
     session.commit()
+    tile_cache.invalidate([(event.latitude, event.longitude)])
+    event_bus.publish("event.deleted", {"id": event.id, "animal_id": event.animal_id, "event_type": event.event_type},
+                      [event.animal_id], [event.event_type])
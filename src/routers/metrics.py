@@ -0,0 +1,15 @@
+from fastapi import APIRouter, Depends
+
+from ..auth import oauth2_scheme
+from ..metrics import get_metrics
+
+router = APIRouter(
+    prefix="/metrics",
+    tags=["metrics"],
+    dependencies=[Depends(oauth2_scheme)]
+)
+
+
+@router.get("/", response_model=dict)
+def get_all():
+    return get_metrics()
@@ -8,7 +8,7 @@ from src.database import get_database_session, NotificationSubscription
 from src.models.notification_subscription import NotificationSubscriptionRead, NotificationSubscriptionCreate
 from src.models.user import UserRead
 from src.services.notifications import send_notification_to_subscription
-from src.services.users import get_current_user
+from src.services.users import get_current_principal
 
 router = APIRouter(
     prefix="/notifications",
@@ -20,7 +20,7 @@ router = APIRouter(
 @router.post("/subscribe", response_model=NotificationSubscriptionRead, status_code=status.HTTP_201_CREATED)
 def subscribe(subscription: NotificationSubscriptionCreate, session: Session = Depends(get_database_session),
               token: str = Depends(oauth2_scheme)):
-    current_user: UserRead = get_current_user(session, token)
+    current_user: UserRead = get_current_principal(session, token)
 
     db_subscription = NotificationSubscription(
         endpoint=subscription.endpoint,
@@ -42,7 +42,7 @@ def subscribe(subscription: NotificationSubscriptionCreate, session: Session = D
 @router.put("/subscribe", response_model=NotificationSubscriptionRead)
 def subscribe(subscription: NotificationSubscriptionCreate, session: Session = Depends(get_database_session),
               token: str = Depends(oauth2_scheme)):
-    current_user = get_current_user(session, token)
+    current_user = get_current_principal(session, token)
 
     db_subscription: NotificationSubscription = session.query(NotificationSubscription)\
         .where(NotificationSubscription.endpoint == subscription.endpoint)
@@ -68,7 +68,7 @@ def subscribe(subscription: NotificationSubscriptionCreate, session: Session = D
 
 @router.get("/test")
 def test(session: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
-    current_user = get_current_user(session, token)
+    current_user = get_current_principal(session, token)
     subscription = session.query(NotificationSubscription)\
         .where(NotificationSubscription.created_by_user_id == current_user.id).first()
     send_notification_to_subscription(subscription, "Hello!", "World!")
@@ -0,0 +1,25 @@
+from typing import Optional
+
+from fastapi import APIRouter, Depends
+from sqlalchemy.ext.asyncio import AsyncSession
+
+from src.auth import oauth2_scheme
+from src.database import get_async_database_session
+from src.models.changes import ChangesRead
+from src.services.sync import get_changes
+
+router = APIRouter(
+    prefix="/sync",
+    tags=["sync"],
+    dependencies=[Depends(oauth2_scheme)]
+)
+
+
+@router.get("/", response_model=ChangesRead)
+async def get_all(since: Optional[str] = None, session: AsyncSession = Depends(get_async_database_session)):
+    """
+    Get the events, conditions, weights and notes created or updated, and the rows deleted, since the token returned
+    by the previous sync. Omit since to get everything. Pass the returned token on the next sync.
+    Rows may be returned by two consecutive syncs, so clients should apply them by id.
+    """
+    return await get_changes(session, since)
@@ -1,13 +1,18 @@
 from datetime import datetime
 from typing import List
 
-from fastapi import Depends, APIRouter
-from sqlalchemy.orm import Session
+from fastapi import Depends, APIRouter, HTTPException, Request, Response, status
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
 
 from src.auth import oauth2_scheme
-from src.database import get_database_session, Trip, Event
-from src.models.trip import TripRead, TripCreate
-from src.services.users import get_current_user
+from src.database import get_async_database_session, get_database_session, Trip, Event
+from src.models.trip import TripDetailRead, TripRead, TripCreate
+from src.services.conditional_requests import get_not_modified_response
+from src.services.event_bus import event_bus
+from src.services.events import get_event_read_options
+from src.services.users import get_current_principal
 
 router = APIRouter(
     prefix="/trips",
@@ -17,14 +22,40 @@ router = APIRouter(
 
 
 @router.get("/", response_model=List[TripRead])
-def get_all(session: Session = Depends(get_database_session)):
-    trips = session.query(Trip).all()
-    return trips
+async def get_all(request: Request, response: Response, session: AsyncSession = Depends(get_async_database_session)):
+    not_modified = await get_not_modified_response(session, request, response, Trip.created_date)
+    if not_modified is not None:
+        return not_modified
+
+    return (await session.execute(select(Trip))).scalars().all()
+
+
+@router.get("/{_id}", response_model=TripDetailRead)
+def get_trip(_id: int, session: Session = Depends(get_database_session)):
+    trip = session.query(Trip)\
+        .options(joinedload(Trip.events).options(*get_event_read_options()))\
+        .where(Trip.id == _id)\
+        .first()
+
+    if trip is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=f"trip with id {_id} was not found")
+
+    return trip
 
 
 @router.post("/", response_model=TripRead)
 def create(trip: TripCreate, session: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
-    current_user = get_current_user(session, token)
+    current_user = get_current_principal(session, token)
+
+    event_ids = set(trip.event_ids)
+    found_events = session.query(Event.id, Event.animal_id, Event.event_type).where(Event.id.in_(event_ids)).all()
+    found_event_ids = {event.id for event in found_events}
+
+    if found_event_ids != event_ids:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail=f"events with ids {sorted(event_ids - found_event_ids)} were not found"
+        )
 
     db_trip = Trip(
         created_by_user_id=current_user.id,
@@ -32,16 +63,17 @@ def create(trip: TripCreate, session: Session = Depends(get_database_session), t
     )
 
     session.add(db_trip)
-    session.commit()
-    session.refresh(db_trip)
+    session.flush()
 
-    for event_id in trip.event_ids:
-        db_event = session.query(Event).where(Event.id == event_id).first()
-        db_event.trip_id = db_trip.id
-        db_event.updated = datetime.now()
-        db_event.updated_by_user_id = current_user.id
-        session.add(db_event)
+    session.query(Event).where(Event.id.in_(event_ids)).update({
+        Event.trip_id: db_trip.id,
+        Event.updated: datetime.now(),
+        Event.updated_by_user_id: current_user.id
+    }, synchronize_session=False)
 
     session.commit()
+    session.refresh(db_trip)
+    event_bus.publish("trip.created", {"id": db_trip.id, "event_ids": sorted(event_ids)},
+                      {event.animal_id for event in found_events}, {event.event_type for event in found_events})
 
     return db_trip
@@ -2,13 +2,16 @@ from datetime import datetime
 from typing import List
 
 from fastapi import APIRouter, Depends, status, HTTPException
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from ..auth import pwd_context, oauth2_scheme
-from ..database import get_database_session, User
+from ..auth import oauth2_scheme
+from ..database import get_async_database_session, get_database_session, User
 from ..models.color_theme import ColorTheme
 from ..models.user import UserRead, UserCreate
-from ..services.users import get_current_user
+from ..services.passwords import password_hasher
+from ..services.sync import add_tombstone
+from ..services.users import get_current_principal, get_current_user, invalidate_principal
 
 router = APIRouter(
     prefix="/users",
@@ -18,7 +21,7 @@ router = APIRouter(
 
 @router.get("/me", response_model=UserRead)
 def get_me(session: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
-    return get_current_user(session, token)
+    return get_current_principal(session, token)
 
 
 @router.get("/", response_model=List[UserRead])
@@ -27,7 +30,7 @@ def get_all_users(page: int = 0, page_size: int = 100, session: Session = Depend
 
 
 @router.post("/", response_model=UserRead, status_code=status.HTTP_201_CREATED)
-def create(user: UserCreate, session: Session = Depends(get_database_session)):
+async def create(user: UserCreate, session: AsyncSession = Depends(get_async_database_session)):
     if user.password != user.password_repeated:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
@@ -38,28 +41,31 @@ def create(user: UserCreate, session: Session = Depends(get_database_session)):
         first_name=user.first_name,
         last_name=user.last_name,
         email_address=user.email_address,
-        password_hash=pwd_context.hash(user.password),
+        password_hash=await password_hasher.hash(user.password),
         is_disabled=False,
         created=datetime.now(),
         updated=datetime.now()
     )
 
     session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
+    await session.commit()
+    await session.refresh(db_user)
 
     return db_user
 
 
 @router.patch("/update", response_model=UserRead)
-def update(user: UserCreate, session: Session = Depends(get_database_session), token: str = Depends(oauth2_scheme)):
+async def update(
+        user: UserCreate,
+        session: AsyncSession = Depends(get_async_database_session),
+        token: str = Depends(oauth2_scheme)):
     if user.password != user.password_repeated:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=f"Passwords must match"
         )
 
-    db_user: User = get_current_user(session, token)
+    db_user: User = await session.run_sync(get_current_user, token)
     db_user.email_address = user.email_address
     db_user.first_name = user.first_name
     db_user.last_name = user.last_name
@@ -68,11 +74,12 @@ def update(user: UserCreate, session: Session = Depends(get_database_session), t
     db_user.updated = datetime.now()
 
     if user.password is not None:
-        db_user.password_hash = pwd_context.hash(user.password)
+        db_user.password_hash = await password_hasher.hash(user.password)
 
     session.add(db_user)
-    session.commit()
-    session.refresh(db_user)
+    await session.commit()
+    await session.refresh(db_user)
+    invalidate_principal(db_user.id)
 
     return db_user
 
@@ -88,7 +95,9 @@ def delete(_id, session: Session = Depends(get_database_session)):
         )
 
     session.delete(user)
+    add_tombstone(session, User.__tablename__, user.id)
     session.commit()
+    invalidate_principal(user.id)
 
 
 @router.patch("/theme/{theme}", response_model=ColorTheme)
@@ -99,6 +108,7 @@ def set_theme(theme: ColorTheme, session: Session = Depends(get_database_session
     session.add(db_user)
     session.commit()
     session.refresh(db_user)
+    invalidate_principal(db_user.id)
 
     return db_user.color_theme
 
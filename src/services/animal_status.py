@@ -0,0 +1,131 @@
+from collections import defaultdict
+from datetime import datetime
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, case, delete, func, insert, or_, select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from src.database import AnimalConditionTypeAssociation, AnimalEventTypeAssociation, AnimalLastEvent, Condition, \
+    Event
+from src.models.animal_status import AnimalStatusRead
+
+# An event as seen by the summary: animal id, event type, id, created, created by user id and rating.
+LastEvent = Tuple[int, str, int, datetime, int, Optional[int]]
+
+COLUMNS = ["animal_id", "event_type", "event_id", "created", "created_by_user_id", "rating"]
+
+
+def get_upsert_statement(session: Session, rows: List[dict]):
+    """
+    Get a statement which inserts rows, or replaces the rows with the same key which are older, in one round trip.
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        statement = sqlite.insert(AnimalLastEvent).values(rows)
+        return statement.on_conflict_do_update(
+            index_elements=["animal_id", "event_type"],
+            set_={column: statement.excluded[column] for column in COLUMNS[2:]},
+            where=is_newer(statement.excluded)
+        )
+
+    statement = mysql.insert(AnimalLastEvent).values(rows)
+    # MariaDB assigns the columns in order and compares against the values assigned so far, so created goes last.
+    return statement.on_duplicate_key_update([
+        (column, case((is_newer(statement.inserted), statement.inserted[column]),
+                      else_=AnimalLastEvent.__table__.c[column]))
+        for column in ["rating", "created_by_user_id", "event_id", "created"]
+    ])
+
+
+def is_newer(new):
+    return or_(new.created > AnimalLastEvent.created,
+               and_(new.created == AnimalLastEvent.created, new.event_id > AnimalLastEvent.event_id))
+
+
+def update_last_events(session: Session, events: Iterable[LastEvent]):
+    """
+    Record the events as the latest of their animal and event type unless a later one is already recorded. The caller
+    commits, so the summary changes in the same transaction as the events.
+    """
+    latest: Dict[Tuple[int, str], LastEvent] = {}
+    for event in events:
+        key = (event[0], event[1])
+        if key not in latest or (event[3], event[2]) > (latest[key][3], latest[key][2]):
+            latest[key] = event
+
+    if len(latest) == 0:
+        return
+
+    session.execute(get_upsert_statement(session, [dict(zip(COLUMNS, event)) for event in latest.values()]))
+
+
+def remove_last_event(session: Session, animal_id: int, event_type: str, event_id: int):
+    """
+    Replace the event with the latest remaining one of its animal and event type, if it is the one recorded. Call this
+    after deleting the event. The caller commits.
+    """
+    result = session.execute(delete(AnimalLastEvent).where(
+        AnimalLastEvent.animal_id == animal_id,
+        AnimalLastEvent.event_type == event_type,
+        AnimalLastEvent.event_id == event_id
+    ))
+
+    if result.rowcount == 0:
+        return
+
+    session.flush()
+    session.execute(insert(AnimalLastEvent).from_select(COLUMNS, select(
+        Event.animal_id, Event.event_type, Event.id, Event.created, Event.created_by_user_id, Event.rating
+    ).where(
+        Event.animal_id == animal_id,
+        Event.event_type == event_type
+    ).order_by(Event.created.desc(), Event.id.desc()).limit(1)))
+
+
+def rebuild_last_events(session: Session):
+    """
+    Replace the summary with the latest event per animal and event type, ranked with a window function. The caller
+    commits.
+    """
+    row_number = func.row_number().over(
+        partition_by=(Event.animal_id, Event.event_type),
+        order_by=(Event.created.desc(), Event.id.desc())
+    ).label("row_number")
+    ranked = select(Event.animal_id, Event.event_type, Event.id, Event.created, Event.created_by_user_id, Event.rating,
+                    row_number)\
+        .where(Event.animal_id.is_not(None))\
+        .subquery()
+
+    session.execute(delete(AnimalLastEvent))
+    session.execute(insert(AnimalLastEvent).from_select(COLUMNS, select(
+        ranked.c.animal_id, ranked.c.event_type, ranked.c.id, ranked.c.created, ranked.c.created_by_user_id,
+        ranked.c.rating
+    ).where(ranked.c.row_number == 1)))
+
+
+def get_statuses(session: Session, statement: Select) -> List[AnimalStatusRead]:
+    """
+    Get the latest event per tracked event type and the tracked conditions of the animals whose ids and names are
+    selected by statement, with one statement for each.
+    """
+    animals = session.execute(statement).all()
+    animal_ids = [animal_id for animal_id, _ in animals]
+
+    last_events = defaultdict(list)
+    for last_event in session.execute(select(AnimalLastEvent).join(AnimalEventTypeAssociation, and_(
+        AnimalEventTypeAssociation.animal_id == AnimalLastEvent.animal_id,
+        AnimalEventTypeAssociation.event_type == AnimalLastEvent.event_type
+    )).where(AnimalLastEvent.animal_id.in_(animal_ids)).order_by(AnimalLastEvent.event_type)).scalars():
+        last_events[last_event.animal_id].append(last_event)
+
+    conditions = defaultdict(list)
+    for condition in session.execute(select(Condition).join(AnimalConditionTypeAssociation, and_(
+        AnimalConditionTypeAssociation.animal_id == Condition.animal_id,
+        AnimalConditionTypeAssociation.condition_type == Condition.condition_type
+    )).where(Condition.animal_id.in_(animal_ids)).order_by(Condition.condition_type)).scalars():
+        conditions[condition.animal_id].append(condition)
+
+    return [AnimalStatusRead(animal_id=animal_id, name=name, last_events=last_events[animal_id],
+                             conditions=conditions[animal_id])
+            for animal_id, name in animals]
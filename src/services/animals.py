@@ -0,0 +1,159 @@
+from collections import defaultdict
+from datetime import datetime
+from enum import Enum
+from typing import Iterable, List, Optional, Set
+
+from sqlalchemy import and_, func, insert, select
+from sqlalchemy.orm import Query, Session, joinedload, noload, selectinload
+from sqlalchemy.orm.attributes import set_committed_value
+from sqlalchemy.sql import Select
+
+from src.database import Animal, AnimalConditionTypeAssociation, AnimalEventTypeAssociation, AnimalLastEvent, \
+    AnimalWeight, Condition, Event, EventDailyRollup, Note
+from src.models.animal_collection import AnimalCollection
+from src.services.events import get_event_read_options
+from src.services.sync import add_tombstones
+from src.services.time_window import filter_by_time_window
+
+DEFAULT_COLLECTIONS = {
+    AnimalCollection.Notes,
+    AnimalCollection.TrackedConditionTypes,
+    AnimalCollection.TrackedEventTypes
+}
+DEFAULT_COLLECTION_LIMIT = 100
+
+
+def get_animals(
+        session: Session,
+        statement: Select,
+        expand: Set[AnimalCollection],
+        collection_limit: Optional[int] = None,
+        weight_days: Optional[int] = None,
+        weight_limit: int = 100) -> List[Animal]:
+    """
+    Get the animals selected by statement with only the collections in expand loaded.
+    Every collection is loaded for all animals at once, so the number of statements does not depend on the number of
+    animals. The tracked events of each animal are capped to the latest collection_limit, or DEFAULT_COLLECTION_LIMIT
+    if it is None, and the notes are only capped when collection_limit is given. The weight history is capped to the
+    latest weight_limit within the last weight_days.
+    """
+    options = [noload(getattr(Animal, collection.value)) for collection in AnimalCollection]
+    if AnimalCollection.TrackedConditionTypes in expand:
+        options.append(selectinload(Animal.tracked_condition_types))
+    if AnimalCollection.TrackedEventTypes in expand:
+        options.append(selectinload(Animal.tracked_event_types))
+
+    animals = session.execute(statement.options(*options)).scalars().all()
+
+    if len(animals) == 0:
+        return animals
+
+    if AnimalCollection.Notes in expand:
+        load_latest_per_animal(session, animals, Animal.notes, Note, session.query(Note.id), collection_limit, (
+            joinedload(Note.created_by_user),
+            joinedload(Note.updated_by_user)
+        ))
+
+    if AnimalCollection.TrackedEvents in expand:
+        tracked_event_ids = session.query(Event.id).join(AnimalEventTypeAssociation, and_(
+            AnimalEventTypeAssociation.animal_id == Event.animal_id,
+            AnimalEventTypeAssociation.event_type == Event.event_type
+        ))
+        load_latest_per_animal(session, animals, Animal.tracked_events, Event, tracked_event_ids,
+                               collection_limit if collection_limit is not None else DEFAULT_COLLECTION_LIMIT,
+                               get_event_read_options())
+
+    if AnimalCollection.TrackedConditions in expand:
+        load_tracked_conditions(session, animals)
+
+    if AnimalCollection.WeightHistory in expand:
+        weight_ids = filter_by_time_window(session.query(AnimalWeight.id), AnimalWeight.created, weight_days)
+        load_latest_per_animal(session, animals, Animal.weight_history, AnimalWeight, weight_ids, weight_limit)
+
+    return animals
+
+
+def load_latest_per_animal(session: Session, animals: List[Animal], attribute, entity, id_statement: Query,
+                           limit: Optional[int], options=()):
+    """
+    Set attribute of every animal to the latest limit rows of entity whose ids are selected by id_statement, or to all
+    of them if limit is None.
+    """
+    id_statement = id_statement.where(entity.animal_id.in_([animal.id for animal in animals]))
+
+    if limit is not None:
+        row_number = func.row_number().over(
+            partition_by=entity.animal_id,
+            order_by=(entity.created.desc(), entity.id.desc())
+        ).label("row_number")
+        ranked = id_statement.add_columns(row_number).subquery()
+        id_statement = select(ranked.c.id).where(ranked.c.row_number <= limit)
+
+    rows = session.query(entity)\
+        .options(*options)\
+        .where(entity.id.in_(id_statement))\
+        .order_by(entity.created.desc(), entity.id.desc())\
+        .all()
+
+    rows_by_animal_id = defaultdict(list)
+    for row in rows:
+        rows_by_animal_id[row.animal_id].append(row)
+
+    for animal in animals:
+        set_committed_value(animal, attribute.key, rows_by_animal_id[animal.id])
+
+
+def load_tracked_conditions(session: Session, animals: List[Animal]):
+    conditions = session.query(Condition).join(AnimalConditionTypeAssociation, and_(
+        AnimalConditionTypeAssociation.animal_id == Condition.animal_id,
+        AnimalConditionTypeAssociation.condition_type == Condition.condition_type
+    )).where(Condition.animal_id.in_([animal.id for animal in animals])).all()
+
+    conditions_by_animal_id = defaultdict(list)
+    for condition in conditions:
+        conditions_by_animal_id[condition.animal_id].append(condition)
+
+    for animal in animals:
+        set_committed_value(animal, Animal.tracked_conditions.key, conditions_by_animal_id[animal.id])
+
+
+def update_tracked_types(session: Session, animal_id: int, entity, column, types: Iterable[Enum], user_id: int):
+    """
+    Make the association rows of entity for an animal match types, by deleting the removed types and inserting the
+    added ones in bulk. Rows of types which are still tracked keep their audit columns.
+    """
+    tracked_types = {value for (value,) in session.query(column).where(entity.animal_id == animal_id)}
+    types = {tracked_type.value for tracked_type in types}
+
+    removed_types = tracked_types - types
+    if len(removed_types) > 0:
+        session.query(entity)\
+            .where(entity.animal_id == animal_id, column.in_(removed_types))\
+            .delete(synchronize_session=False)
+
+    added_types = types - tracked_types
+    if len(added_types) > 0:
+        now = datetime.now()
+        session.execute(insert(entity), [{
+            "animal_id": animal_id,
+            column.key: added_type,
+            "created": now,
+            "created_by_user_id": user_id,
+            "updated": now,
+            "updated_by_user_id": user_id
+        } for added_type in sorted(added_types)])
+
+
+def delete_animal_rows(session: Session, animal_id: int):
+    """
+    Delete the events, conditions, weights and notes of an animal with a tombstone for each, so that clients which
+    sync remove them as well, and drop the animal from the event rollup and the latest events. The caller deletes the
+    animal and commits.
+    """
+    for entity in (Event, Condition, AnimalWeight, Note):
+        row_ids = [row_id for (row_id,) in session.query(entity.id).where(entity.animal_id == animal_id)]
+        add_tombstones(session, entity.__tablename__, row_ids)
+        session.query(entity).where(entity.animal_id == animal_id).delete(synchronize_session=False)
+
+    session.query(EventDailyRollup).where(EventDailyRollup.animal_id == animal_id).delete(synchronize_session=False)
+    session.query(AnimalLastEvent).where(AnimalLastEvent.animal_id == animal_id).delete(synchronize_session=False)
@@ -0,0 +1,205 @@
+import asyncio
+import uuid
+from collections import deque
+from dataclasses import dataclass, field
+from logging import getLogger
+from threading import Lock
+from typing import AsyncIterator, Collection, Deque, FrozenSet, List, Optional, Set
+
+import orjson
+from fastapi import HTTPException, status
+
+from src.metrics import register_metrics
+
+log = getLogger(__name__)
+
+HISTORY_SIZE = 1000
+QUEUE_SIZE = 100
+KEEPALIVE_SECONDS = 15
+RETRY_MILLISECONDS = 3000
+
+
+@dataclass(frozen=True)
+class StreamMessage:
+    sequence: int
+    name: str
+    data: dict
+    animal_ids: FrozenSet[int]
+    event_types: FrozenSet[str]
+
+
+@dataclass(eq=False)
+class Subscription:
+    loop: asyncio.AbstractEventLoop
+    animal_ids: FrozenSet[int]
+    event_types: FrozenSet[str]
+    queue: asyncio.Queue
+    replay: List[StreamMessage] = field(default_factory=list)
+    is_reset: bool = False
+    is_closed: bool = False
+
+    def matches(self, message: StreamMessage) -> bool:
+        return (len(self.animal_ids) == 0 or not self.animal_ids.isdisjoint(message.animal_ids)) \
+            and (len(self.event_types) == 0 or not self.event_types.isdisjoint(message.event_types))
+
+
+class EventBus:
+    """
+    Publish changes from request handlers to the event streams of every connected client within the process.
+    Recent messages are kept so that a client which reconnects with the id of the last message it received gets the
+    messages it missed. A client which falls further behind than queue_size messages is disconnected, and resumes
+    from the history when it reconnects.
+    """
+    def __init__(self, history_size: int = HISTORY_SIZE, queue_size: int = QUEUE_SIZE):
+        self.queue_size = queue_size
+        # Message ids are only meaningful within the process which issued them.
+        self.epoch = uuid.uuid4().hex[:8]
+        self.published = 0
+        self.overflowed = 0
+        self.__history: Deque[StreamMessage] = deque(maxlen=history_size)
+        self.__subscriptions: Set[Subscription] = set()
+        self.__lock = Lock()
+
+    def get_message_id(self, message: StreamMessage) -> str:
+        return f"{self.epoch}-{message.sequence}"
+
+    def parse_message_id(self, message_id: str) -> Optional[int]:
+        """
+        Get the sequence number of a message id, or None if it was issued by another process.
+        """
+        epoch, _, sequence = message_id.partition("-")
+
+        if not sequence.isdigit():
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=f"{message_id} is not a valid event id"
+            )
+
+        return int(sequence) if epoch == self.epoch else None
+
+    def publish(self, name: str, data: dict, animal_ids: Collection[int], event_types: Collection[str] = ()):
+        """
+        Send a message to every matching subscription. Safe to call from any thread.
+        """
+        with self.__lock:
+            self.published += 1
+            message = StreamMessage(self.published, name, data, frozenset(animal_ids), frozenset(event_types))
+            self.__history.append(message)
+            subscriptions = [subscription for subscription in self.__subscriptions if subscription.matches(message)]
+
+        for subscription in subscriptions:
+            try:
+                subscription.loop.call_soon_threadsafe(self.__deliver, subscription, message)
+            except RuntimeError:
+                # The event loop of the subscription has been closed.
+                self.unsubscribe(subscription)
+
+    def subscribe(
+            self,
+            animal_ids: Optional[Collection[int]] = None,
+            event_types: Optional[Collection[str]] = None,
+            last_event_id: Optional[str] = None) -> Subscription:
+        """
+        Subscribe the current event loop to the messages matching the filters, replaying the messages published after
+        last_event_id. The subscription is reset when those messages are no longer available.
+        """
+        last_sequence = self.parse_message_id(last_event_id) if last_event_id is not None else None
+        subscription = Subscription(asyncio.get_running_loop(), frozenset(animal_ids or ()),
+                                    frozenset(event_types or ()), asyncio.Queue(self.queue_size))
+
+        with self.__lock:
+            self.__subscriptions.add(subscription)
+
+            if last_event_id is not None:
+                oldest_sequence = self.__history[0].sequence if len(self.__history) > 0 else self.published + 1
+                subscription.is_reset = last_sequence is None or last_sequence < oldest_sequence - 1
+                subscription.replay = [message for message in self.__history
+                                       if not subscription.is_reset and message.sequence > last_sequence
+                                       and subscription.matches(message)]
+
+        return subscription
+
+    def unsubscribe(self, subscription: Subscription):
+        with self.__lock:
+            self.__subscriptions.discard(subscription)
+
+    def __deliver(self, subscription: Subscription, message: StreamMessage):
+        if subscription.is_closed:
+            return
+
+        if not subscription.queue.full():
+            subscription.queue.put_nowait(message)
+            return
+
+        log.warning(f"An event stream fell more than {self.queue_size} messages behind and will be disconnected")
+        with self.__lock:
+            self.overflowed += 1
+        self.unsubscribe(subscription)
+        subscription.is_closed = True
+
+        while not subscription.queue.empty():
+            subscription.queue.get_nowait()
+        subscription.queue.put_nowait(None)
+
+    def encode(self, message: StreamMessage) -> bytes:
+        return f"id: {self.get_message_id(message)}\nevent: {message.name}\ndata: ".encode() \
+            + orjson.dumps(message.data) + b"\n\n"
+
+    async def stream(self, subscription: Subscription) -> AsyncIterator[bytes]:
+        """
+        Encode the messages of subscription as Server-Sent Events until the client disconnects or falls behind.
+        """
+        try:
+            yield f"retry: {RETRY_MILLISECONDS}\n\n".encode()
+
+            if subscription.is_reset:
+                # Tell the client to reload, since the messages it missed are gone.
+                yield b"event: reset\ndata: {}\n\n"
+
+            for message in subscription.replay:
+                yield self.encode(message)
+
+            while True:
+                try:
+                    message = await asyncio.wait_for(subscription.queue.get(), KEEPALIVE_SECONDS)
+                except asyncio.TimeoutError:
+                    yield b": keepalive\n\n"
+                    continue
+
+                if message is None:
+                    return
+
+                yield self.encode(message)
+        finally:
+            self.unsubscribe(subscription)
+
+    async def subscribe_and_stream(
+            self,
+            animal_ids: Optional[Collection[int]] = None,
+            event_types: Optional[Collection[str]] = None,
+            last_event_id: Optional[str] = None) -> AsyncIterator[bytes]:
+        """
+        Subscribe only once the response starts to be sent, and stream the messages like stream. A client which
+        disconnects before that never starts the generator, which would leave a subscription behind if it subscribed
+        up front.
+        """
+        messages = self.stream(self.subscribe(animal_ids, event_types, last_event_id))
+        try:
+            async for chunk in messages:
+                yield chunk
+        finally:
+            await messages.aclose()
+
+    def get_metrics(self) -> dict:
+        with self.__lock:
+            return {
+                "subscriptions": len(self.__subscriptions),
+                "published": self.published,
+                "history": len(self.__history),
+                "overflowed": self.overflowed
+            }
+
+
+event_bus = EventBus()
+
+register_metrics("event_bus", event_bus.get_metrics)
@@ -0,0 +1,109 @@
+from collections import defaultdict
+from datetime import date, datetime, time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from sqlalchemy import delete, func, insert, select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import Select
+
+from src.database import Animal, Event, EventDailyRollup
+
+# An event as seen by the rollup: animal id, event type, created and rating.
+RollupEvent = Tuple[int, str, datetime, Optional[int]]
+
+
+def get_increments(new) -> dict:
+    return {
+        "count": EventDailyRollup.count + new["count"],
+        "rating_sum": EventDailyRollup.rating_sum + new["rating_sum"],
+        "rating_count": EventDailyRollup.rating_count + new["rating_count"]
+    }
+
+
+def get_upsert_statement(session: Session, rows: List[dict]):
+    """
+    Get a statement which inserts rows, or adds them to the rollup rows with the same key, in one round trip.
+    """
+    if session.get_bind().dialect.name == "sqlite":
+        statement = sqlite.insert(EventDailyRollup).values(rows)
+        return statement.on_conflict_do_update(index_elements=["animal_id", "event_type", "day"],
+                                               set_=get_increments(statement.excluded))
+
+    statement = mysql.insert(EventDailyRollup).values(rows)
+    return statement.on_duplicate_key_update(get_increments(statement.inserted))
+
+
+def update_rollup(session: Session, events: Iterable[RollupEvent], sign: int = 1):
+    """
+    Add the events to the rollup, or remove them if sign is -1. The caller commits, so the rollup changes in the same
+    transaction as the events.
+    """
+    deltas: Dict[Tuple[int, str, date], List[int]] = defaultdict(lambda: [0, 0, 0])
+    for animal_id, event_type, created, rating in events:
+        delta = deltas[(animal_id, event_type, created.date())]
+        delta[0] += sign
+        if rating is not None:
+            delta[1] += sign * rating
+            delta[2] += sign
+
+    if len(deltas) == 0:
+        return
+
+    session.execute(get_upsert_statement(session, [{
+        "animal_id": animal_id,
+        "event_type": event_type,
+        "day": day,
+        "count": count,
+        "rating_sum": rating_sum,
+        "rating_count": rating_count
+    } for (animal_id, event_type, day), (count, rating_sum, rating_count) in deltas.items()]))
+
+    if sign < 0:
+        session.execute(delete(EventDailyRollup).where(
+            EventDailyRollup.day.in_({day for (_, _, day) in deltas}),
+            EventDailyRollup.count <= 0
+        ))
+
+
+def rebuild_rollup(session: Session):
+    """
+    Replace the rollup with one aggregated from every event. The caller commits.
+    """
+    day = func.date(Event.created)
+    session.execute(delete(EventDailyRollup))
+    session.execute(insert(EventDailyRollup).from_select(
+        ["animal_id", "event_type", "day", "count", "rating_sum", "rating_count"],
+        select(Event.animal_id, Event.event_type, day, func.count(Event.id),
+               func.coalesce(func.sum(Event.rating), 0), func.count(Event.rating))
+        .where(Event.animal_id.is_not(None))
+        .group_by(Event.animal_id, Event.event_type, day)
+    ))
+
+
+def get_stats_statement(
+        animal_ids: Optional[List[int]] = None,
+        event_type: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None) -> Select:
+    """
+    Get the rollup rows of active animals for the days overlapping the half-open window [start, end).
+    """
+    statement = select(EventDailyRollup)\
+        .join(Animal, Animal.id == EventDailyRollup.animal_id)\
+        .where(Animal.is_deactivated.is_not(True))
+
+    if animal_ids is not None and len(animal_ids) > 0:
+        statement = statement.where(EventDailyRollup.animal_id.in_(animal_ids))
+
+    if event_type is not None:
+        statement = statement.where(EventDailyRollup.event_type == event_type)
+
+    if start is not None:
+        statement = statement.where(EventDailyRollup.day >= start.date())
+
+    if end is not None:
+        statement = statement.where(EventDailyRollup.day < end.date() if end.time() == time.min
+                                    else EventDailyRollup.day <= end.date())
+
+    return statement.order_by(EventDailyRollup.day, EventDailyRollup.animal_id, EventDailyRollup.event_type)
@@ -0,0 +1,125 @@
+import base64
+import binascii
+from datetime import datetime
+from typing import Dict, List
+
+from fastapi import HTTPException, status
+from sqlalchemy import insert
+from sqlalchemy.orm import Session, joinedload
+
+from src.database import Animal, Event
+from src.models.event import EventBatchItem, EventBatchItemResult
+from src.models.event_batch_item_status import EventBatchItemStatus
+from src.services.animal_status import update_last_events
+from src.services.event_rollup import update_rollup
+
+
+def get_event_read_options() -> tuple:
+    """
+    Get the loader options which load everything EventRead needs together with the events themselves.
+    """
+    return (
+        joinedload(Event.animal),
+        joinedload(Event.created_by_user),
+        joinedload(Event.animal_event_type_association),
+    )
+
+
+def encode_cursor(sort_order: str, event_id: int) -> str:
+    """
+    Get an opaque cursor which continues a listing in sort_order after the event with event_id.
+    """
+    return base64.urlsafe_b64encode(f"{sort_order}:{event_id}".encode()).decode()
+
+
+def decode_cursor(cursor: str, sort_order: str) -> int:
+    """
+    Get the id of the event a cursor continues after, which must have been issued for the same sort_order.
+    """
+    try:
+        cursor_sort_order, _, event_id = base64.urlsafe_b64decode(cursor.encode()).decode().partition(":")
+        event_id = int(event_id)
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{cursor} is not a valid cursor"
+        )
+
+    if cursor_sort_order != sort_order:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"The cursor continues a listing in {cursor_sort_order} order, not {sort_order}"
+        )
+
+    return event_id
+
+
+def create_events(session: Session, items: List[EventBatchItem], user_id: int) -> List[EventBatchItemResult]:
+    """
+    Insert the events of a batch with a single executemany, skipping items whose idempotency key the user has already
+    used, either in an earlier request or earlier in the same batch. Returns the result of every item in the order of
+    the batch, where exactly one result is Created for every inserted event. The caller commits.
+    """
+    results: List[EventBatchItemResult] = []
+    created_results: Dict[str, EventBatchItemResult] = {}
+    keys = {item.idempotency_key for item in items}
+
+    existing_event_ids = dict(session.query(Event.idempotency_key, Event.id)
+                              .where(Event.created_by_user_id == user_id, Event.idempotency_key.in_(keys)))
+
+    animal_ids = {animal_id for (animal_id,) in session.query(Animal.id)
+                  .where(Animal.id.in_({item.animal_id for item in items}))}
+
+    now = datetime.now()
+    rows = []
+    for item in items:
+        key = item.idempotency_key
+
+        if key in existing_event_ids:
+            result = EventBatchItemResult(idempotency_key=key, status=EventBatchItemStatus.Duplicate,
+                                          event_id=existing_event_ids[key])
+        elif key in created_results:
+            result = EventBatchItemResult(idempotency_key=key, status=EventBatchItemStatus.Duplicate,
+                                          detail="the idempotency key was already used earlier in the batch")
+        elif item.animal_id not in animal_ids:
+            result = EventBatchItemResult(idempotency_key=key, status=EventBatchItemStatus.Invalid,
+                                          detail=f"animal with id {item.animal_id} was not found")
+        else:
+            result = EventBatchItemResult(idempotency_key=key, status=EventBatchItemStatus.Created)
+            # Only a created item uses up its key, so an invalid item does not keep a later one from being created.
+            created_results[key] = result
+            rows.append({
+                "latitude": item.latitude,
+                "longitude": item.longitude,
+                "event_type": item.event_type.value,
+                "animal_id": item.animal_id,
+                "rating": item.rating,
+                "created": item.created if item.created is not None else now,
+                "created_by_user_id": user_id,
+                "updated": now,
+                "updated_by_user_id": user_id,
+                "idempotency_key": key
+            })
+
+        results.append(result)
+
+    if len(rows) > 0:
+        session.execute(insert(Event), rows)
+        update_rollup(session, [(row["animal_id"], row["event_type"], row["created"], row["rating"]) for row in rows])
+
+        created_events = session.query(Event.idempotency_key, Event.id)\
+            .where(Event.created_by_user_id == user_id,
+                   Event.idempotency_key.in_([row["idempotency_key"] for row in rows]))
+        for key, event_id in created_events:
+            created_results[key].event_id = event_id
+
+        update_last_events(session, [(row["animal_id"], row["event_type"],
+                                      created_results[row["idempotency_key"]].event_id, row["created"], user_id,
+                                      row["rating"]) for row in rows])
+
+    # Repeats within the batch refer to the event created for the item which used their key.
+    for result in results:
+        if result.status == EventBatchItemStatus.Duplicate and result.event_id is None:
+            result.event_id = created_results[result.idempotency_key].event_id
+
+    return results
@@ -0,0 +1,60 @@
+import csv
+import io
+import json
+from datetime import date
+from typing import AsyncIterator
+
+from fastapi.responses import StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.sql import Select
+
+from src.models.export_format import ExportFormat
+
+YIELD_PER = 1000
+
+MEDIA_TYPES = {
+    ExportFormat.ndjson: "application/x-ndjson",
+    ExportFormat.csv: "text/csv"
+}
+
+
+def encode_value(value):
+    return value.isoformat() if isinstance(value, date) else value
+
+
+async def stream_rows(session: AsyncSession, statement: Select, export_format: ExportFormat) -> AsyncIterator[str]:
+    """
+    Stream the rows of statement from a server-side cursor, encoding YIELD_PER rows at a time, so that only one batch
+    of rows is held in memory regardless of how many rows there are.
+    """
+    result = await session.stream(statement.execution_options(yield_per=YIELD_PER))
+    columns = list(result.keys())
+
+    if export_format == ExportFormat.csv:
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(columns)
+
+        async for rows in result.partitions():
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+            writer.writerows([encode_value(value) for value in row] for row in rows)
+
+        yield buffer.getvalue()
+    else:
+        async for rows in result.partitions():
+            yield "".join(json.dumps(dict(zip(columns, (encode_value(value) for value in row)))) + "\n"
+                          for row in rows)
+
+
+def create_export_response(
+        session: AsyncSession,
+        statement: Select,
+        export_format: ExportFormat,
+        name: str) -> StreamingResponse:
+    return StreamingResponse(
+        stream_rows(session, statement, export_format),
+        media_type=MEDIA_TYPES[export_format],
+        headers={"Content-Disposition": f'attachment; filename="{name}.{export_format.value}"'}
+    )
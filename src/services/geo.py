@@ -0,0 +1,199 @@
+import math
+from typing import List, Optional, Tuple, Union
+
+from fastapi import HTTPException, status
+from sqlalchemy import Column, func, or_
+from sqlalchemy.orm import Query
+from sqlalchemy.sql import Select
+
+EARTH_RADIUS_M = 6371008.8
+METERS_PER_DEGREE = math.pi * EARTH_RADIUS_M / 180
+GEOHASH_PRECISION = 12
+GEOHASH_ALPHABET = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+# A bounding box is covered by at most this many geohash cells, which bounds the number of index ranges scanned.
+MAX_COVERING_CELLS = 16
+
+# Searches near a position are limited to this radius, beyond which the bounding box degenerates towards the globe.
+MAX_RADIUS_M = 100000
+
+# South, west, north, east in degrees.
+BoundingBox = Tuple[float, float, float, float]
+
+
+def encode_geohash(latitude: float, longitude: float, precision: int = GEOHASH_PRECISION) -> str:
+    """
+    Encode a position as a geohash, in which every position sharing a prefix lies within the cell of that prefix.
+    """
+    latitude_range = [-90.0, 90.0]
+    longitude_range = [-180.0, 180.0]
+    geohash = []
+    bits = 0
+    bit_count = 0
+    is_longitude = True
+
+    while len(geohash) < precision:
+        value, value_range = (longitude, longitude_range) if is_longitude else (latitude, latitude_range)
+        middle = (value_range[0] + value_range[1]) / 2
+        if value >= middle:
+            bits = bits * 2 + 1
+            value_range[0] = middle
+        else:
+            bits = bits * 2
+            value_range[1] = middle
+
+        is_longitude = not is_longitude
+        bit_count += 1
+        if bit_count == 5:
+            geohash.append(GEOHASH_ALPHABET[bits])
+            bits = 0
+            bit_count = 0
+
+    return "".join(geohash)
+
+
+def get_cell_size(precision: int) -> Tuple[float, float]:
+    """
+    Get the height and width in degrees of the geohash cells of precision.
+    """
+    bit_count = 5 * precision
+    return 180 / 2 ** (bit_count // 2), 360 / 2 ** ((bit_count + 1) // 2)
+
+
+def get_covering_cells(bbox: BoundingBox) -> Optional[List[str]]:
+    """
+    Get the geohash cells of the finest precision which cover bbox with at most MAX_COVERING_CELLS cells, so that the
+    index ranges they select are as narrow as possible. Returns None if bbox is too large to be covered by that many
+    cells of any precision.
+    """
+    south, west, north, east = bbox
+    cells = None
+
+    for precision in range(1, GEOHASH_PRECISION + 1):
+        height, width = get_cell_size(precision)
+        rows = range(math.floor((south + 90) / height),
+                     min(math.floor((north + 90) / height), round(180 / height) - 1) + 1)
+        columns = range(math.floor((west + 180) / width),
+                        min(math.floor((east + 180) / width), round(360 / width) - 1) + 1)
+
+        if len(rows) * len(columns) > MAX_COVERING_CELLS:
+            break
+
+        cells = [encode_geohash((row + 0.5) * height - 90, (column + 0.5) * width - 180, precision)
+                 for row in rows for column in columns]
+
+    return cells
+
+
+def get_bounding_box(latitude: float, longitude: float, radius_m: float) -> BoundingBox:
+    """
+    Get a bounding box which contains every position within radius_m of the position.
+    """
+    latitude_delta = radius_m / METERS_PER_DEGREE
+    cos_latitude = math.cos(math.radians(latitude))
+    longitude_delta = 180.0 if cos_latitude < 1e-9 \
+        else min(180.0, radius_m / (METERS_PER_DEGREE * cos_latitude))
+
+    return (max(-90.0, latitude - latitude_delta), max(-180.0, longitude - longitude_delta),
+            min(90.0, latitude + latitude_delta), min(180.0, longitude + longitude_delta))
+
+
+def get_haversine_distance(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float:
+    """
+    Get the great-circle distance in meters between two positions.
+    """
+    a = math.sin(math.radians(latitude2 - latitude1) / 2) ** 2 + \
+        math.cos(math.radians(latitude1)) * math.cos(math.radians(latitude2)) * \
+        math.sin(math.radians(longitude2 - longitude1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+def get_distance(latitude_column: Column, longitude_column: Column, latitude: float, longitude: float):
+    """
+    Get an SQL expression for the great-circle distance in meters between the columns and the position.
+    """
+    a = func.power(func.sin(func.radians(latitude_column - latitude) / 2), 2) + \
+        math.cos(math.radians(latitude)) * func.cos(func.radians(latitude_column)) * \
+        func.power(func.sin(func.radians(longitude_column - longitude) / 2), 2)
+    return 2 * EARTH_RADIUS_M * func.asin(func.sqrt(a))
+
+
+def parse_coordinates(value: str, count: int, name: str) -> Tuple[float, ...]:
+    """
+    Parse count comma separated latitudes and longitudes, such as 59.91,10.75.
+    """
+    try:
+        coordinates = tuple(float(coordinate) for coordinate in value.split(","))
+    except ValueError:
+        coordinates = ()
+
+    is_valid = len(coordinates) == count and \
+        all(-90 <= coordinate <= 90 for coordinate in coordinates[0::2]) and \
+        all(-180 <= coordinate <= 180 for coordinate in coordinates[1::2])
+
+    if not is_valid:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{value} is not a valid {name}"
+        )
+
+    return coordinates
+
+
+def validate_radius(radius_m: float):
+    if not 0 < radius_m <= MAX_RADIUS_M:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"radius_m must be greater than 0 and at most {MAX_RADIUS_M}"
+        )
+
+
+def parse_bounding_box(value: str) -> BoundingBox:
+    """
+    Parse a bounding box given as south,west,north,east.
+    """
+    south, west, north, east = parse_coordinates(value, 4, "bounding box")
+
+    if south > north or west > east:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{value} is not a valid bounding box"
+        )
+
+    return south, west, north, east
+
+
+def filter_by_bounding_box(
+        statement: Union[Query, Select],
+        latitude_column: Column,
+        longitude_column: Column,
+        geohash_column: Column,
+        bbox: BoundingBox) -> Union[Query, Select]:
+    """
+    Filter statement to the positions within bbox. The geohash prefixes of the cells covering bbox select a few ranges
+    of the geohash index, and the latitude and longitude predicates trim them to bbox.
+    """
+    south, west, north, east = bbox
+    cells = get_covering_cells(bbox)
+
+    if cells is not None:
+        statement = statement.where(or_(*[geohash_column.like(f"{cell}%") for cell in cells]))
+
+    return statement.where(latitude_column.between(south, north), longitude_column.between(west, east))
+
+
+def filter_by_distance(
+        statement: Union[Query, Select],
+        latitude_column: Column,
+        longitude_column: Column,
+        geohash_column: Column,
+        latitude: float,
+        longitude: float,
+        radius_m: float) -> Union[Query, Select]:
+    """
+    Filter statement to the positions within radius_m of the position. Circles crossing the antimeridian are cut off
+    at it.
+    """
+    statement = filter_by_bounding_box(statement, latitude_column, longitude_column, geohash_column,
+                                       get_bounding_box(latitude, longitude, radius_m))
+    return statement.where(get_distance(latitude_column, longitude_column, latitude, longitude) <= radius_m)
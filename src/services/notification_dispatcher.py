@@ -0,0 +1,249 @@
+import heapq
+import itertools
+import time
+from dataclasses import dataclass, replace
+from logging import getLogger
+from queue import Empty, Full, Queue
+from threading import Lock, Thread
+from typing import Callable, Dict, List, Optional, Tuple
+
+from pywebpush import WebPushException
+from requests import RequestException
+
+from src.database import NotificationSubscription, SessionLocal
+from src.services.notifications import create_notifications, get_audience, get_subscription_info, \
+    get_subscriptions, get_vapid_headers, push
+
+log = getLogger(__name__)
+
+WORKER_COUNT = 4
+MAX_QUEUE_SIZE = 1000
+MAX_ATTEMPTS = 3
+BACKOFF_SECONDS = 1.0
+CLEANUP_BATCH_SIZE = 100
+
+# Push services answer 404 or 410 for subscriptions which have expired or been unsubscribed.
+EXPIRED_STATUS_CODES = (404, 410)
+
+
+@dataclass
+class FanOutJob:
+    title: str
+    message: str
+    exclude_user_ids: List[int]
+    created_by_user_id: int
+
+
+@dataclass
+class PushJob:
+    subscription_id: int
+    subscription_info: dict
+    title: str
+    message: str
+    vapid_headers: Optional[dict]
+    attempt: int = 1
+
+
+class NotificationDispatcher:
+    """
+    Send push notifications from a bounded pool of worker threads so that requests do not wait for push services.
+    Failed pushes are retried with exponential backoff from a heap of delayed jobs, so that a worker is not held up while
+    it waits, and expired subscriptions are deleted in batches.
+    """
+    def __init__(
+            self,
+            session_factory: Callable = SessionLocal,
+            send: Callable[[dict, str, str, Optional[dict]], None] = push,
+            sign: Callable[[List[str]], Dict[str, dict]] = get_vapid_headers,
+            worker_count: int = WORKER_COUNT,
+            max_queue_size: int = MAX_QUEUE_SIZE,
+            max_attempts: int = MAX_ATTEMPTS,
+            backoff_seconds: float = BACKOFF_SECONDS,
+            cleanup_batch_size: int = CLEANUP_BATCH_SIZE):
+        self.session_factory = session_factory
+        self.send = send
+        self.sign = sign
+        self.worker_count = worker_count
+        self.max_attempts = max_attempts
+        self.backoff_seconds = backoff_seconds
+        self.cleanup_batch_size = cleanup_batch_size
+        self.__queue: Queue = Queue(maxsize=max_queue_size)
+        self.__workers: List[Thread] = []
+        self.__lock = Lock()
+        self.__expired_subscription_ids: List[int] = []
+        # Retries wait here, ordered by the monotonic time they are due at. They remain unfinished tasks of the queue
+        # until they are moved back to it, so that join waits for them.
+        self.__delayed: List[Tuple[float, int, PushJob]] = []
+        self.__delayed_lock = Lock()
+        self.__sequence = itertools.count()
+
+    def start(self):
+        with self.__lock:
+            if len(self.__workers) > 0:
+                return
+
+            for i in range(self.worker_count):
+                worker = Thread(target=self.__work, name=f"notification-worker-{i}", daemon=True)
+                worker.start()
+                self.__workers.append(worker)
+
+    def stop(self):
+        """
+        Send the notifications already queued, including their retries, and stop the workers.
+        """
+        with self.__lock:
+            workers, self.__workers = self.__workers, []
+
+        if len(workers) > 0:
+            self.__queue.join()
+
+        for _ in workers:
+            self.__queue.put(None)
+
+        for worker in workers:
+            worker.join()
+
+        self.delete_expired_subscriptions()
+
+    def join(self):
+        """
+        Wait until every queued notification has been sent or has run out of retries, and expired subscriptions have
+        been deleted.
+        """
+        self.__queue.join()
+        self.delete_expired_subscriptions()
+
+    def dispatch(self, title: str, message: str, exclude_user_ids: List[int], created_by_user_id: int) -> bool:
+        """
+        Queue a notification to every subscription of every user not in exclude_user_ids and return immediately.
+        Returns False if the queue is full and the notification was dropped.
+        """
+        self.start()
+        return self.__enqueue(FanOutJob(title, message, exclude_user_ids, created_by_user_id))
+
+    def __enqueue(self, job) -> bool:
+        try:
+            self.__queue.put_nowait(job)
+            return True
+        except Full:
+            log.error(f"Notification queue is full. Dropping {job}")
+            return False
+
+    def __work(self):
+        while True:
+            try:
+                job = self.__queue.get(timeout=self.__release_due_jobs())
+            except Empty:
+                continue
+
+            is_delayed = False
+            try:
+                if job is None:
+                    return
+                elif isinstance(job, FanOutJob):
+                    self.__fan_out(job)
+                else:
+                    is_delayed = self.__push(job)
+            except Exception:
+                log.exception(f"Unable to process {job}")
+            finally:
+                if not is_delayed:
+                    self.__queue.task_done()
+
+            if self.__queue.empty():
+                self.delete_expired_subscriptions()
+
+    def __fan_out(self, job: FanOutJob):
+        """
+        Resolve the subscriptions to notify and record the notifications with a fixed number of statements.
+        """
+        session = self.session_factory()
+        try:
+            subscriptions = get_subscriptions(session, job.exclude_user_ids)
+            vapid_headers = self.sign([subscription.endpoint for subscription in subscriptions]) \
+                if len(subscriptions) > 0 else {}
+            push_jobs = [PushJob(subscription.id, get_subscription_info(subscription), job.title, job.message,
+                                 vapid_headers.get(get_audience(subscription.endpoint)))
+                         for subscription in subscriptions]
+
+            create_notifications(session, job.title, job.message, job.created_by_user_id, len(subscriptions))
+            session.commit()
+        finally:
+            session.close()
+
+        for push_job in push_jobs:
+            self.__enqueue(push_job)
+
+    def __push(self, job: PushJob) -> bool:
+        """
+        Make one attempt to send the notification. Returns True if another attempt was scheduled.
+        """
+        try:
+            self.send(job.subscription_info, job.title, job.message, job.vapid_headers)
+            return False
+        except WebPushException as ex:
+            status_code: Optional[int] = ex.response.status_code if ex.response is not None else None
+
+            if status_code in EXPIRED_STATUS_CODES:
+                log.info(f"Subscription {job.subscription_id} no longer exists and will be deleted")
+                self.__expire(job.subscription_id)
+                return False
+
+            if status_code is not None and status_code < 500 and status_code != 429:
+                log.error(f"Push notification to subscription {job.subscription_id} was rejected: {ex}")
+                return False
+
+            log.warning(f"Push notification to subscription {job.subscription_id} failed on attempt {job.attempt}")
+        except RequestException:
+            log.warning(f"Push notification to subscription {job.subscription_id} failed on attempt {job.attempt}")
+
+        if job.attempt >= self.max_attempts:
+            log.error(f"Giving up on push notification to subscription {job.subscription_id}")
+            return False
+
+        due = time.monotonic() + self.backoff_seconds * 2 ** (job.attempt - 1)
+        with self.__delayed_lock:
+            heapq.heappush(self.__delayed, (due, next(self.__sequence), replace(job, attempt=job.attempt + 1)))
+        return True
+
+    def __release_due_jobs(self) -> Optional[float]:
+        """
+        Move the retries which are due back to the queue, and get the number of seconds until the next one is due, or
+        None if there is none.
+        """
+        with self.__delayed_lock:
+            now = time.monotonic()
+            while len(self.__delayed) > 0 and self.__delayed[0][0] <= now:
+                _, _, job = heapq.heappop(self.__delayed)
+                self.__enqueue(job)
+                # The retry now counts as a task of its own, so the task of the failed attempt is finished.
+                self.__queue.task_done()
+
+            return self.__delayed[0][0] - now if len(self.__delayed) > 0 else None
+
+    def __expire(self, subscription_id: int):
+        with self.__lock:
+            self.__expired_subscription_ids.append(subscription_id)
+            is_batch_full = len(self.__expired_subscription_ids) >= self.cleanup_batch_size
+
+        if is_batch_full:
+            self.delete_expired_subscriptions()
+
+    def delete_expired_subscriptions(self):
+        with self.__lock:
+            subscription_ids, self.__expired_subscription_ids = self.__expired_subscription_ids, []
+
+        if len(subscription_ids) == 0:
+            return
+
+        session = self.session_factory()
+        try:
+            session.query(NotificationSubscription)\
+                .where(NotificationSubscription.id.in_(subscription_ids))\
+                .delete(synchronize_session=False)
+            session.commit()
+        finally:
+            session.close()
+
+
+notification_dispatcher = NotificationDispatcher()
@@ -1,34 +1,96 @@
 import json
+import time
 from datetime import datetime
 from logging import getLogger
-from typing import List
+from typing import Dict, List, Optional
+from urllib.parse import urlparse
 
+from py_vapid import Vapid
 from pywebpush import webpush, WebPushException
+from sqlalchemy import insert
 from sqlalchemy.orm import Session
 
 from src.database import NotificationSubscription, User, Notification
 from src.models.notification_subscription import NotificationSubscriptionRead
-from src.models.user import UserRead
-from src.services.users import get_current_user
+from src.services.users import get_current_principal
 from src.settings_manager import settingsManager
 
 log = getLogger(__name__)
 
 
-def send_notification_to_users(title: str, message: str, exclude_user_ids: List[int], session: Session, token: str):
-    users = session.query(User).filter(User.id.not_in(exclude_user_ids)).all()
+VAPID_SUBJECT = "mailto:no-reply@pooper.online"
+VAPID_EXPIRATION_SECONDS = 12 * 60 * 60
 
-    for user in users:
-        send_notification_to_user(user, title, message, session, token)
 
-
-def send_notification_to_user(user: UserRead, title: str, message: str, session: Session, token: str):
-    subscriptions = session.query(NotificationSubscription)\
-        .where(NotificationSubscription.created_by_user_id == user.id)\
+def get_subscriptions(session: Session, exclude_user_ids: List[int]) -> List[NotificationSubscription]:
+    return session.query(NotificationSubscription)\
+        .join(User, User.id == NotificationSubscription.created_by_user_id)\
+        .where(User.id.not_in(exclude_user_ids))\
         .all()
 
-    for subscription in subscriptions:
-        send_notification_to_subscription(subscription, title, message, session, token)
+
+def get_audience(endpoint: str) -> str:
+    url = urlparse(endpoint)
+    return f"{url.scheme}://{url.netloc}"
+
+
+def get_vapid_headers(endpoints: List[str]) -> Dict[str, dict]:
+    """
+    Sign the VAPID claims once for every push service among endpoints and return the headers by audience.
+    """
+    vapid = Vapid.from_string(private_key=settingsManager.get_setting('VAPID_PRIVATE_KEY'))
+    expiration = int(time.time()) + VAPID_EXPIRATION_SECONDS
+
+    return {audience: vapid.sign({"sub": VAPID_SUBJECT, "aud": audience, "exp": expiration})
+            for audience in {get_audience(endpoint) for endpoint in endpoints}}
+
+
+def create_notifications(session: Session, title: str, message: str, created_by_user_id: int, count: int):
+    """
+    Record count notifications with a single insert.
+    """
+    if count == 0:
+        return
+
+    created = datetime.now()
+    session.execute(insert(Notification), [{
+        "title": title,
+        "message": message,
+        "created": created,
+        "created_by_user_id": created_by_user_id
+    } for _ in range(count)])
+
+
+def get_subscription_info(subscription: NotificationSubscriptionRead) -> dict:
+    return {
+        "endpoint": subscription.endpoint,
+        "keys": {
+            "p256dh": subscription.public_key,
+            "auth": subscription.authentication_secret
+        }
+    }
+
+
+def push(subscription_info: dict, title: str, message: str, vapid_headers: Optional[dict] = None):
+    """
+    Send a push notification to a subscription. Raises WebPushException when the push service rejects it.
+    The VAPID claims are signed for this push alone unless vapid_headers from get_vapid_headers are given.
+    """
+    data = json.dumps({
+        "title": title,
+        "message": message
+    })
+
+    if vapid_headers is not None:
+        webpush(subscription_info=subscription_info, data=data, headers=vapid_headers)
+        return
+
+    webpush(subscription_info=subscription_info,
+            data=data,
+            vapid_private_key=settingsManager.get_setting('VAPID_PRIVATE_KEY'),
+            vapid_claims={
+                "sub": VAPID_SUBJECT
+            })
 
 
 def send_notification_to_subscription(
@@ -38,7 +100,7 @@ def send_notification_to_subscription(
         session: Session,
         token: str
 ):
-    current_user = get_current_user(session, token)
+    current_user = get_current_principal(session, token)
 
     notification = Notification(
         title=title,
@@ -47,20 +109,7 @@ def send_notification_to_subscription(
         created_by_user_id=current_user.id,
     )
     try:
-        webpush(subscription_info={
-            "endpoint": subscription.endpoint,
-            "keys": {
-                "p256dh": subscription.public_key,
-                "auth": subscription.authentication_secret
-            }},
-            data=json.dumps({
-                "title": title,
-                "message": message
-            }),
-            vapid_private_key=settingsManager.get_setting('VAPID_PRIVATE_KEY'),
-            vapid_claims={
-                "sub": "mailto:no-reply@pooper.online"
-            })
+        push(get_subscription_info(subscription), title, message)
     except WebPushException as ex:
         if ex.response.status_code == 410:
             log.error("Push notification could not be sent. The subscription no longer exists")
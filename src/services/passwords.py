@@ -0,0 +1,108 @@
+import asyncio
+import multiprocessing
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from logging import getLogger
+from threading import Lock
+from typing import Callable, Optional
+
+from fastapi import HTTPException, status
+from passlib.hash import bcrypt
+
+from src.auth import pwd_context
+from src.metrics import Timer, register_metrics
+from src.settings_manager import settingsManager
+
+log = getLogger(__name__)
+
+RETRY_AFTER_SECONDS = 1
+
+
+def hash_password(password: str, rounds: int) -> str:
+    return bcrypt.using(rounds=rounds).hash(password)
+
+
+def verify_password(password: str, password_hash: str) -> bool:
+    return pwd_context.verify(password, password_hash)
+
+
+class PasswordHasher:
+    """
+    Hash and verify passwords in a pool of worker processes, so that the CPU time of bcrypt neither blocks the event
+    loop nor competes with requests for the GIL. Callers await the result on the event loop, so a request waiting for a
+    worker holds no threadpool slot. At most max_pending operations are admitted at a time, and requests beyond that
+    get a 503 straight away.
+    """
+    def __init__(self, worker_count: int, max_pending: int, rounds: int):
+        self.worker_count = worker_count
+        self.max_pending = max_pending
+        self.rounds = rounds
+        self.pending = 0
+        self.rejected = 0
+        self.hash_latency = Timer()
+        self.verify_latency = Timer()
+        self.__executor: Optional[ProcessPoolExecutor] = None
+        self.__lock = Lock()
+
+    def start(self):
+        with self.__lock:
+            if self.__executor is None:
+                # Spawn rather than fork, since forking a process with running threads can deadlock the children.
+                self.__executor = ProcessPoolExecutor(self.worker_count, multiprocessing.get_context("spawn"))
+
+    def stop(self):
+        with self.__lock:
+            executor, self.__executor = self.__executor, None
+
+        if executor is not None:
+            executor.shutdown()
+
+    async def hash(self, password: str) -> str:
+        return await self.__run(self.hash_latency, hash_password, password, self.rounds)
+
+    async def verify(self, password: str, password_hash: str) -> bool:
+        return await self.__run(self.verify_latency, verify_password, password, password_hash)
+
+    async def __run(self, timer: Timer, function: Callable, *args):
+        self.start()
+
+        with self.__lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                log.warning(f"{self.pending} password operations are already pending. Rejecting another one")
+                raise HTTPException(
+                    status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+                    detail="Too many password operations in progress",
+                    headers={"Retry-After": str(RETRY_AFTER_SECONDS)}
+                )
+            self.pending += 1
+            future: Future = self.__executor.submit(function, *args)
+
+        start = time.perf_counter()
+        try:
+            return await asyncio.wrap_future(future)
+        finally:
+            timer.observe(time.perf_counter() - start)
+            with self.__lock:
+                self.pending -= 1
+
+    def get_metrics(self) -> dict:
+        with self.__lock:
+            return {
+                "workers": self.worker_count,
+                "rounds": self.rounds,
+                "pending": self.pending,
+                "queue_depth": max(self.pending - self.worker_count, 0),
+                "rejected": self.rejected,
+                "hash": self.hash_latency.get_metrics(),
+                "verify": self.verify_latency.get_metrics()
+            }
+
+
+password_hasher = PasswordHasher(
+    int(settingsManager.get_setting('PASSWORD_HASH_WORKERS')),
+    int(settingsManager.get_setting('PASSWORD_HASH_MAX_PENDING')),
+    int(settingsManager.get_setting('BCRYPT_ROUNDS'))
+)
+
+register_metrics("password_hasher", password_hasher.get_metrics)
@@ -0,0 +1,124 @@
+import asyncio
+import hashlib
+from threading import Lock
+from typing import Awaitable, Callable, Dict, Optional
+
+from anyio import from_thread
+
+from src.cache import CacheBackend, LocalCacheBackend, RedisCacheBackend
+from src.metrics import register_metrics
+from src.settings_manager import settingsManager
+
+ANIMALS_NAMESPACE = "animals"
+CONDITIONS_NAMESPACE = "conditions"
+
+
+class ResponseCache:
+    """
+    Read serialized responses through a cache backend, keyed by a namespace and the normalized parameters of the
+    request. Concurrent misses for the same key wait for the first one to load the response, so that only one of them
+    queries the database. Every key of a namespace is invalidated at once by incrementing its generation.
+    """
+    def __init__(self, backend: CacheBackend):
+        self.backend = backend
+        self.__loads: Dict[str, asyncio.Future] = {}
+        self.__lock = Lock()
+        # The event loop the cache was last used from, for invalidations from threads which anyio did not start.
+        self.__loop: Optional[asyncio.AbstractEventLoop] = None
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+
+    async def get_key(self, namespace: str, parameters: tuple) -> str:
+        generation = await self.backend.get_counter(f"{namespace}:generation")
+        return f"{namespace}:{generation}:{hashlib.sha1(repr(parameters).encode()).hexdigest()}"
+
+    async def get_or_load(self, namespace: str, parameters: tuple, load: Callable[[], Awaitable[bytes]]) -> bytes:
+        self.__loop = asyncio.get_running_loop()
+        key = await self.get_key(namespace, parameters)
+        value = await self.backend.get(key)
+
+        if value is not None:
+            self.__count("hits")
+            return value
+
+        future = self.__loads.get(key)
+        if future is not None:
+            self.__count("coalesced")
+            return await asyncio.shield(future)
+
+        self.__count("misses")
+        future = asyncio.get_running_loop().create_future()
+        self.__loads[key] = future
+
+        try:
+            value = await load()
+            await self.backend.set(key, value)
+            future.set_result(value)
+            return value
+        except BaseException as ex:
+            future.set_exception(ex)
+            # Mark the exception as retrieved in case no other request was waiting for it.
+            future.exception()
+            raise
+        finally:
+            del self.__loads[key]
+
+    async def invalidate(self, *namespaces: str):
+        self.__loop = asyncio.get_running_loop()
+        for namespace in namespaces:
+            await self.backend.increment(f"{namespace}:generation")
+
+    def invalidate_from_thread(self, *namespaces: str):
+        """
+        Invalidate the namespaces from a thread other than the one of the event loop. Synchronous handlers run in
+        worker threads of anyio, which hand the invalidation to their event loop. Other threads, such as those of the
+        notification dispatcher, hand it to the event loop the cache was last used from, and a command without a
+        running event loop invalidates on an event loop of its own.
+        """
+        try:
+            from_thread.run(self.invalidate, *namespaces)
+            return
+        except RuntimeError:
+            # Not a worker thread of anyio.
+            pass
+
+        loop = self.__loop
+        if loop is not None and loop.is_running():
+            asyncio.run_coroutine_threadsafe(self.invalidate(*namespaces), loop).result()
+        else:
+            asyncio.run(self.invalidate(*namespaces))
+
+    def __count(self, counter: str):
+        with self.__lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get_metrics(self) -> dict:
+        with self.__lock:
+            lookups = self.hits + self.misses + self.coalesced
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "coalesced": self.coalesced,
+                # Coalesced lookups waited for a load from the database, so they are not hits.
+                "hit_ratio": self.hits / lookups if lookups > 0 else 0.0
+            }
+
+
+def create_backend() -> CacheBackend:
+    """
+    Create the backend selected by the CACHE_BACKEND setting. The redis backend requires the redis package, version 4.2
+    or later for its asyncio client.
+    """
+    ttl_seconds = float(settingsManager.get_setting('RESPONSE_CACHE_TTL_SECONDS'))
+
+    if settingsManager.get_setting('CACHE_BACKEND') == 'redis':
+        import redis.asyncio
+        return RedisCacheBackend(redis.asyncio.Redis.from_url(settingsManager.get_setting('REDIS_URL')), ttl_seconds)
+
+    return LocalCacheBackend(int(settingsManager.get_setting('RESPONSE_CACHE_SIZE')), ttl_seconds)
+
+
+response_cache = ResponseCache(create_backend())
+
+register_metrics("response_cache", response_cache.get_metrics)
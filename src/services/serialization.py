@@ -0,0 +1,140 @@
+from typing import Any, Callable, Dict, List, Optional, Type
+
+import orjson
+from fastapi import Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from sqlalchemy import and_, select
+from sqlalchemy.sql import Select
+
+from src.database import Animal, AnimalEventTypeAssociation, Event, User
+from src.settings_manager import settingsManager
+
+
+def is_fast_json_enabled() -> bool:
+    """
+    Whether list endpoints serialize their results with the functions below instead of validating them against their
+    response models. Enabled by setting FAST_JSON_RESPONSES to true.
+    """
+    return settingsManager.get_setting('FAST_JSON_RESPONSES').lower() == 'true'
+
+
+def create_json_response(content: List[dict], headers: Optional[Dict[str, str]] = None) -> ORJSONResponse:
+    return ORJSONResponse(content, headers=headers)
+
+
+def create_rendered_response(content: bytes, headers: Optional[Dict[str, str]] = None) -> Response:
+    return Response(content, media_type="application/json", headers=headers)
+
+
+def render(items: List[Any], to_dict: Callable[[Any], dict], model: Type[BaseModel]) -> bytes:
+    """
+    Render items as a JSON array, through model unless fast JSON responses are enabled.
+    """
+    if is_fast_json_enabled():
+        return orjson.dumps([to_dict(item) for item in items])
+
+    return orjson.dumps(jsonable_encoder([model.from_orm(item) for item in items]))
+
+
+def get_event_row_statement(statement: Select) -> Select:
+    """
+    Get a statement which selects the columns of EventRead, named after its fields, instead of the events selected by
+    statement.
+    """
+    is_tracked = select(AnimalEventTypeAssociation.id).where(and_(
+        AnimalEventTypeAssociation.animal_id == Event.animal_id,
+        AnimalEventTypeAssociation.event_type == Event.event_type
+    )).exists()
+
+    return statement.with_only_columns(
+        Event.id, Event.latitude, Event.longitude, Event.animal_id, Event.event_type, Event.rating, Event.created,
+        Event.created_by_user_id, (User.first_name + " " + User.last_name).label("created_by_user_name"),
+        Animal.name.label("animal_name"), Event.trip_id, is_tracked.label("is_tracked")
+    )\
+        .join_from(Event, Animal, Event.animal_id == Animal.id, isouter=True)\
+        .join_from(Event, User, Event.created_by_user_id == User.id, isouter=True)
+
+
+# The functions below accept ORM objects and rows alike, as long as they have attributes named after the fields.
+
+def event_to_dict(event: Any) -> dict:
+    return {
+        "latitude": event.latitude,
+        "longitude": event.longitude,
+        "animal_id": event.animal_id,
+        "event_type": event.event_type,
+        "rating": event.rating,
+        "created": event.created,
+        "id": event.id,
+        "created_by_user_id": event.created_by_user_id,
+        "created_by_user_name": event.created_by_user_name,
+        "animal_name": event.animal_name,
+        "trip_id": event.trip_id,
+        "is_tracked": bool(event.is_tracked)
+    }
+
+
+def condition_to_dict(condition: Any) -> dict:
+    return {
+        "animal_id": condition.animal_id,
+        "condition_type": condition.condition_type,
+        "is_enabled": condition.is_enabled,
+        "id": condition.id,
+        "created": condition.created,
+        "updated": condition.updated
+    }
+
+
+def animal_weight_to_dict(animal_weight: Any) -> dict:
+    return {
+        "animal_id": animal_weight.animal_id,
+        "weight_in_grams": animal_weight.weight_in_grams,
+        "id": animal_weight.id,
+        "created": animal_weight.created
+    }
+
+
+def note_to_dict(note: Any) -> dict:
+    return {
+        "animal_id": note.animal_id,
+        "text": note.text,
+        "id": note.id,
+        "created": note.created,
+        "created_by_user_name": note.created_by_user_name,
+        "updated": note.updated,
+        "updated_by_user_name": note.updated_by_user_name
+    }
+
+
+def association_to_dict(association: Any, type_field: str) -> dict:
+    return {
+        "animal_id": association.animal_id,
+        type_field: getattr(association, type_field),
+        "created": association.created,
+        "created_by_user_id": association.created_by_user_id,
+        "updated": association.updated,
+        "updated_by_user_id": association.updated_by_user_id
+    }
+
+
+def animal_to_dict(animal: Animal) -> dict:
+    """
+    Serialize an animal and the collections loaded by get_animals.
+    """
+    return {
+        "name": animal.name,
+        "is_deactivated": animal.is_deactivated,
+        "id": animal.id,
+        "created": animal.created,
+        "updated": animal.updated,
+        "tracked_conditions": [condition_to_dict(condition) for condition in animal.tracked_conditions],
+        "tracked_events": [event_to_dict(event) for event in animal.tracked_events],
+        "notes": [note_to_dict(note) for note in animal.notes],
+        "tracked_condition_types": [association_to_dict(association, "condition_type")
+                                    for association in animal.tracked_condition_types],
+        "tracked_event_types": [association_to_dict(association, "event_type")
+                                for association in animal.tracked_event_types],
+        "weight_history": [animal_weight_to_dict(animal_weight) for animal_weight in animal.weight_history]
+    }
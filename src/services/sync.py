@@ -0,0 +1,95 @@
+import base64
+import binascii
+from datetime import datetime, timedelta
+from typing import Iterable, Optional
+
+from fastapi import HTTPException, status
+from sqlalchemy import delete, insert, select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import Session, joinedload
+
+from src.database import AnimalWeight, Condition, Event, Note, Tombstone
+from src.models.changes import ChangesRead
+from src.services.events import get_event_read_options
+from src.settings_manager import settingsManager
+
+# Rows are stamped with the time of the request that wrote them, which may commit after a sync has already started.
+# Tokens point this far back in time so that such rows are returned by the next sync instead of being skipped.
+OVERLAP_SECONDS = 60
+
+
+def add_tombstone(session: Session, table_name: str, row_id: int):
+    """
+    Record that a row has been deleted so that clients can remove it on their next sync. The caller commits.
+    """
+    session.add(Tombstone(table_name=table_name, row_id=row_id, deleted=datetime.now()))
+
+
+def add_tombstones(session: Session, table_name: str, row_ids: Iterable[int]):
+    """
+    Record that rows have been deleted with a single executemany. The caller commits.
+    """
+    now = datetime.now()
+    rows = [{"table_name": table_name, "row_id": row_id, "deleted": now} for row_id in row_ids]
+
+    if len(rows) > 0:
+        session.execute(insert(Tombstone), rows)
+
+
+def get_retention() -> timedelta:
+    return timedelta(days=float(settingsManager.get_setting('TOMBSTONE_RETENTION_DAYS')))
+
+
+def prune_tombstones(session: Session) -> int:
+    """
+    Delete the tombstones older than the retention, and return how many were deleted. Tokens older than the retention
+    are rejected by get_changes, so no client misses a pruned tombstone. The caller commits.
+    """
+    return session.execute(delete(Tombstone).where(Tombstone.deleted < datetime.now() - get_retention())).rowcount
+
+
+def encode_token(watermark: datetime) -> str:
+    return base64.urlsafe_b64encode(watermark.isoformat().encode()).decode()
+
+
+def decode_token(token: str) -> datetime:
+    try:
+        return datetime.fromisoformat(base64.urlsafe_b64decode(token.encode()).decode())
+    except (binascii.Error, UnicodeError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{token} is not a valid sync token"
+        )
+
+
+async def get_changes(session: AsyncSession, token: Optional[str] = None) -> ChangesRead:
+    """
+    Get the rows created, updated or deleted since the watermark in token, or every row if token is None.
+    Every query is a range scan on an index of updated or deleted, so the cost follows the number of changes.
+    A token older than the tombstone retention gets a 410, since deletes it has not seen may have been pruned, and the
+    client must sync again without a token.
+    """
+    since = decode_token(token) if token is not None else None
+    now = datetime.now()
+    watermark = now - timedelta(seconds=OVERLAP_SECONDS)
+
+    if since is not None and since < now - get_retention():
+        raise HTTPException(
+            status_code=status.HTTP_410_GONE,
+            detail="The sync token is older than the tombstone retention. Sync again without a token"
+        )
+
+    async def get_all(entity, column, *options):
+        statement = select(entity).options(*options).order_by(column)
+        if since is not None:
+            statement = statement.where(column >= since)
+        return (await session.execute(statement)).scalars().unique().all()
+
+    return ChangesRead(
+        token=encode_token(watermark),
+        events=await get_all(Event, Event.updated, *get_event_read_options()),
+        conditions=await get_all(Condition, Condition.updated),
+        weights=await get_all(AnimalWeight, AnimalWeight.updated),
+        notes=await get_all(Note, Note.updated, joinedload(Note.created_by_user), joinedload(Note.updated_by_user)),
+        deleted=await get_all(Tombstone, Tombstone.deleted)
+    )
@@ -0,0 +1,122 @@
+import math
+from threading import Lock
+from typing import Hashable, Iterable, Optional, Sequence, Set, Tuple
+
+import numpy as np
+from fastapi import HTTPException, status
+
+from src.cache import TTLCache
+from src.models.tile import TileCellRead, TileRead
+from src.services.geo import BoundingBox
+
+MAX_ZOOM = 22
+TILE_CACHE_SIZE = 4096
+TILE_CACHE_TTL_SECONDS = 300
+
+# A tile of the Web Mercator projection as zoom, x and y.
+Tile = Tuple[int, int, int]
+
+
+def validate_tile(z: int, x: int, y: int):
+    if not 0 <= z <= MAX_ZOOM or not 0 <= x < 2 ** z or not 0 <= y < 2 ** z:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{z}/{x}/{y} is not a valid tile"
+        )
+
+
+def get_tile_bounding_box(z: int, x: int, y: int) -> BoundingBox:
+    """
+    Get the south, west, north and east edges of a tile in degrees.
+    """
+    def get_latitude(tile_y: int) -> float:
+        return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * tile_y / 2 ** z))))
+
+    return get_latitude(y + 1), x / 2 ** z * 360 - 180, get_latitude(y), (x + 1) / 2 ** z * 360 - 180
+
+
+def get_tile(latitude: float, longitude: float, z: int) -> Tile:
+    """
+    Get the tile at zoom level z which contains the position.
+    """
+    tile_count = 2 ** z
+    x = math.floor((longitude + 180) / 360 * tile_count)
+    y = math.floor((1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * tile_count)
+    return z, min(max(x, 0), tile_count - 1), min(max(y, 0), tile_count - 1)
+
+
+def bin_positions(z: int, x: int, y: int, grid_size: int, positions: Sequence[Tuple[float, float]]) -> TileRead:
+    """
+    Count the positions within each cell of a grid_size by grid_size grid over the tile, and locate each non-empty cell
+    at the mean of its positions.
+    """
+    latitudes, longitudes = np.array(positions, dtype=np.float64).reshape(-1, 2).T
+    tile_count = 2 ** z
+    tile_x = (longitudes + 180) / 360 * tile_count - x
+    tile_y = (1 - np.arcsinh(np.tan(np.radians(latitudes))) / np.pi) / 2 * tile_count - y
+    columns = np.clip(np.floor(tile_x * grid_size), 0, grid_size - 1).astype(np.int64)
+    rows = np.clip(np.floor(tile_y * grid_size), 0, grid_size - 1).astype(np.int64)
+
+    cell_indexes = rows * grid_size + columns
+    counts = np.bincount(cell_indexes, minlength=grid_size * grid_size)
+    latitude_sums = np.bincount(cell_indexes, weights=latitudes, minlength=grid_size * grid_size)
+    longitude_sums = np.bincount(cell_indexes, weights=longitudes, minlength=grid_size * grid_size)
+
+    cells = [TileCellRead(
+        row=int(cell_index // grid_size),
+        column=int(cell_index % grid_size),
+        count=int(counts[cell_index]),
+        latitude=float(latitude_sums[cell_index] / counts[cell_index]),
+        longitude=float(longitude_sums[cell_index] / counts[cell_index])
+    ) for cell_index in np.flatnonzero(counts)]
+
+    return TileRead(z=z, x=x, y=y, grid_size=grid_size, count=len(latitudes), cells=cells)
+
+
+class TileCache:
+    """
+    Cache the binned tiles for every combination of filters, and drop every cached version of the tiles containing an
+    event when it is created or deleted.
+    """
+    def __init__(self, maxsize: int = TILE_CACHE_SIZE, ttl_seconds: float = TILE_CACHE_TTL_SECONDS):
+        self.__tiles = TTLCache(maxsize, ttl_seconds)
+        self.__lock = Lock()
+        self.__generation = 0
+
+    def get_generation(self) -> int:
+        """
+        Get the number of invalidations so far. Pass it to set, which discards a tile binned before an invalidation.
+        """
+        return self.__generation
+
+    def get(self, tile: Tile, filters: Hashable) -> Optional[TileRead]:
+        return (self.__tiles.get(tile) or {}).get(filters)
+
+    def set(self, tile: Tile, filters: Hashable, value: TileRead, generation: int):
+        with self.__lock:
+            if generation != self.__generation:
+                return
+
+            versions = dict(self.__tiles.get(tile) or {})
+            versions[filters] = value
+            self.__tiles.set(tile, versions)
+
+    def invalidate(self, positions: Iterable[Tuple[float, float]]):
+        """
+        Drop the tiles at every zoom level which contain any of the positions.
+        """
+        tiles: Set[Tile] = {get_tile(latitude, longitude, z)
+                            for latitude, longitude in positions for z in range(MAX_ZOOM + 1)}
+
+        with self.__lock:
+            self.__generation += 1
+            for tile in tiles:
+                self.__tiles.delete(tile)
+
+    def clear(self):
+        with self.__lock:
+            self.__generation += 1
+            self.__tiles.clear()
+
+
+tile_cache = TileCache()
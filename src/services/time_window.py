@@ -0,0 +1,86 @@
+from datetime import datetime, time, timedelta
+from typing import Optional, Tuple, Union
+from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
+
+from fastapi import HTTPException, status
+from sqlalchemy import Column
+from sqlalchemy.orm import Query
+from sqlalchemy.sql import Select
+
+
+def get_time_zone(time_zone: Optional[str]) -> Optional[ZoneInfo]:
+    if time_zone is None:
+        return None
+
+    try:
+        return ZoneInfo(time_zone)
+    except (ZoneInfoNotFoundError, ValueError):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"{time_zone} is not a valid time zone"
+        )
+
+
+def to_server_time(value: datetime, time_zone: Optional[ZoneInfo] = None) -> datetime:
+    """
+    Convert value to the naive local time of the server, which is how timestamps are stored in the database.
+    Naive values are interpreted in time_zone if one is given.
+    """
+    if value.tzinfo is None:
+        if time_zone is None:
+            return value
+        value = value.replace(tzinfo=time_zone)
+
+    return value.astimezone().replace(tzinfo=None)
+
+
+def get_time_window(
+        days: Optional[int] = None,
+        from_date: Optional[datetime] = None,
+        to_date: Optional[datetime] = None,
+        time_zone: Optional[str] = None) -> Tuple[Optional[datetime], Optional[datetime]]:
+    """
+    Get the half-open window [start, end) in server time described by the parameters.
+    days=1 is today, and days=n is today and the n calendar days before it, in time_zone if given.
+    from_date and to_date narrow the window further. Either end is None when it is unbounded.
+    """
+    zone = get_time_zone(time_zone)
+    start: Optional[datetime] = None
+    end: Optional[datetime] = None
+
+    if days is not None:
+        now = datetime.now(zone)
+        today = datetime.combine(now.date(), time.min, tzinfo=now.tzinfo)
+        start = to_server_time(today if days == 1 else today - timedelta(days=days))
+        end = to_server_time(today + timedelta(days=1))
+
+    if from_date is not None:
+        from_date = to_server_time(from_date, zone)
+        start = from_date if start is None else max(start, from_date)
+
+    if to_date is not None:
+        to_date = to_server_time(to_date, zone)
+        end = to_date if end is None else min(end, to_date)
+
+    return start, end
+
+
+def filter_by_time_window(
+        statement: Union[Query, Select],
+        column: Column,
+        days: Optional[int] = None,
+        from_date: Optional[datetime] = None,
+        to_date: Optional[datetime] = None,
+        time_zone: Optional[str] = None) -> Union[Query, Select]:
+    """
+    Filter statement with range predicates on column so that an index on it can be used.
+    """
+    start, end = get_time_window(days, from_date, to_date, time_zone)
+
+    if start is not None:
+        statement = statement.where(column >= start)
+
+    if end is not None:
+        statement = statement.where(column < end)
+
+    return statement
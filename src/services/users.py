@@ -1,27 +1,74 @@
+import json
+
 import jwt
 from fastapi import HTTPException, status
 from sqlalchemy.orm import Session
 
 from src.auth import ALGORITHM
+from src.cache import TTLCache
 from src.database import User
 from src.models.user import UserRead
 from src.settings_manager import settingsManager
 
+PRINCIPAL_CACHE_TTL_SECONDS = 60
+principal_cache = TTLCache(maxsize=1024, ttl_seconds=PRINCIPAL_CACHE_TTL_SECONDS)
 
-def get_current_user(session: Session, token: str) -> UserRead:
-    payload = jwt.decode(token, settingsManager.get_setting('API_SECRET_AUTH_KEY'), algorithms=ALGORITHM)
-    email_address: str = payload.get("sub")
+credentials_exception = HTTPException(
+    status_code=status.HTTP_401_UNAUTHORIZED,
+    detail="Invalid credentials"
+)
 
-    credentials_exception = HTTPException(
-        status_code=status.HTTP_401_UNAUTHORIZED,
-        detail="Invalid credentials"
-    )
 
-    if email_address is None:
+def get_token_payload(token: str) -> dict:
+    payload = jwt.decode(token, settingsManager.get_setting('API_SECRET_AUTH_KEY'), algorithms=ALGORITHM)
+
+    if payload.get("sub") is None:
         raise credentials_exception
 
+    return payload
+
+
+def get_current_user(session: Session, token: str) -> UserRead:
+    email_address: str = get_token_payload(token)["sub"]
+
     user = session.query(User).where(User.email_address == email_address).first()
     if user is None:
         raise credentials_exception
 
     return user
+
+
+def get_current_principal(session: Session, token: str) -> UserRead:
+    """
+    Get the user a token was issued to without touching the database while the user is cached.
+    The user is looked up by the id in the verified claims, and only loaded from the database on a cache miss.
+    The cache belongs to the process, so a change made through another process is only seen once the entry expires
+    after PRINCIPAL_CACHE_TTL_SECONDS.
+    Use get_current_user instead when the user entity itself is going to be modified.
+    """
+    payload = get_token_payload(token)
+    email_address: str = payload["sub"]
+
+    user_id = json.loads(payload["user"]).get("id") if "user" in payload else None
+    principal: UserRead = principal_cache.get(user_id) if user_id is not None else None
+
+    if principal is None:
+        user = session.query(User).where(User.email_address == email_address).first()
+        if user is None:
+            raise credentials_exception
+
+        principal = UserRead.from_orm(user)
+        principal_cache.set(principal.id, principal)
+
+    if principal.email_address != email_address:
+        raise credentials_exception
+
+    return principal
+
+
+def invalidate_principal(user_id: int):
+    """
+    Make the next request of a user load the user from the database again. Call this whenever a user changes.
+    Only the cache of the current process is invalidated.
+    """
+    principal_cache.delete(user_id)
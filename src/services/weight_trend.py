@@ -0,0 +1,145 @@
+from datetime import datetime
+from typing import List, Optional, Sequence, Tuple
+
+import numpy as np
+from fastapi import HTTPException, status
+
+from src.models.downsampling_method import DownsamplingMethod
+from src.models.weight_trend import WeightTrendPointRead, WeightTrendRead
+
+MIN_POINTS = 3
+MAX_POINTS = 5000
+MICROSECONDS_PER_DAY = 86400 * 10 ** 6
+
+# A weight as fetched for the trend: animal id, created and weight in grams.
+WeightRow = Tuple[int, datetime, float]
+
+
+def validate_trend(max_points: int, window_days: float):
+    if not MIN_POINTS <= max_points <= MAX_POINTS:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"max_points must be between {MIN_POINTS} and {MAX_POINTS}"
+        )
+
+    if window_days <= 0:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="window_days must be positive"
+        )
+
+
+def get_moving_average(x: np.ndarray, y: np.ndarray, window: float) -> np.ndarray:
+    """
+    Get the average of the values of y within the half-open window (x - window, x] of each value of x, which must be
+    sorted.
+    """
+    starts = np.searchsorted(x, x - window, side="right")
+    ends = np.arange(1, len(x) + 1)
+    sums = np.concatenate(([0.0], np.cumsum(y)))
+    return (sums[ends] - sums[starts]) / (ends - starts)
+
+
+def get_lttb_indexes(x: np.ndarray, y: np.ndarray, max_points: int) -> np.ndarray:
+    """
+    Get the indexes of at most max_points points which preserve the shape of the series, using the
+    Largest-Triangle-Three-Buckets algorithm. The first and last points are always kept.
+    """
+    point_count = len(x)
+    if point_count <= max_points:
+        return np.arange(point_count)
+
+    # The points between the first and the last are split into max_points - 2 buckets, bounded by edges.
+    edges = np.linspace(1, point_count - 1, max_points - 1).astype(np.int64)
+    indexes = np.empty(max_points, dtype=np.int64)
+    indexes[0] = 0
+    indexes[-1] = point_count - 1
+
+    for bucket in range(max_points - 2):
+        start, end = edges[bucket], edges[bucket + 1]
+
+        if bucket == max_points - 3:
+            next_x, next_y = x[-1], y[-1]
+        else:
+            next_x, next_y = x[end:edges[bucket + 2]].mean(), y[end:edges[bucket + 2]].mean()
+
+        previous = indexes[bucket]
+        areas = np.abs((x[previous] - next_x) * (y[start:end] - y[previous])
+                       - (x[previous] - x[start:end]) * (next_y - y[previous]))
+        indexes[bucket + 1] = start + np.argmax(areas)
+
+    return indexes
+
+
+def get_bucket_means(x: np.ndarray, series: Sequence[np.ndarray], max_points: int) -> List[np.ndarray]:
+    """
+    Split the time span of x into max_points buckets of equal length, and get the mean of x and of each of series
+    within every bucket which is not empty.
+    """
+    span = max(x[-1] - x[0], 1)
+    buckets = np.minimum((x - x[0]) * max_points // span, max_points - 1)
+    counts = np.bincount(buckets, minlength=max_points)
+    is_filled = counts > 0
+
+    return [np.bincount(buckets, weights=values, minlength=max_points)[is_filled] / counts[is_filled]
+            for values in (x, *series)]
+
+
+def get_trend(
+        animal_id: int,
+        x: np.ndarray,
+        y: np.ndarray,
+        max_points: int,
+        method: DownsamplingMethod,
+        window_days: float) -> WeightTrendRead:
+    """
+    Get the trend of the weights y of an animal, weighed at the times x in microseconds.
+    """
+    moving_average = get_moving_average(x, y, window_days * MICROSECONDS_PER_DAY)
+
+    slope: Optional[float] = None
+    if x[-1] > x[0]:
+        slope = float(np.polyfit((x - x[0]) / MICROSECONDS_PER_DAY, y, 1)[0])
+
+    change_percent: Optional[float] = None
+    if y[0] != 0:
+        change_percent = float((y[-1] - y[0]) / y[0] * 100)
+
+    if method == DownsamplingMethod.buckets and len(x) > max_points:
+        points_x, points_y, points_moving_average = get_bucket_means(x, (y, moving_average), max_points)
+        points_x = np.rint(points_x).astype(np.int64)
+    else:
+        indexes = get_lttb_indexes(x, y, max_points)
+        points_x, points_y, points_moving_average = x[indexes], y[indexes], moving_average[indexes]
+
+    return WeightTrendRead(
+        animal_id=animal_id,
+        count=len(x),
+        slope_grams_per_day=slope,
+        change_percent=change_percent,
+        points=[WeightTrendPointRead(created=created, weight_in_grams=weight, moving_average=average)
+                for created, weight, average in zip(points_x.astype("datetime64[us]").tolist(), points_y.tolist(),
+                                                    points_moving_average.tolist())]
+    )
+
+
+def get_trends(
+        rows: Sequence[WeightRow],
+        max_points: int,
+        method: DownsamplingMethod,
+        window_days: float) -> List[WeightTrendRead]:
+    """
+    Get the trend of every animal in rows, which must be ordered by animal id and created.
+    """
+    if len(rows) == 0:
+        return []
+
+    animal_ids, created, weights = zip(*rows)
+    animal_ids = np.array(animal_ids, dtype=np.int64)
+    created = np.array(created, dtype="datetime64[us]").astype(np.int64)
+    weights = np.array(weights, dtype=np.float64)
+
+    boundaries = np.flatnonzero(np.diff(animal_ids)) + 1
+    return [get_trend(int(ids[0]), x, y, max_points, method, window_days)
+            for ids, x, y in zip(np.split(animal_ids, boundaries), np.split(created, boundaries),
+                                 np.split(weights, boundaries))]
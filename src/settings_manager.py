@@ -35,6 +35,27 @@ class SettingsManager:
 
             self.__settings[key] = value
 
+        optional_settings = {
+            'MARIADB_ASYNC_DRIVER': 'asyncmy',
+            'MARIADB_POOL_SIZE': '5',
+            'MARIADB_MAX_OVERFLOW': '10',
+            'MARIADB_POOL_TIMEOUT': '30',
+            'MARIADB_POOL_RECYCLE': '1800',
+            'FAST_JSON_RESPONSES': 'false',
+            'GZIP_MINIMUM_SIZE': '1000',
+            'CACHE_BACKEND': 'local',
+            'REDIS_URL': 'redis://localhost:6379/0',
+            'RESPONSE_CACHE_SIZE': '1024',
+            'RESPONSE_CACHE_TTL_SECONDS': '60',
+            'PASSWORD_HASH_WORKERS': str(os.cpu_count() or 1),
+            'PASSWORD_HASH_MAX_PENDING': '32',
+            'BCRYPT_ROUNDS': '12',
+            'TOMBSTONE_RETENTION_DAYS': '30'
+        }
+
+        for key, default_value in optional_settings.items():
+            self.__settings[key] = os.environ.get(key, default_value)
+
     def get_setting(self, key: str):
         value: str = self.__settings[key]
 
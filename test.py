@@ -22,10 +22,9 @@ class NotificationsTest(TestCase):
         """
         Send notification to all users.
         """
-        from src.database import SessionLocal
-        from src.services.notifications import send_notification_to_users
-        session: Session = SessionLocal()
-        send_notification_to_users("Hello", "World", [4], session, "mock token")
+        from src.services.notification_dispatcher import notification_dispatcher
+        notification_dispatcher.dispatch("Hello", "World", [4], 4)
+        notification_dispatcher.join()
 
     @staticmethod
     def test_send_notification_to_subscription(self):
@@ -40,4 +39,1651 @@ class NotificationsTest(TestCase):
         subscription = session.query(NotificationSubscription)\
             .where(NotificationSubscription.created_by_user_id == 4)\
             .first()
-        send_notification_to_subscription(subscription, "Hello!", "World!")
\ No newline at end of file
+        send_notification_to_subscription(subscription, "Hello!", "World!")
+
+def create_session() -> Session:
+    """
+    Create a session against a temporary SQLite database with the schema of the API.
+    """
+    import tempfile
+    from sqlalchemy import create_engine
+    from sqlalchemy.orm import sessionmaker
+    from src.database import Base
+
+    directory = tempfile.mkdtemp()
+    engine = create_engine(f"sqlite:///{directory}/pooper.db", connect_args={"check_same_thread": False})
+    Base.metadata.create_all(engine)
+    return sessionmaker(bind=engine)()
+
+
+def create_client(session: Session):
+    """
+    Create a test client for the API that uses session for every synchronous request, and an aiosqlite session
+    against the same database for every asynchronous request.
+    """
+    from fastapi.testclient import TestClient
+    from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
+    from sqlalchemy.orm import sessionmaker
+    from src.database import get_async_database_session, get_database_session
+    from src.main import app
+
+    async_engine = create_async_engine(f"sqlite+aiosqlite:///{session.get_bind().url.database}")
+    async_session_local = sessionmaker(bind=async_engine, class_=AsyncSession, expire_on_commit=False)
+
+    async def get_test_async_database_session():
+        async with async_session_local() as async_session:
+            yield async_session
+
+    app.dependency_overrides[get_database_session] = lambda: session
+    app.dependency_overrides[get_async_database_session] = get_test_async_database_session
+    client = TestClient(app)
+    client.headers["Authorization"] = "Bearer test"
+    client.engines = [session.get_bind(), async_engine.sync_engine]
+    return client
+
+
+def seed(session: Session, event_count: int = 0, animal_count: int = 1):
+    """
+    Seed a user, animal_count animals tracking pee and event_count events spread across the animals.
+    """
+    from datetime import datetime, timedelta
+    from src.database import Animal, AnimalEventTypeAssociation, Event, User
+
+    now = datetime.now()
+    user = User(first_name="Test", last_name="User", email_address="test@pooper.online", password_hash="",
+                is_disabled=False, created=now, updated=now)
+    session.add(user)
+    session.flush()
+
+    animals = []
+    for i in range(animal_count):
+        animal = Animal(name=f"Animal {i}", is_deactivated=False, created=now, created_by_user_id=user.id, updated=now,
+                        updated_by_user_id=user.id)
+        animal.tracked_event_types.append(AnimalEventTypeAssociation(
+            event_type="Pee", created=now, created_by_user_id=user.id, updated=now, updated_by_user_id=user.id))
+        session.add(animal)
+        animals.append(animal)
+    session.flush()
+
+    for i in range(event_count):
+        session.add(Event(
+            latitude=59.91,
+            longitude=10.75,
+            event_type=["Pee", "Poo", "Eat"][i % 3],
+            animal_id=animals[i % animal_count].id,
+            created=now - timedelta(minutes=i),
+            created_by_user_id=user.id,
+            updated=now,
+            updated_by_user_id=user.id
+        ))
+    session.commit()
+
+    return user, animals
+
+
+def create_token(user) -> str:
+    """
+    Create an access token for user, signed with the mock secret.
+    """
+    import json
+    from datetime import datetime, timedelta
+
+    import jwt
+    from src.models.user import UserRead
+
+    return jwt.encode({
+        "sub": user.email_address,
+        "exp": datetime.utcnow() + timedelta(minutes=5),
+        "user": json.dumps(UserRead.from_orm(user).__dict__, default=str)
+    }, "mock api secret auth key", algorithm="HS256")
+
+
+class StatementCounter:
+    """
+    Count the statements executed and the transactions committed by engines while in use as a context manager.
+    """
+    def __init__(self, *engines):
+        self.engines = engines
+        self.count = 0
+        self.statements = []
+        self.commits = 0
+
+    def __enter__(self):
+        from sqlalchemy import event
+        for engine in self.engines:
+            event.listen(engine, "before_cursor_execute", self.increment)
+            event.listen(engine, "commit", self.increment_commits)
+        return self
+
+    def __exit__(self, *args):
+        from sqlalchemy import event
+        for engine in self.engines:
+            event.remove(engine, "before_cursor_execute", self.increment)
+            event.remove(engine, "commit", self.increment_commits)
+
+    def increment(self, connection, cursor, statement, *args):
+        self.count += 1
+        self.statements.append(statement)
+
+    def increment_commits(self, *args):
+        self.commits += 1
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class EventsTest(TestCase):
+    def test_get_all_statement_count(self):
+        """
+        Getting a page of events costs the same number of statements regardless of the page size: one for the ETag and
+        one for the page.
+        """
+        session = create_session()
+        seed(session, event_count=100, animal_count=3)
+        client = create_client(session)
+
+        with StatementCounter(*client.engines) as counter:
+            response = client.get("/events/", params={"page_size": 100})
+
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(100, len(response.json()))
+        self.assertLessEqual(counter.count, 2)
+
+    def test_get_all_with_cursor(self):
+        """
+        Following the cursor pages through every event exactly once in either sort order, and a cursor only continues
+        the sort order it was issued for.
+        """
+        session = create_session()
+        seed(session, event_count=25, animal_count=3)
+        client = create_client(session)
+
+        for sort_order, expected in [("desc", list(range(25, 0, -1))), ("asc", list(range(1, 26)))]:
+            event_ids = []
+            params = {"page_size": 10, "sort_order": sort_order}
+            while True:
+                response = client.get("/events/", params=params)
+                self.assertEqual(200, response.status_code)
+                event_ids += [event["id"] for event in response.json()]
+
+                if "x-next-cursor" not in response.headers:
+                    break
+                self.assertFalse(response.headers["x-next-cursor"].isdigit())
+                params["cursor"] = response.headers["x-next-cursor"]
+
+            self.assertEqual(expected, event_ids)
+
+        cursor = client.get("/events/", params={"page_size": 10}).headers["x-next-cursor"]
+        self.assertEqual(400, client.get("/events/", params={"cursor": cursor, "sort_order": "asc"}).status_code)
+        self.assertEqual(400, client.get("/events/", params={"cursor": "not a cursor"}).status_code)
+        self.assertEqual(400, client.get("/events/", params={"cursor": cursor, "near": "59.91,10.75"}).status_code)
+
+    def test_get_all_not_modified(self):
+        """
+        A client which already has the current page gets a 304 from the ETag statement alone, until an event changes.
+        """
+        session = create_session()
+        seed(session, event_count=10)
+        client = create_client(session)
+
+        response = client.get("/events/", params={"page_size": 5})
+        etag = response.headers["etag"]
+        self.assertIn("last-modified", response.headers)
+
+        with StatementCounter(*client.engines) as counter:
+            response = client.get("/events/", params={"page_size": 5}, headers={"If-None-Match": etag})
+        self.assertEqual(304, response.status_code)
+        self.assertEqual(b"", response.content)
+        self.assertEqual(1, counter.count)
+
+        self.assertEqual(200, client.get("/events/", params={"page_size": 6}, headers={"If-None-Match": etag})
+                         .status_code)
+        self.assertEqual(204, client.delete("/events/1").status_code)
+        self.assertEqual(200, client.get("/events/", params={"page_size": 5}, headers={"If-None-Match": etag})
+                         .status_code)
+
+    def test_get_all_compressed(self):
+        """
+        Pages larger than the minimum size are compressed for clients which accept gzip.
+        """
+        session = create_session()
+        seed(session, event_count=100)
+        client = create_client(session)
+
+        response = client.get("/events/", params={"page_size": 100}, headers={"Accept-Encoding": "gzip"})
+        self.assertEqual("gzip", response.headers["content-encoding"])
+        self.assertEqual(100, len(response.json()))
+
+    def test_create_batch_with_repeated_key(self):
+        """
+        An item repeating an idempotency key used earlier in the same batch is reported as a duplicate of the first,
+        and is neither created nor counted in the notification.
+        """
+        from src.database import Event
+        from src.services.notification_dispatcher import notification_dispatcher
+
+        session = create_session()
+        user, animals = seed(session)
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+        item = {"latitude": 59.91, "longitude": 10.75, "animal_id": 1, "event_type": "Pee"}
+
+        with mock.patch.object(notification_dispatcher, "dispatch") as dispatch:
+            response = client.post("/events/batch", json=[
+                {**item, "idempotency_key": "a"},
+                {**item, "event_type": "Poo", "idempotency_key": "a"},
+                {**item, "idempotency_key": "b"}
+            ])
+
+        self.assertEqual(200, response.status_code)
+        results = response.json()
+        self.assertEqual(["Created", "Duplicate", "Created"], [result["status"] for result in results])
+        self.assertEqual(results[0]["event_id"], results[1]["event_id"])
+        self.assertEqual(["Pee", "Pee"], [event_type for (event_type,) in session.query(Event.event_type)])
+        self.assertEqual("Test registered 2 new events", dispatch.call_args[0][0])
+
+        response = client.post("/events/batch", json=[{**item, "idempotency_key": "b"}])
+        self.assertEqual([("Duplicate", results[2]["event_id"])],
+                         [(result["status"], result["event_id"]) for result in response.json()])
+
+    def test_create_batch_with_key_of_invalid_item(self):
+        """
+        An invalid item does not use up its idempotency key, so a later valid item with the same key is created.
+        """
+        session = create_session()
+        user, _ = seed(session)
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+        item = {"latitude": 59.91, "longitude": 10.75, "event_type": "Pee", "idempotency_key": "a"}
+
+        response = client.post("/events/batch", json=[{**item, "animal_id": 100}, {**item, "animal_id": 1}])
+        self.assertEqual(200, response.status_code)
+        results = response.json()
+        self.assertEqual(["Invalid", "Created"], [result["status"] for result in results])
+        self.assertIsNotNone(results[1]["event_id"])
+
+        response = client.post("/events/batch", json=[{**item, "animal_id": 1}])
+        self.assertEqual([("Duplicate", results[1]["event_id"])],
+                         [(result["status"], result["event_id"]) for result in response.json()])
+
+    def test_get_event_and_count_statement_count(self):
+        """
+        Getting a single event or the number of events costs a single statement.
+        """
+        session = create_session()
+        seed(session, event_count=10)
+        client = create_client(session)
+
+        with StatementCounter(*client.engines) as counter:
+            response = client.get("/events/1")
+        self.assertEqual(200, response.status_code)
+        self.assertTrue(response.json()["is_tracked"])
+        self.assertLessEqual(counter.count, 1)
+
+        with StatementCounter(*client.engines) as counter:
+            response = client.get("/events/count")
+        self.assertEqual(10, response.json())
+        self.assertLessEqual(counter.count, 1)
+
+    def test_get_near_and_in_bounding_box(self):
+        """
+        Events near a position and within a bounding box match a brute-force search, nearest first.
+        """
+        import random
+        from src.database import Event
+        from src.services.geo import encode_geohash, get_haversine_distance
+
+        session = create_session()
+        seed(session, event_count=500)
+        generator = random.Random(42)
+        for event in session.query(Event):
+            event.latitude = 59.91 + generator.uniform(-0.02, 0.02)
+            event.longitude = 10.75 + generator.uniform(-0.04, 0.04)
+            event.geohash = encode_geohash(event.latitude, event.longitude)
+        session.commit()
+        client = create_client(session)
+        events = session.query(Event).all()
+
+        response = client.get("/events/", params={"near": "59.91,10.75", "radius_m": 1000, "page_size": 500})
+        self.assertEqual(200, response.status_code)
+        expected = sorted((get_haversine_distance(59.91, 10.75, event.latitude, event.longitude), event.id)
+                          for event in events)
+        self.assertEqual([event_id for distance, event_id in expected if distance <= 1000],
+                         [event["id"] for event in response.json()])
+
+        response = client.get("/events/", params={"bbox": "59.9,10.74,59.92,10.8", "page_size": 500})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(sorted(event.id for event in events
+                                if 59.9 <= event.latitude <= 59.92 and 10.74 <= event.longitude <= 10.8),
+                         sorted(event["id"] for event in response.json()))
+
+        self.assertEqual(400, client.get("/events/", params={"bbox": "59.92,10.74,59.9,10.8"}).status_code)
+        self.assertEqual(400, client.get("/events/", params={"near": "north"}).status_code)
+        self.assertEqual(400, client.get("/events/", params={"near": "59.91,10.75", "radius_m": -1}).status_code)
+        self.assertEqual(400, client.get("/events/", params={"near": "59.91,10.75", "radius_m": 1e9}).status_code)
+
+    def test_get_tile(self):
+        """
+        A tile counts the events within it and is served from the cache until an event within it is deleted.
+        """
+        import random
+        from src.database import Event
+        from src.services.geo import encode_geohash
+        from src.services.tiles import get_tile, tile_cache
+
+        session = create_session()
+        seed(session, event_count=500)
+        generator = random.Random(42)
+        for event in session.query(Event):
+            event.latitude = 59.91 + generator.uniform(-0.02, 0.02)
+            event.longitude = 10.75 + generator.uniform(-0.04, 0.04)
+            event.geohash = encode_geohash(event.latitude, event.longitude)
+        session.commit()
+        tile_cache.clear()
+        client = create_client(session)
+
+        z, x, y = get_tile(59.91, 10.75, 14)
+        events = [event for event in session.query(Event) if get_tile(event.latitude, event.longitude, z) == (z, x, y)]
+        response = client.get(f"/events/tiles/{z}/{x}/{y}")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(len(events), response.json()["count"])
+        self.assertEqual(len(events), sum(cell["count"] for cell in response.json()["cells"]))
+
+        with StatementCounter(*client.engines) as counter:
+            self.assertEqual(response.json(), client.get(f"/events/tiles/{z}/{x}/{y}").json())
+        self.assertEqual(0, counter.count)
+
+        self.assertEqual(204, client.delete(f"/events/{events[0].id}").status_code)
+        self.assertEqual(len(events) - 1, client.get(f"/events/tiles/{z}/{x}/{y}").json()["count"])
+        self.assertEqual(400, client.get("/events/tiles/1/2/0").status_code)
+
+    def test_get_stats(self):
+        """
+        The statistics of events are read from the rollup in a single statement and follow deleted events.
+        """
+        from collections import Counter
+        from src.database import Event
+        from src.services.event_rollup import rebuild_rollup
+
+        session = create_session()
+        seed(session, event_count=30, animal_count=2)
+        rebuild_rollup(session)
+        session.commit()
+        client = create_client(session)
+
+        for event_id in [1, 2]:
+            self.assertEqual(204, client.delete(f"/events/{event_id}").status_code)
+
+        with StatementCounter(*client.engines) as counter:
+            response = client.get("/events/stats", params={"days": 7})
+
+        self.assertEqual(200, response.status_code)
+        self.assertLessEqual(counter.count, 1)
+        self.assertEqual(
+            Counter((event.created.date().isoformat(), event.animal_id, event.event_type)
+                    for event in session.query(Event)),
+            Counter({(row["day"], row["animal_id"], row["event_type"]): row["count"] for row in response.json()})
+        )
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class NotificationDispatcherTest(TestCase):
+    def test_dispatch(self):
+        """
+        Notifications reach every subscription but the sender's, failed pushes are retried and expired subscriptions
+        are deleted.
+        """
+        from datetime import datetime
+        from pywebpush import WebPushException
+        from requests import Response
+        from sqlalchemy.orm import sessionmaker
+        from src.database import NotificationSubscription, User
+        from src.services.notification_dispatcher import NotificationDispatcher
+
+        session = create_session()
+        sender, _ = seed(session)
+        receiver = User(first_name="Receiver", last_name="User", email_address="receiver@pooper.online",
+                        password_hash="", is_disabled=False, created=datetime.now(), updated=datetime.now())
+        session.add(receiver)
+        session.flush()
+        for user_id, endpoint in [(sender.id, "sender"), (receiver.id, "ok"), (receiver.id, "flaky"),
+                                  (receiver.id, "expired")]:
+            session.add(NotificationSubscription(endpoint=endpoint, public_key="", authentication_secret="",
+                                                 created_by_user_id=user_id, created=datetime.now(),
+                                                 updated_by_user_id=user_id, updated=datetime.now()))
+        session.commit()
+
+        attempts = []
+
+        def send(subscription_info: dict, title: str, message: str, vapid_headers: dict):
+            """
+            Stand in for a push service which accepts ok, fails flaky once and has forgotten expired.
+            """
+            endpoint = subscription_info["endpoint"]
+            attempts.append(endpoint)
+
+            if endpoint == "expired" or (endpoint == "flaky" and attempts.count(endpoint) == 1):
+                response = Response()
+                response.status_code = 410 if endpoint == "expired" else 503
+                raise WebPushException("Push failed", response=response)
+
+        dispatcher = NotificationDispatcher(sessionmaker(bind=session.get_bind()), send, lambda endpoints: {},
+                                            backoff_seconds=0)
+        self.assertTrue(dispatcher.dispatch("Hello", "World", [sender.id], sender.id))
+        dispatcher.join()
+        dispatcher.stop()
+
+        self.assertEqual(["expired", "flaky", "flaky", "ok"], sorted(attempts))
+        session.expire_all()
+        self.assertEqual(["flaky", "ok", "sender"], sorted(
+            subscription.endpoint for subscription in session.query(NotificationSubscription)))
+
+    def test_dispatch_retry_does_not_hold_up_worker(self):
+        """
+        A failed push waits for its retry on the delay heap while the worker sends other notifications, and join waits
+        for the retry.
+        """
+        from datetime import datetime
+        from pywebpush import WebPushException
+        from requests import Response
+        from sqlalchemy.orm import sessionmaker
+        from src.database import NotificationSubscription, User
+        from src.services.notification_dispatcher import NotificationDispatcher
+
+        session = create_session()
+        sender, _ = seed(session)
+        receiver = User(first_name="Receiver", last_name="User", email_address="receiver@pooper.online",
+                        password_hash="", is_disabled=False, created=datetime.now(), updated=datetime.now())
+        session.add(receiver)
+        session.flush()
+        for endpoint in ["first", "second"]:
+            session.add(NotificationSubscription(endpoint=endpoint, public_key="", authentication_secret="",
+                                                 created_by_user_id=receiver.id, created=datetime.now(),
+                                                 updated_by_user_id=receiver.id, updated=datetime.now()))
+        session.commit()
+
+        attempts = []
+
+        def send(subscription_info: dict, title: str, message: str, vapid_headers: dict):
+            endpoint = subscription_info["endpoint"]
+            attempts.append(endpoint)
+
+            if attempts.count(endpoint) == 1:
+                response = Response()
+                response.status_code = 503
+                raise WebPushException("Push failed", response=response)
+
+        dispatcher = NotificationDispatcher(sessionmaker(bind=session.get_bind()), send, lambda endpoints: {},
+                                            worker_count=1, backoff_seconds=0.1)
+        self.assertTrue(dispatcher.dispatch("Hello", "World", [sender.id], sender.id))
+        dispatcher.join()
+        dispatcher.stop()
+
+        self.assertEqual(4, len(attempts))
+        self.assertEqual({"first", "second"}, set(attempts[:2]))
+        self.assertEqual({"first", "second"}, set(attempts[2:]))
+
+    def test_dispatch_statement_count(self):
+        """
+        Fanning out a notification costs the same number of statements regardless of the number of users.
+        """
+        from datetime import datetime
+        from sqlalchemy.orm import sessionmaker
+        from src.database import Notification, NotificationSubscription, User
+        from src.services.notification_dispatcher import NotificationDispatcher
+
+        counts = []
+        for user_count in [1, 10]:
+            session = create_session()
+            sender, _ = seed(session)
+            for i in range(user_count):
+                user = User(first_name="Receiver", last_name=str(i), email_address=f"receiver{i}@pooper.online",
+                            password_hash="", is_disabled=False, created=datetime.now(), updated=datetime.now())
+                session.add(user)
+                session.flush()
+                session.add(NotificationSubscription(endpoint=f"https://push.example.com/{i}", public_key="",
+                                                     authentication_secret="", created_by_user_id=user.id,
+                                                     created=datetime.now(), updated_by_user_id=user.id,
+                                                     updated=datetime.now()))
+            session.commit()
+
+            signed_endpoints = []
+            dispatcher = NotificationDispatcher(sessionmaker(bind=session.get_bind()), lambda *args: None,
+                                                lambda endpoints: signed_endpoints.append(endpoints) or {})
+
+            with StatementCounter(session.get_bind()) as counter:
+                dispatcher.dispatch("Hello", "World", [sender.id], sender.id)
+                dispatcher.join()
+            dispatcher.stop()
+
+            counts.append(counter.count)
+            self.assertEqual(1, len(signed_endpoints))
+            self.assertEqual(user_count, session.query(Notification).count())
+
+        self.assertEqual(counts[0], counts[1])
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class SyncTest(TestCase):
+    def test_get_changes(self):
+        """
+        A sync returns only the rows updated or deleted since the token.
+        """
+        from datetime import datetime, timedelta
+        from src.database import Event
+        from src.services.sync import encode_token
+
+        session = create_session()
+        seed(session, event_count=10)
+        session.query(Event).update({Event.updated: datetime.now() - timedelta(hours=2)})
+        session.query(Event).where(Event.id == 2).update({Event.updated: datetime.now()})
+        session.commit()
+        client = create_client(session)
+
+        self.assertEqual(204, client.delete("/events/1").status_code)
+
+        response = client.get("/sync/", params={"since": encode_token(datetime.now() - timedelta(hours=1))})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([2], [event["id"] for event in response.json()["events"]])
+        self.assertEqual([("event", 1)], [(row["table_name"], row["row_id"]) for row in response.json()["deleted"]])
+        self.assertEqual(9, len(client.get("/sync/").json()["events"]))
+        self.assertEqual(400, client.get("/sync/", params={"since": "not a token"}).status_code)
+
+    def test_delete_animal(self):
+        """
+        Deleting an animal records a tombstone for the animal and for each of its events, weights and notes.
+        """
+        from datetime import datetime
+        from src.database import AnimalWeight, Event, Note
+        from src.services.sync import encode_token
+
+        session = create_session()
+        user, animals = seed(session, event_count=4, animal_count=2)
+        now = datetime.now()
+        session.add(Note(text="Note", animal_id=animals[0].id, created=now, created_by_user_id=user.id, updated=now,
+                         updated_by_user_id=user.id))
+        session.add(AnimalWeight(animal_id=animals[0].id, weight_in_grams=5000, created=now, created_by_user_id=user.id,
+                                 updated=now, updated_by_user_id=user.id))
+        session.commit()
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+
+        self.assertEqual(204, client.delete(f"/animals/{animals[0].id}").status_code)
+
+        response = client.get("/sync/", params={"since": encode_token(now)})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual([("animal", 1), ("animalweight", 1), ("event", 1), ("event", 3), ("note", 1)],
+                         sorted((row["table_name"], row["row_id"]) for row in response.json()["deleted"]))
+        session.expire_all()
+        self.assertEqual([2, 4], sorted(event_id for (event_id,) in session.query(Event.id)))
+        self.assertEqual(0, session.query(Note).count())
+
+    def test_prune_tombstones(self):
+        """
+        Tombstones older than the retention are pruned, and tokens older than the retention get a 410.
+        """
+        from datetime import datetime, timedelta
+        from src.database import Tombstone
+        from src.services.sync import encode_token, prune_tombstones
+
+        session = create_session()
+        seed(session, event_count=2)
+        session.add(Tombstone(table_name="event", row_id=100, deleted=datetime.now() - timedelta(days=31)))
+        session.commit()
+        client = create_client(session)
+
+        self.assertEqual(204, client.delete("/events/1").status_code)
+        self.assertEqual(1, prune_tombstones(session))
+        session.commit()
+        self.assertEqual([1], [row_id for (row_id,) in session.query(Tombstone.row_id)])
+
+        self.assertEqual(410, client.get("/sync/", params={"since": encode_token(datetime.now() - timedelta(days=31))})
+                         .status_code)
+        self.assertEqual(200, client.get("/sync/", params={"since": encode_token(datetime.now() - timedelta(days=29))})
+                         .status_code)
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class ExportTest(TestCase):
+    def test_export_memory(self):
+        """
+        Exporting a million events streams them without growing the peak memory of the process with the row count.
+        """
+        import asyncio
+        import resource
+        from sqlalchemy import text
+        from src.main import app
+
+        session = create_session()
+        seed(session)
+        session.execute(text(
+            "INSERT INTO event (latitude, longitude, geohash, event_type, animal_id, created, created_by_user_id, "
+            "updated, updated_by_user_id) "
+            "WITH RECURSIVE n(i) AS (SELECT 1 UNION ALL SELECT i + 1 FROM n WHERE i < 1000000) "
+            "SELECT 59.91, 10.75, 'u4xsud7cj1ky', 'Pee', 1, datetime('now', '-' || i || ' seconds'), 1, "
+            "datetime('now'), 1 FROM n"
+        ))
+        session.commit()
+        create_client(session)
+
+        async def export(query_string: bytes) -> (int, int):
+            """
+            Stream an export straight from the app, counting and discarding the lines of the body.
+            """
+            line_count = 0
+            byte_count = 0
+            scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": "/events/export",
+                     "raw_path": b"/events/export", "root_path": "", "query_string": query_string,
+                     "headers": [(b"authorization", b"Bearer test")], "client": ("127.0.0.1", 0),
+                     "server": ("127.0.0.1", 80)}
+
+            async def receive():
+                # The client never disconnects.
+                await asyncio.Event().wait()
+
+            async def send(message):
+                nonlocal line_count, byte_count
+                if message["type"] == "http.response.body":
+                    line_count += message.get("body", b"").count(b"\n")
+                    byte_count += len(message.get("body", b""))
+
+            await app(scope, receive, send)
+            return line_count, byte_count
+
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        line_count, byte_count = asyncio.run(export(b"format=ndjson"))
+        peak_rss_growth = (resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - peak_rss) * 1024
+
+        self.assertEqual(1000000, line_count)
+        self.assertLess(peak_rss_growth, 64 * 1024 * 1024)
+        self.assertLess(peak_rss_growth, byte_count / 4)
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class SerializationTest(TestCase):
+    def test_fast_json_responses(self):
+        """
+        The list endpoints return the same JSON whether or not FAST_JSON_RESPONSES is enabled.
+        """
+        from datetime import datetime
+        from src.database import AnimalConditionTypeAssociation, AnimalWeight, Condition, Note
+        import asyncio
+        from src.services.response_cache import ANIMALS_NAMESPACE, CONDITIONS_NAMESPACE, response_cache
+        from src.settings_manager import settingsManager
+
+        session = create_session()
+        user, animals = seed(session, event_count=30, animal_count=2)
+        now = datetime.now()
+        for animal in animals:
+            animal.tracked_condition_types.append(AnimalConditionTypeAssociation(
+                condition_type="Heat", created=now, created_by_user_id=user.id, updated=now, updated_by_user_id=user.id))
+            animal.tracked_conditions.append(Condition(
+                condition_type="Heat", is_enabled=True, created=now, created_by_user_id=user.id, updated=now,
+                updated_by_user_id=user.id))
+            animal.weight_history.append(AnimalWeight(
+                weight_in_grams=5000, created=now, created_by_user_id=user.id, updated=now, updated_by_user_id=user.id))
+            animal.notes.append(Note(text="Note", created=now, created_by_user_id=user.id, updated=now,
+                                     updated_by_user_id=user.id))
+        session.commit()
+        client = create_client(session)
+
+        paths = [("/events/", {"page_size": 10}), ("/conditions/", {}), ("/animals/weight", {}),
+                 ("/animals/", {"expand": ["notes", "tracked_conditions", "tracked_events", "tracked_condition_types",
+                                           "tracked_event_types", "weight_history"]})]
+        get_setting = settingsManager.get_setting
+
+        for path, params in paths:
+            expected = client.get(path, params=params)
+            asyncio.run(response_cache.invalidate(ANIMALS_NAMESPACE, CONDITIONS_NAMESPACE))
+            with mock.patch.object(settingsManager, "get_setting",
+                                   lambda key: "true" if key == "FAST_JSON_RESPONSES" else get_setting(key)):
+                actual = client.get(path, params=params)
+
+            self.assertEqual(200, actual.status_code)
+            self.assertGreater(len(expected.json()), 0)
+            self.assertEqual(expected.json(), actual.json(), path)
+            self.assertEqual(expected.headers.get("x-next-cursor"), actual.headers.get("x-next-cursor"))
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class ResponseCacheTest(TestCase):
+    def test_get_all_animals_cached(self):
+        """
+        A repeated listing is served from the cache with only the ETag statement, until an animal is deleted.
+        """
+        session = create_session()
+        seed(session, animal_count=3)
+        client = create_client(session)
+
+        expected = client.get("/animals/", params={"expand": ["tracked_event_types"]})
+        self.assertEqual(3, len(expected.json()))
+
+        with StatementCounter(*client.engines) as counter:
+            actual = client.get("/animals/", params={"expand": ["tracked_event_types"]})
+        self.assertEqual(expected.json(), actual.json())
+        self.assertEqual(expected.headers["etag"], actual.headers["etag"])
+        self.assertEqual(1, counter.count)
+
+        self.assertEqual(204, client.delete("/animals/1").status_code)
+        self.assertEqual([2, 3], [animal["id"] for animal in client.get(
+            "/animals/", params={"expand": ["tracked_event_types"]}).json()])
+
+    def test_get_or_load(self):
+        """
+        Concurrent misses for the same key load once, and invalidating the namespace loads again.
+        """
+        import asyncio
+        from src.cache import LocalCacheBackend
+        from src.services.response_cache import ResponseCache
+
+        cache = ResponseCache(LocalCacheBackend(16, 60))
+        loads = []
+
+        async def load() -> bytes:
+            loads.append(1)
+            await asyncio.sleep(0.01)
+            return b"[]"
+
+        async def get_all():
+            return await asyncio.gather(*[cache.get_or_load("animals", (1, "a"), load) for _ in range(5)])
+
+        self.assertEqual([b"[]"] * 5, asyncio.run(get_all()))
+        self.assertEqual(b"[]", asyncio.run(cache.get_or_load("animals", (1, "a"), load)))
+        self.assertEqual(1, len(loads))
+        self.assertEqual({"hits": 1, "misses": 1, "coalesced": 4, "hit_ratio": 1 / 6}, cache.get_metrics())
+
+        asyncio.run(cache.invalidate("conditions"))
+        asyncio.run(cache.get_or_load("animals", (1, "a"), load))
+        self.assertEqual(1, len(loads))
+
+        asyncio.run(cache.invalidate("animals"))
+        asyncio.run(cache.get_or_load("animals", (1, "a"), load))
+        self.assertEqual(2, len(loads))
+
+    def test_redis_backend(self):
+        """
+        The Redis backend awaits its client, stores values with the TTL and shares generation counters through incr.
+        """
+        import asyncio
+        from src.cache import RedisCacheBackend
+
+        class Redis:
+            def __init__(self):
+                self.values = {}
+                self.expiry = {}
+
+            async def get(self, key):
+                return self.values.get(key)
+
+            async def set(self, key, value, ex=None):
+                self.values[key] = value
+                self.expiry[key] = ex
+
+            async def incr(self, key):
+                self.values[key] = str(int(self.values.get(key, 0)) + 1).encode()
+                return int(self.values[key])
+
+        client = Redis()
+        backend = RedisCacheBackend(client, 60)
+
+        async def run():
+            await backend.set("animals:0:key", b"[]")
+            self.assertEqual(b"[]", await backend.get("animals:0:key"))
+            self.assertEqual(60, client.expiry["animals:0:key"])
+            self.assertEqual(0, await backend.get_counter("animals:generation"))
+            self.assertEqual(1, await backend.increment("animals:generation"))
+            self.assertEqual(1, await backend.get_counter("animals:generation"))
+
+        asyncio.run(run())
+
+    def test_invalidate_from_thread(self):
+        """
+        Threads which anyio did not start invalidate through the event loop the cache was last used from, or through
+        an event loop of their own when there is none.
+        """
+        import asyncio
+        from src.cache import CacheBackend, LocalCacheBackend
+        from src.services.response_cache import ResponseCache
+
+        with self.assertRaises(TypeError):
+            CacheBackend()
+
+        cache = ResponseCache(LocalCacheBackend(10, 60))
+
+        async def load() -> bytes:
+            return b"[]"
+
+        async def run():
+            await cache.get_or_load("animals", (), load)
+            await asyncio.get_running_loop().run_in_executor(None, cache.invalidate_from_thread, "animals")
+            self.assertEqual(1, await cache.backend.get_counter("animals:generation"))
+
+        asyncio.run(run())
+        cache.invalidate_from_thread("animals")
+        self.assertEqual(2, asyncio.run(cache.backend.get_counter("animals:generation")))
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class PasswordHasherTest(TestCase):
+    def test_hash_and_verify(self):
+        """
+        Passwords are hashed with the configured rounds in a worker process, and verified against the hash.
+        """
+        import asyncio
+        from src.services.passwords import PasswordHasher
+
+        hasher = PasswordHasher(worker_count=1, max_pending=2, rounds=4)
+        try:
+            password_hash = asyncio.run(hasher.hash("secret"))
+            self.assertTrue(password_hash.startswith("$2b$04$"))
+            self.assertTrue(asyncio.run(hasher.verify("secret", password_hash)))
+            self.assertFalse(asyncio.run(hasher.verify("wrong", password_hash)))
+
+            metrics = hasher.get_metrics()
+            self.assertEqual(0, metrics["pending"])
+            self.assertEqual(1, metrics["hash"]["count"])
+            self.assertEqual(2, metrics["verify"]["count"])
+        finally:
+            hasher.stop()
+
+    def test_admission_control(self):
+        """
+        Operations beyond max_pending are rejected with a 503 instead of waiting for a worker.
+        """
+        import asyncio
+        from fastapi import HTTPException
+        from src.services.passwords import PasswordHasher
+
+        hasher = PasswordHasher(worker_count=1, max_pending=0, rounds=4)
+        try:
+            with self.assertRaises(HTTPException) as context:
+                asyncio.run(hasher.hash("secret"))
+            self.assertEqual(503, context.exception.status_code)
+            self.assertEqual("1", context.exception.headers["Retry-After"])
+            self.assertEqual(1, hasher.get_metrics()["rejected"])
+        finally:
+            hasher.stop()
+
+    def test_pending_hash_holds_no_thread(self):
+        """
+        A request waiting for a hash awaits it on the event loop without borrowing a token of the threadpool.
+        """
+        import asyncio
+        from anyio import to_thread
+        from src.services.passwords import PasswordHasher
+
+        hasher = PasswordHasher(worker_count=1, max_pending=2, rounds=4)
+
+        async def run():
+            task = asyncio.create_task(hasher.hash("secret"))
+            while hasher.get_metrics()["pending"] == 0:
+                await asyncio.sleep(0)
+
+            self.assertEqual(0, to_thread.current_default_thread_limiter().borrowed_tokens)
+            self.assertTrue((await task).startswith("$2b$04$"))
+
+        try:
+            asyncio.run(run())
+        finally:
+            hasher.stop()
+
+    def test_login(self):
+        """
+        A user created through the API can log in with its password, and not with any other.
+        """
+        session = create_session()
+        client = create_client(session)
+
+        self.assertEqual(201, client.post("/users/", json={
+            "first_name": "Test", "last_name": "User", "email_address": "test@pooper.online", "password": "secret",
+            "password_repeated": "secret"
+        }).status_code)
+
+        response = client.post("/auth/token", data={"username": "test@pooper.online", "password": "secret"})
+        self.assertEqual(200, response.status_code)
+        self.assertIn("access_token", response.json())
+        self.assertEqual(401, client.post("/auth/token", data={"username": "test@pooper.online", "password": "wrong"})
+                         .status_code)
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class EventBusTest(TestCase):
+    def test_stream(self):
+        """
+        A stream is sent uncompressed as Server-Sent Events, and only carries the messages matching its filters.
+        """
+        import asyncio
+        from src.main import app
+        from src.services.event_bus import event_bus
+
+        session = create_session()
+        seed(session, event_count=4, animal_count=2)
+        client = create_client(session)
+
+        async def stream() -> (dict, bytes):
+            start = None
+            body = b""
+            received = asyncio.Event()
+            scope = {"type": "http", "http_version": "1.1", "method": "GET", "scheme": "http", "path": "/events/stream",
+                     "raw_path": b"/events/stream", "root_path": "", "query_string": b"animal_ids=1",
+                     "headers": [(b"authorization", b"Bearer test"), (b"accept", b"text/event-stream"),
+                                 (b"accept-encoding", b"gzip")],
+                     "client": ("127.0.0.1", 0), "server": ("127.0.0.1", 80)}
+
+            async def receive():
+                await asyncio.Event().wait()
+
+            async def send(message):
+                nonlocal start, body
+                if message["type"] == "http.response.start":
+                    start = message
+                else:
+                    body += message.get("body", b"")
+                    if b"event.deleted" in body:
+                        received.set()
+
+            task = asyncio.create_task(app(scope, receive, send))
+            while event_bus.get_metrics()["subscriptions"] == 0:
+                await asyncio.sleep(0.01)
+
+            # Events 1 and 3 belong to animal 1, and events 2 and 4 to animal 2.
+            self.assertEqual(204, (await asyncio.to_thread(client.delete, "/events/2")).status_code)
+            self.assertEqual(204, (await asyncio.to_thread(client.delete, "/events/3")).status_code)
+            await asyncio.wait_for(received.wait(), 5)
+            task.cancel()
+            return dict(start["headers"]), body
+
+        headers, body = asyncio.run(stream())
+        self.assertEqual(b"text/event-stream", headers[b"content-type"].split(b";")[0])
+        self.assertNotIn(b"content-encoding", headers)
+        self.assertTrue(body.startswith(b"retry: "))
+        self.assertEqual(1, body.count(b"event: event.deleted"))
+        self.assertIn(b'"id":3', body)
+        self.assertEqual(0, event_bus.get_metrics()["subscriptions"])
+
+    def test_disconnect_before_stream_starts(self):
+        """
+        The stream handler only subscribes once the response starts, so a client which disconnects before that leaves
+        no subscription behind. An invalid Last-Event-ID is still rejected by the handler.
+        """
+        import asyncio
+        from fastapi import HTTPException
+        from src.routers.events import stream
+        from src.services.event_bus import event_bus
+
+        async def run():
+            response = await stream(animal_ids=None, event_type=None, last_event_id=None)
+            self.assertEqual(0, event_bus.get_metrics()["subscriptions"])
+
+            chunk = await response.body_iterator.__anext__()
+            self.assertTrue(chunk.startswith(b"retry: "))
+            self.assertEqual(1, event_bus.get_metrics()["subscriptions"])
+            await response.body_iterator.aclose()
+            self.assertEqual(0, event_bus.get_metrics()["subscriptions"])
+
+        asyncio.run(run())
+        with self.assertRaises(HTTPException):
+            asyncio.run(stream(animal_ids=None, event_type=None, last_event_id="not an id"))
+
+    def test_resume(self):
+        """
+        A subscription resumes after the last event id while it is in the history, and is reset otherwise.
+        """
+        import asyncio
+        from fastapi import HTTPException
+        from src.services.event_bus import EventBus
+
+        bus = EventBus(history_size=2)
+        for i in range(4):
+            bus.publish("event.created", {"id": i}, [i % 2], ["Pee"])
+
+        async def subscribe(*args):
+            return bus.subscribe(*args)
+
+        subscription = asyncio.run(subscribe([1], None, f"{bus.epoch}-2"))
+        self.assertFalse(subscription.is_reset)
+        self.assertEqual([{"id": 3}], [message.data for message in subscription.replay])
+
+        subscription = asyncio.run(subscribe(None, ["Pee"], f"{bus.epoch}-2"))
+        self.assertEqual([{"id": 2}, {"id": 3}], [message.data for message in subscription.replay])
+
+        self.assertTrue(asyncio.run(subscribe(None, None, f"{bus.epoch}-1")).is_reset)
+        self.assertTrue(asyncio.run(subscribe(None, None, "otherepoch-3")).is_reset)
+        self.assertEqual([], asyncio.run(subscribe(None, None, f"{bus.epoch}-4")).replay)
+        with self.assertRaises(HTTPException):
+            asyncio.run(subscribe(None, None, "not an id"))
+
+    def test_overflow(self):
+        """
+        A subscription which falls behind is ended, so that the client reconnects and resumes from the history.
+        """
+        import asyncio
+        from src.services.event_bus import EventBus
+
+        bus = EventBus(queue_size=1)
+
+        async def stream() -> list:
+            subscription = bus.subscribe()
+            for i in range(3):
+                bus.publish("event.created", {"id": i}, [1], ["Pee"])
+            await asyncio.sleep(0)
+            return [chunk async for chunk in bus.stream(subscription)]
+
+        chunks = asyncio.run(stream())
+        self.assertEqual(1, len(chunks))
+        self.assertEqual(1, bus.get_metrics()["overflowed"])
+        self.assertEqual(0, bus.get_metrics()["subscriptions"])
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class AnimalsTest(TestCase):
+    def test_update_tracked_types(self):
+        """
+        Updating an animal only inserts the added types and deletes the removed ones, and keeps the rows of the rest.
+        """
+        from datetime import datetime
+
+        from sqlalchemy.exc import IntegrityError
+        from src.database import AnimalEventTypeAssociation
+
+        session = create_session()
+        user, animals = seed(session)
+        session.query(AnimalEventTypeAssociation).update({
+            AnimalEventTypeAssociation.created: datetime(2022, 1, 1),
+            AnimalEventTypeAssociation.updated: datetime(2022, 1, 1)
+        })
+        session.commit()
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+
+        response = client.put("/animals/1", json={"name": "Renamed", "condition_types_to_track": ["Heat"],
+                                                  "event_types_to_track": ["Pee", "Poo"]})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual("Renamed", response.json()["name"])
+        self.assertEqual(["Heat"], [association["condition_type"]
+                                    for association in response.json()["tracked_condition_types"]])
+        tracked_event_types = {association["event_type"]: association
+                               for association in response.json()["tracked_event_types"]}
+        self.assertEqual({"Pee", "Poo"}, set(tracked_event_types))
+        self.assertEqual("2022-01-01T00:00:00", tracked_event_types["Pee"]["created"])
+
+        response = client.put("/animals/1", json={"name": "Renamed", "condition_types_to_track": [],
+                                                  "event_types_to_track": ["Poo"]})
+        self.assertEqual([], response.json()["tracked_condition_types"])
+        self.assertEqual([tracked_event_types["Poo"]], response.json()["tracked_event_types"])
+
+        session.add(AnimalEventTypeAssociation(animal_id=1, event_type="Poo", created=datetime.now(),
+                                               updated=datetime.now()))
+        with self.assertRaises(IntegrityError):
+            session.commit()
+
+    def test_get_all_expand(self):
+        """
+        Only the expanded collections are loaded, with a number of statements which does not depend on the number of
+        animals. Tracked events are capped to the latest collection_limit, 100 by default, and notes only when
+        collection_limit is given.
+        """
+        from datetime import datetime, timedelta
+        from src.database import Note
+        from src.models.animal_collection import AnimalCollection
+
+        counts = []
+        for animal_count in [1, 5]:
+            session = create_session()
+            user, animals = seed(session, event_count=animal_count * 30, animal_count=animal_count)
+            now = datetime.now()
+            for animal in animals:
+                for i in range(105):
+                    animal.notes.append(Note(text=f"Note {i}", created=now - timedelta(minutes=i),
+                                             created_by_user_id=user.id, updated=now, updated_by_user_id=user.id))
+            session.commit()
+            client = create_client(session)
+
+            response = client.get("/animals/")
+            self.assertEqual(200, response.status_code)
+            self.assertEqual([105] * animal_count, [len(animal["notes"]) for animal in response.json()])
+            self.assertEqual([[]] * animal_count, [animal["tracked_events"] for animal in response.json()])
+            self.assertEqual([["Pee"]] * animal_count, [[association["event_type"]
+                                                         for association in animal["tracked_event_types"]]
+                                                        for animal in response.json()])
+
+            response = client.get("/animals/", params={"expand": ["tracked_events"], "collection_limit": 3})
+            for animal in response.json():
+                self.assertEqual([], animal["notes"])
+                self.assertEqual(["Pee"] * 3, [event["event_type"] for event in animal["tracked_events"]])
+                created = [event["created"] for event in animal["tracked_events"]]
+                self.assertEqual(sorted(created, reverse=True), created)
+
+            response = client.get("/animals/", params={"expand": ["notes"], "collection_limit": 2})
+            self.assertEqual([["Note 0", "Note 1"]] * animal_count, [[note["text"] for note in animal["notes"]]
+                                                                     for animal in response.json()])
+
+            with StatementCounter(*client.engines) as counter:
+                response = client.get("/animals/", params={"expand": [collection.value for collection in
+                                                                      AnimalCollection]})
+            self.assertEqual(animal_count, len(response.json()))
+            counts.append(counter.count)
+
+        self.assertEqual(counts[0], counts[1])
+
+        session = create_session()
+        seed(session, event_count=310)
+        client = create_client(session)
+        response = client.get("/animals/1", params={"expand": ["tracked_events"]})
+        self.assertEqual(100, len(response.json()["tracked_events"]))
+
+    def test_get_all_pages_and_weights(self):
+        """
+        Pages of animals follow each other without gaps or repeats, and the weight history is limited to the last
+        weight_days and capped to the latest weight_limit.
+        """
+        from datetime import datetime, time, timedelta
+        from src.database import AnimalWeight
+
+        session = create_session()
+        user, animals = seed(session, animal_count=5)
+        midday = datetime.combine(datetime.now().date(), time(12))
+        for i in range(10):
+            animals[0].weight_history.append(AnimalWeight(
+                weight_in_grams=5000 + i, created=midday - timedelta(days=i), created_by_user_id=user.id,
+                updated=midday, updated_by_user_id=user.id))
+        session.commit()
+        client = create_client(session)
+
+        names = [[animal["name"] for animal in client.get("/animals/", params={"page": page, "page_size": 2}).json()]
+                 for page in range(4)]
+        self.assertEqual([["Animal 0", "Animal 1"], ["Animal 2", "Animal 3"], ["Animal 4"], []], names)
+
+        def get_weights(**params) -> list:
+            response = client.get("/animals/", params={"expand": ["weight_history"], "page_size": 1, **params})
+            self.assertEqual(200, response.status_code)
+            return [weight["weight_in_grams"] for weight in response.json()[0]["weight_history"]]
+
+        self.assertEqual([5000 + i for i in range(10)], get_weights())
+        self.assertEqual([5000, 5001, 5002, 5003], get_weights(weight_days=3))
+        self.assertEqual([5000, 5001], get_weights(weight_days=3, weight_limit=2))
+        self.assertEqual([5000], get_weights(weight_days=1))
+
+    def test_get_statuses(self):
+        """
+        The latest event per animal and tracked event type follows created and deleted events, and is read without
+        loading any events. Untracking an event type hides it, and deleting an animal removes its latest events.
+        """
+        from datetime import datetime, timedelta
+        from src.database import AnimalLastEvent, Event
+        from src.services.animal_status import rebuild_last_events
+
+        session = create_session()
+        user, animals = seed(session, event_count=30, animal_count=2)
+        rebuild_last_events(session)
+        session.commit()
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+
+        for event_id in [1, 2]:
+            self.assertEqual(204, client.delete(f"/events/{event_id}").status_code)
+        for created in [datetime.now() - timedelta(days=1), datetime.now()]:
+            self.assertEqual(201, client.post("/events/", json={"latitude": 59.91, "longitude": 10.75, "animal_id": 1,
+                                                                "event_type": "Poo", "created": created.isoformat()})
+                             .status_code)
+        self.assertEqual(200, client.post("/events/batch", json=[
+            {"latitude": 59.91, "longitude": 10.75, "animal_id": 2, "event_type": "Eat",
+             "created": (datetime.now() - timedelta(days=1)).isoformat(), "idempotency_key": "1"},
+            {"latitude": 59.91, "longitude": 10.75, "animal_id": 2, "event_type": "Eat", "idempotency_key": "2"}
+        ]).status_code)
+
+        with StatementCounter(*client.engines) as counter:
+            response = client.get("/animals/status")
+        self.assertEqual(200, response.status_code)
+        self.assertLessEqual(counter.count, 3)
+
+        expected = {}
+        for event in session.query(Event).order_by(Event.created, Event.id):
+            if event.is_tracked:
+                expected[(event.animal_id, event.event_type)] = event.id
+        self.assertEqual({(1, "Pee"), (2, "Pee")}, set(expected))
+        self.assertEqual(expected, {(status["animal_id"], last_event["event_type"]): last_event["event_id"]
+                                    for status in response.json() for last_event in status["last_events"]})
+        self.assertEqual(["Animal 0", "Animal 1"], [status["name"] for status in response.json()])
+
+        rebuild_last_events(session)
+        session.commit()
+        self.assertEqual(response.json(), client.get("/animals/status").json())
+
+        self.assertEqual(200, client.put("/animals/2", json={"name": "Animal 1", "condition_types_to_track": [],
+                                                             "event_types_to_track": []}).status_code)
+        self.assertEqual([["Pee"], []], [[last_event["event_type"] for last_event in status["last_events"]]
+                                         for status in client.get("/animals/status").json()])
+
+        self.assertEqual(204, client.delete("/animals/1").status_code)
+        self.assertEqual(0, session.query(AnimalLastEvent).where(AnimalLastEvent.animal_id == 1).count())
+
+    def test_get_weight_trend(self):
+        """
+        The weight trend of each animal is bounded by max_points with either downsampling method, and its slope and
+        change are computed over every weight.
+        """
+        from datetime import datetime, timedelta
+        from src.database import AnimalWeight
+
+        session = create_session()
+        user, animals = seed(session, animal_count=2)
+        start = datetime(2022, 1, 1)
+        session.bulk_insert_mappings(AnimalWeight, [{
+            "animal_id": 1 if i < 1000 else 2,
+            "weight_in_grams": 5000 + 2 * i + (100 if i == 500 else 0),
+            "created": start + timedelta(days=i % 1000),
+            "created_by_user_id": user.id,
+            "updated": start,
+            "updated_by_user_id": user.id
+        } for i in range(1010)])
+        session.commit()
+        client = create_client(session)
+
+        for method in ["lttb", "buckets"]:
+            with StatementCounter(*client.engines) as counter:
+                response = client.get("/animals/weight/trend", params={"max_points": 50, "method": method})
+            self.assertEqual(200, response.status_code)
+            self.assertLessEqual(counter.count, 2)
+
+            trend, other_trend = response.json()
+            self.assertEqual((1, 1000), (trend["animal_id"], trend["count"]))
+            self.assertLessEqual(len(trend["points"]), 50)
+            self.assertAlmostEqual(2, trend["slope_grams_per_day"], places=1)
+            self.assertAlmostEqual((6998 - 5000) / 5000 * 100, trend["change_percent"])
+            self.assertEqual(10, len(other_trend["points"]))
+
+        # The first of 50 buckets over 999 days holds the weights of the first 20 days.
+        self.assertEqual("2022-01-10T12:00:00", trend["points"][0]["created"])
+        self.assertEqual(5019, trend["points"][0]["weight_in_grams"])
+
+        response = client.get("/animals/weight/trend", params={"max_points": 50})
+        points = {point["created"]: point for point in response.json()[0]["points"]}
+        self.assertEqual(6100, points[(start + timedelta(days=500)).isoformat()]["weight_in_grams"])
+        self.assertEqual(6998, points[(start + timedelta(days=999)).isoformat()]["weight_in_grams"])
+        self.assertAlmostEqual(sum(5000 + 2 * i for i in range(993, 1000)) / 7,
+                               points[(start + timedelta(days=999)).isoformat()]["moving_average"])
+
+        self.assertEqual(400, client.get("/animals/weight/trend", params={"max_points": 2}).status_code)
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class TripsTest(TestCase):
+    def test_create_with_unknown_event(self):
+        """
+        A trip listing an event which does not exist is rejected with a 404, and neither the trip nor the events are
+        written.
+        """
+        from src.database import Event, Trip
+
+        session = create_session()
+        user, _ = seed(session, event_count=2)
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+
+        response = client.post("/trips/", json={"event_ids": [1, 100]})
+        self.assertEqual(404, response.status_code)
+        self.assertEqual("events with ids [100] were not found", response.json()["detail"])
+        session.expire_all()
+        self.assertEqual(0, session.query(Trip).count())
+        self.assertEqual([None, None], [trip_id for (trip_id,) in session.query(Event.trip_id)])
+
+    def test_create(self):
+        """
+        The events of a new trip are assigned to it with a single UPDATE, in the same transaction as the trip.
+        """
+        from src.database import Event
+
+        session = create_session()
+        user, _ = seed(session, event_count=4)
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+
+        with StatementCounter(*client.engines) as counter:
+            response = client.post("/trips/", json={"event_ids": [1, 2, 3]})
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, len([statement for statement in counter.statements
+                                 if statement.lstrip().upper().startswith("UPDATE EVENT")]))
+        self.assertEqual(1, counter.commits)
+
+        session.expire_all()
+        trip_id = response.json()["id"]
+        self.assertEqual({1: trip_id, 2: trip_id, 3: trip_id, 4: None},
+                         dict(session.query(Event.id, Event.trip_id)))
+
+    def test_get_trip(self):
+        """
+        A trip is returned with its events, oldest first, from one joined query, and an unknown trip is a 404.
+        """
+        session = create_session()
+        user, _ = seed(session, event_count=4)
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+        trip_id = client.post("/trips/", json={"event_ids": [1, 2, 3]}).json()["id"]
+        session.expire_all()
+
+        with StatementCounter(*client.engines) as counter:
+            response = client.get(f"/trips/{trip_id}")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(1, counter.count)
+        self.assertEqual([3, 2, 1], [event["id"] for event in response.json()["events"]])
+        self.assertEqual(["Test User"] * 3, [event["created_by_user_name"] for event in response.json()["events"]])
+
+        self.assertEqual(404, client.get("/trips/100").status_code)
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class TimeWindowTest(TestCase):
+    def test_local_day_in_server_time(self):
+        """
+        A day in the time zone of the client is converted to the half-open window of the server time it covers.
+        """
+        from datetime import datetime, timezone
+        from src.services.time_window import get_time_window
+
+        def in_server_time(value: datetime) -> datetime:
+            return value.replace(tzinfo=timezone.utc).astimezone().replace(tzinfo=None)
+
+        self.assertEqual((in_server_time(datetime(2021, 12, 31, 23)), in_server_time(datetime(2022, 1, 1, 23))),
+                         get_time_window(from_date=datetime(2022, 1, 1), to_date=datetime(2022, 1, 2),
+                                         time_zone="Europe/Oslo"))
+        self.assertEqual((datetime(2022, 1, 1), datetime(2022, 1, 2)), get_time_window(
+            from_date=datetime(2022, 1, 1), to_date=datetime(2022, 1, 2)))
+        self.assertEqual((in_server_time(datetime(2022, 6, 30, 22)), None), get_time_window(
+            from_date=datetime.fromisoformat("2022-07-01T00:00:00+02:00"), time_zone="America/New_York"))
+
+    def test_days(self):
+        """
+        days=1 is today and days=n reaches n calendar days further back, in the time zone of the client, and both
+        end at the start of the next day.
+        """
+        from datetime import datetime, time, timedelta
+        from zoneinfo import ZoneInfo
+        from fastapi import HTTPException
+        from src.services.time_window import get_time_window
+
+        zone = ZoneInfo("Pacific/Kiritimati")
+        midnight = datetime.combine(datetime.now(zone).date(), time.min, tzinfo=zone)
+        start, end = get_time_window(days=1, time_zone="Pacific/Kiritimati")
+        self.assertEqual(midnight.astimezone().replace(tzinfo=None), start)
+        self.assertEqual(start + timedelta(days=1), end)
+
+        start, end = get_time_window(days=3, time_zone="Pacific/Kiritimati", from_date=datetime(2000, 1, 1))
+        self.assertEqual((midnight - timedelta(days=3)).astimezone().replace(tzinfo=None), start)
+
+        with self.assertRaises(HTTPException) as context:
+            get_time_window(days=1, time_zone="Not/AZone")
+        self.assertEqual(400, context.exception.status_code)
+
+    def test_filter_events(self):
+        """
+        The window includes its start, excludes its end, and with days leaves out events in the future.
+        """
+        from datetime import datetime, time, timedelta
+        from src.database import Event
+
+        session = create_session()
+        user, _ = seed(session)
+        midnight = datetime.combine(datetime.now().date(), time.min)
+        for created in [midnight - timedelta(microseconds=1), midnight, midnight + timedelta(hours=1),
+                        midnight + timedelta(days=1), midnight + timedelta(days=2)]:
+            session.add(Event(latitude=59.91, longitude=10.75, event_type="Pee", animal_id=1, created=created,
+                              created_by_user_id=user.id, updated=created, updated_by_user_id=user.id))
+        session.commit()
+        client = create_client(session)
+
+        def get_ids(**params) -> list:
+            response = client.get("/events/", params={"sort_order": "asc", **params})
+            self.assertEqual(200, response.status_code)
+            return [event["id"] for event in response.json()]
+
+        self.assertEqual([2, 3], get_ids(days=1))
+        self.assertEqual([1, 2, 3], get_ids(days=2))
+        self.assertEqual([2, 3], get_ids(**{"from": midnight.isoformat(), "to": (midnight + timedelta(days=1))
+                                            .isoformat()}))
+        self.assertEqual([1], get_ids(to=midnight.isoformat()))
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class UsersTest(TestCase):
+    def test_principal_cache(self):
+        """
+        A cached user is returned without any statement, and changes to the user through the API are seen by the
+        next request.
+        """
+        from src.services.users import principal_cache
+
+        principal_cache.clear()
+        session = create_session()
+        user, _ = seed(session)
+        client = create_client(session)
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+
+        self.assertEqual(200, client.get("/users/me").status_code)
+        with StatementCounter(*client.engines) as counter:
+            response = client.get("/users/me")
+        self.assertEqual(200, response.status_code)
+        self.assertEqual(0, counter.count)
+
+        self.assertEqual(200, client.patch("/users/theme/Dark").status_code)
+        self.assertEqual("Dark", client.get("/users/me").json()["color_theme"])
+
+        self.assertEqual(200, client.patch("/users/update", json={
+            "first_name": "Renamed", "last_name": "User", "email_address": "test@pooper.online", "password": "secret",
+            "password_repeated": "secret"
+        }).status_code)
+        # The update commits through the asynchronous session, and the synchronous one is shared between requests.
+        session.expire_all()
+        self.assertEqual("Renamed", client.get("/users/me").json()["first_name"])
+
+        self.assertEqual(204, client.delete(f"/users/{user.id}").status_code)
+        self.assertEqual(401, client.get("/users/me").status_code)
+
+    def test_principal_with_other_email_address(self):
+        """
+        A token is rejected once the email address it was issued to no longer belongs to its user, whether or not
+        the user is cached.
+        """
+        from src.database import User
+        from src.services.users import principal_cache
+
+        principal_cache.clear()
+        session = create_session()
+        user, _ = seed(session)
+        client = create_client(session)
+        old_token = create_token(user)
+        client.headers["Authorization"] = f"Bearer {old_token}"
+        self.assertEqual(200, client.get("/users/me").status_code)
+
+        session.query(User).update({User.email_address: "other@pooper.online"})
+        session.commit()
+        client.headers["Authorization"] = f"Bearer {create_token(user)}"
+        self.assertEqual(401, client.get("/users/me").status_code)
+
+        principal_cache.clear()
+        client.headers["Authorization"] = f"Bearer {old_token}"
+        self.assertEqual(401, client.get("/users/me").status_code)
+
+
+@mock.patch.dict(os.environ, {
+    "CLIENT_BASE_URL": "mock client base url",
+    "API_SECRET_AUTH_KEY": "mock api secret auth key",
+    "SENDER_EMAIL_ADDRESS": "mock sender email address",
+    "SENDGRID_API_KEY": "mock sendgrid api key",
+    "MARIADB_USER": "pooper",
+    "MARIADB_PASSWORD": "pooper",
+    "MARIADB_DATABASE": "pooper",
+    "MARIADB_SERVER": "127.0.0.1",
+    "VAPID_PUBLIC_KEY": "mock vapid public key",
+    "VAPID_PRIVATE_KEY": "mock vapid private key"
+})
+class PoolTest(TestCase):
+    def test_pool_options(self):
+        """
+        The pool is sized from the settings, and pings connections on checkout.
+        """
+        from src.database import get_pool_options
+        from src.settings_manager import settingsManager
+
+        settings = {"MARIADB_POOL_SIZE": "3", "MARIADB_MAX_OVERFLOW": "4", "MARIADB_POOL_TIMEOUT": "5",
+                    "MARIADB_POOL_RECYCLE": "6"}
+        with mock.patch.object(settingsManager, "get_setting", lambda key: settings[key]):
+            self.assertEqual({"pool_size": 3, "max_overflow": 4, "pool_timeout": 5, "pool_recycle": 6,
+                              "pool_pre_ping": True}, get_pool_options())
+
+    def test_pool_metrics(self):
+        """
+        Checking connections out and back in is reported by the metrics endpoint, including the overflow beyond the
+        size of the pool and the time spent waiting for a connection.
+        """
+        from sqlalchemy import create_engine
+        from src.metrics import register_metrics
+        from src.pool import InstrumentedQueuePool
+
+        session = create_session()
+        engine = create_engine(session.get_bind().url, poolclass=InstrumentedQueuePool, pool_size=1, max_overflow=1,
+                               pool_pre_ping=True)
+        register_metrics("test_pool", engine.pool.get_metrics)
+        client = create_client(session)
+
+        connections = [engine.connect(), engine.connect()]
+        metrics = client.get("/metrics/").json()["test_pool"]
+        self.assertEqual({"size": 1, "checked_in": 0, "checked_out": 2, "overflow": 1},
+                         {key: value for key, value in metrics.items() if key != "checkout_wait"})
+        self.assertEqual(2, metrics["checkout_wait"]["count"])
+
+        for connection in connections:
+            connection.close()
+        metrics = client.get("/metrics/").json()["test_pool"]
+        self.assertEqual((1, 0), (metrics["checked_in"], metrics["checked_out"]))
+        engine.dispose()